@@ -4,6 +4,7 @@ import pypulseq as pp
 import numpy as np
 import matplotlib.pyplot as plt
 import util
+import brainweb_store
 
 # makes the ex folder your working directory
 import os
@@ -66,7 +67,7 @@ sz = [64, 64]
 if 1:
     # (i) load a phantom object from file
     # obj_p = mr0.VoxelGridPhantom.load_mat('../data/phantom2D.mat')
-    obj_p = mr0.VoxelGridPhantom.brainweb('../data/brainweb/output/subject05.npz').slices([216]) #original resolution 432x432x432
+    obj_p = brainweb_store.brainweb('../data/brainweb/output/subject05.npz', slices=[216]) #original resolution 432x432x432
     obj_p = obj_p.interpolate(sz[0], sz[1], 1)
     # Manipulate loaded data
     obj_p.B0 *= 1    # alter the B0 inhomogeneity
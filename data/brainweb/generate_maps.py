@@ -23,6 +23,10 @@ INCLUDE_FAT = False
 # The BrainWeb data is centered in the MAP_SIZE^3 volume
 MAP_SIZE = 432 if INCLUDE_FAT else 432
 
+# Also write the maps uncompressed as one z-major .npy per map, which
+# ex/brainweb_store.py can load slice by slice
+SAVE_STORE = True
+
 if INCLUDE_FAT:
     print("WARNING: the maps include fat but don't export offresonance!")
 
@@ -292,3 +296,16 @@ for subject in SUBJECTS:
             tissue_GM = tissue_GM,
             tissue_CSF = tissue_CSF
         )
+
+    if SAVE_STORE:
+        store_dir = file_name[:-4]
+        print(f"Saving uncompressed maps to 'output/{name[:-4]}/'")
+        os.makedirs(store_dir, exist_ok=True)
+        # The B0 / B1 normalization of old maps is computed again on load
+        if os.path.exists(os.path.join(store_dir, "norm.json")):
+            os.remove(os.path.join(store_dir, "norm.json"))
+        for key, value in [("PD_map", PD_map), ("T1_map", T1_map),
+                           ("T2_map", T2_map), ("T2dash_map", T2dash_map),
+                           ("D_map", D_map)]:
+            np.save(os.path.join(store_dir, key + ".npy"),
+                    np.ascontiguousarray(value.transpose(2, 0, 1)))
@@ -5,6 +5,7 @@ import numpy as np
 import torch
 from matplotlib import pyplot as plt
 import util
+import brainweb_store
 import random
 
 # makes the ex folder your working directory
@@ -108,7 +109,7 @@ slice_num = 216 #center slice
 if 1:
     # (i) load a phantom object from file
     # obj_p = mr0.VoxelGridPhantom.load_mat('../data/phantom2D.mat')
-    obj_p = mr0.VoxelGridPhantom.brainweb(phantom_path).slices([slice_num]) #original resolution 432x432x432
+    obj_p = brainweb_store.brainweb(phantom_path, slices=[slice_num]) #original resolution 432x432x432
     obj_p = obj_p.interpolate(sz[0], sz[1], 1)
     # Manipulate loaded data
     obj_p.T2dash[:] = 30e-3
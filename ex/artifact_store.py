@@ -0,0 +1,211 @@
+"""Content-addressed store for sequences, signals and reconstructions.
+
+Every run of an exercise writes ``out/external.seq`` and a copy named after
+the experiment, and nothing links the sequence to the signal or image that
+was simulated from it. :class:`ArtifactStore` stores every artifact once,
+named by the SHA-256 of its contents, and keeps a small JSON index of runs:
+which ``experiment_id`` produced which artifacts at what time. Storing the
+same content again only marks it as recently used, and the store is kept
+below a size limit by deleting the least recently used blobs.
+
+A script can check if an unchanged sequence was simulated before and skip
+the simulation:
+
+.. code-block:: python
+
+    store = artifact_store.ArtifactStore()
+    seq_hash = store.put_seq(seq)
+    run = store.find(seq=seq_hash, phantom=phantom_tag)
+    if run is not None and 'signal' in run:
+        signal = store.get_tensor(run['signal'])
+    else:
+        signal = mr0.execute_graph(graph, seq0, obj_p)
+        store.record(experiment_id, seq=seq_hash, phantom=phantom_tag,
+                     signal=store.put_tensor(signal))
+"""
+
+from __future__ import annotations
+import os
+import io
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+import torch
+
+from cache_dir import CacheDir
+
+
+STORE_DIR = os.path.join(os.path.dirname(__file__), 'out', 'cache', 'artifacts')
+# Extension of all blobs, so that a blob is found by its hash alone
+BLOB_SUFFIX = '.blob'
+
+
+class ArtifactStore:
+    """Content-addressed blobs plus an index of runs.
+
+    Blobs are stored as ``<hash>.blob`` in ``path/blobs`` (a
+    :class:`CacheDir`), the index as ``path/index.json``: a list of runs,
+    each a dict with ``experiment_id``, ``time`` and one hash per artifact
+    name. Values that aren't hashes (e.g. a phantom tag) can be recorded as
+    well.
+
+    Attributes
+    ----------
+    path : str
+        Directory of the store
+    max_size : int
+        Maximum total size of all blobs in bytes
+    """
+
+    def __init__(self, path: str = STORE_DIR, max_size: int = 1024 * 2**20):
+        self.path = path
+        self.blobs = CacheDir(os.path.join(path, 'blobs'), max_size, BLOB_SUFFIX)
+        self.index_file = os.path.join(path, 'index.json')
+
+    @property
+    def max_size(self) -> int:
+        return self.blobs.max_size
+
+    @max_size.setter
+    def max_size(self, max_size: int) -> None:
+        self.blobs.max_size = max_size
+
+    # ---- blobs ----
+
+    def blob_path(self, key: str) -> str | None:
+        """Path of the blob with hash ``key``, ``None`` if it isn't stored."""
+        file_name = self.blobs.file_name(key + BLOB_SUFFIX)
+        return file_name if os.path.exists(file_name) else None
+
+    def put_bytes(self, data: bytes) -> str:
+        """Store ``data`` and return its hash, identical data is stored once."""
+        key = hashlib.sha256(data).hexdigest()
+        file_name = self.blob_path(key)
+        if file_name is not None:
+            self.blobs.touch(file_name)
+            return key
+
+        def save(tmp_name):
+            with open(tmp_name, 'wb') as file:
+                file.write(data)
+        self.blobs.write(key + BLOB_SUFFIX, save)
+        return key
+
+    def put_file(self, file_name: str) -> str:
+        """Store a copy of a file."""
+        with open(file_name, 'rb') as file:
+            return self.put_bytes(file.read())
+
+    def put_seq(self, seq) -> str:
+        """Store a ``pypulseq.Sequence`` (written to .seq) or a .seq file."""
+        if isinstance(seq, str):
+            return self.put_file(seq)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_name = os.path.join(tmp_dir, 'seq.seq')
+            seq.write(file_name)
+            return self.put_file(file_name)
+
+    def put_tensor(self, tensor: torch.Tensor | np.ndarray) -> str:
+        """Store a signal or reconstruction in ``.npy`` format."""
+        if isinstance(tensor, torch.Tensor):
+            tensor = tensor.detach().cpu().numpy()
+        buffer = io.BytesIO()
+        np.save(buffer, tensor, allow_pickle=False)
+        return self.put_bytes(buffer.getvalue())
+
+    def get_bytes(self, key: str) -> bytes | None:
+        file_name = self.blob_path(key)
+        if file_name is None:
+            return None
+        self.blobs.touch(file_name)
+        with open(file_name, 'rb') as file:
+            return file.read()
+
+    def get_tensor(self, key: str) -> torch.Tensor | None:
+        """Load a tensor stored with :meth:`put_tensor` (memory mapped)."""
+        file_name = self.blob_path(key)
+        if file_name is None:
+            return None
+        self.blobs.touch(file_name)
+        return torch.from_numpy(np.load(file_name, mmap_mode='c'))
+
+    def export(self, key: str, file_name: str) -> bool:
+        """Copy a blob to ``file_name`` (e.g. ``out/external.seq``).
+
+        Returns ``False`` if the blob isn't stored. This is a copy and not a
+        link, ``seq.write`` would otherwise overwrite the blob in place.
+        """
+        blob = self.blob_path(key)
+        if blob is None:
+            return False
+        shutil.copyfile(blob, file_name)
+        return True
+
+    def evict(self) -> None:
+        """Delete least recently used blobs until the size limit is met.
+
+        Index entries are kept, references to deleted blobs are dropped by
+        :meth:`runs`.
+        """
+        self.blobs.evict()
+
+    # ---- index ----
+
+    def _load_index(self) -> list[dict]:
+        if not os.path.isfile(self.index_file):
+            return []
+        try:
+            with open(self.index_file) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return []  # Corrupted index, start a new one
+
+    def record(self, experiment_id: str, **artifacts: str) -> dict:
+        """Add a run that produced ``artifacts`` (name -> hash or value)."""
+        run = {'experiment_id': experiment_id, 'time': time.time(), **artifacts}
+        index = self._load_index()
+        index.append(run)
+        os.makedirs(self.path, exist_ok=True)
+        tmp_name = self.index_file + f'.{os.getpid()}.tmp'
+        with open(tmp_name, 'w') as file:
+            json.dump(index, file, indent=1)
+        os.replace(tmp_name, self.index_file)
+        return run
+
+    def runs(self, experiment_id: str | None = None) -> list[dict]:
+        """All recorded runs (of one experiment), oldest first.
+
+        Artifacts whose blobs were evicted are removed from the result.
+        """
+        stored = {name[:-len(BLOB_SUFFIX)]
+                  for _, _, name in self.blobs.entries()}
+        result = []
+        for run in self._load_index():
+            if experiment_id is not None and run['experiment_id'] != experiment_id:
+                continue
+            result.append({
+                name: value for name, value in run.items()
+                if not _is_hash(value) or value in stored
+            })
+        return result
+
+    def find(self, experiment_id: str | None = None, **artifacts: str
+             ) -> dict | None:
+        """Newest run that matches all given artifacts, ``None`` if none."""
+        for run in reversed(self.runs(experiment_id)):
+            if all(run.get(name) == value for name, value in artifacts.items()):
+                return run
+        return None
+
+    def clear(self) -> None:
+        """Delete all blobs and the index."""
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
+
+
+def _is_hash(value) -> bool:
+    return (isinstance(value, str) and len(value) == 64
+            and all(c in '0123456789abcdef' for c in value))
@@ -0,0 +1,152 @@
+"""Simulate one sequence for many phantom variants in a single pass.
+
+Quantitative mapping (VFA, MP-FLASH T1, B1 double angle...) often simulates
+the same sequence and graph for dozens of slightly different phantoms. Instead
+of running the main pass once per phantom, all phantoms are interleaved along
+the voxel axis of one :class:`SimData` and simulated together, so the python
+overhead per repetition and distribution is paid only once.
+
+Example
+-------
+>>> variants = batch_sim.vary(data, B1=data.B1 * scale[:, None, None])
+>>> stacked = batch_sim.stack_sim_data(variants)
+>>> graph = mr0.compute_graph(seq, stacked, 200, 1e-3)
+>>> signal = batch_sim.execute_graph_batch(graph, seq, stacked, len(variants))
+>>> signal.shape  # batch x samples x coils
+"""
+
+from __future__ import annotations
+import torch
+import MRzeroCore as mr0
+
+import main_pass
+
+
+def vary(data: mr0.SimData, **maps: torch.Tensor) -> list[mr0.SimData]:
+    """Create variants of ``data`` with some of its maps replaced.
+
+    Every keyword is the name of a :class:`SimData` attribute (``PD``,
+    ``T1``, ``T2``, ``T2dash``, ``D``, ``B0``, ``B1`` or ``coil_sens``) and
+    a tensor with an additional leading batch dimension. All tensors must
+    have the same batch size.
+    """
+    batch_sizes = {tensor.shape[0] for tensor in maps.values()}
+    if len(batch_sizes) != 1:
+        raise ValueError("All maps must have the same batch size")
+
+    variants = []
+    for b in range(batch_sizes.pop()):
+        attr = {
+            name: maps[name][b] if name in maps else getattr(data, name)
+            for name in ["PD", "T1", "T2", "T2dash", "D", "B0", "B1",
+                         "coil_sens"]
+        }
+        variants.append(mr0.SimData(
+            **attr,
+            fov=data.fov,
+            voxel_pos=data.voxel_pos,
+            nyquist=data.nyquist,
+            dephasing_func=data.dephasing_func,
+            recover_func=data.recover_func
+        ))
+    return variants
+
+
+def stack_sim_data(data: list[mr0.SimData]) -> mr0.SimData:
+    """Interleave multiple phantoms into one :class:`SimData`.
+
+    Voxel ``v`` of phantom ``b`` is stored at index ``v * batch_size + b``
+    with ``batch_size = len(data)``, which must be passed on to
+    :func:`execute_graph_batch` together with the returned instance.
+    Phantoms with less voxels are padded with voxels without proton density.
+    fov and nyquist of all phantoms must be equal, the dephasing function of
+    the first phantom is used for all of them.
+    """
+    first = data[0]
+    for d in data[1:]:
+        if not (torch.equal(d.fov, first.fov)
+                and torch.equal(d.nyquist, first.nyquist)):
+            raise ValueError("All phantoms must have the same fov and nyquist")
+        if d.B1.shape[0] != first.B1.shape[0] or \
+                d.coil_sens.shape[0] != first.coil_sens.shape[0]:
+            raise ValueError("All phantoms must have the same coil count")
+    voxel_count = max(d.PD.numel() for d in data)
+
+    def stack(name: str, fill: float) -> torch.Tensor:
+        tensors = []
+        for d in data:
+            tensor = getattr(d, name)
+            pad = voxel_count - tensor.shape[-1]
+            tensors.append(torch.nn.functional.pad(tensor, (0, pad), value=fill))
+        return torch.stack(tensors, -1).flatten(-2)
+
+    # Padded voxels are placed at the first voxel position so that a grid
+    # phantom stays on its grid
+    voxel_pos = torch.stack([
+        torch.cat([d.voxel_pos, d.voxel_pos[:1].expand(
+            voxel_count - d.PD.numel(), 3
+        )])
+        for d in data
+    ], 1).flatten(0, 1)
+
+    stacked = mr0.SimData(
+        stack("PD", 0.0),
+        stack("T1", 1.0),
+        stack("T2", 1.0),
+        stack("T2dash", 1.0),
+        stack("D", 0.0),
+        stack("B0", 0.0),
+        stack("B1", 1.0),
+        stack("coil_sens", 0.0),
+        first.fov,
+        voxel_pos,
+        first.nyquist,
+        first.dephasing_func,
+    )
+    return stacked
+
+
+def execute_graph_batch(graph: mr0.Graph,
+                        seq: mr0.Sequence,
+                        data: mr0.SimData | list[mr0.SimData],
+                        batch_size: int | None = None,
+                        min_signal: float = 1e-2,
+                        min_weight: float = 1e-2,
+                        **kwargs
+                        ) -> torch.Tensor:
+    """Calculate the signal of the sequence for a batch of phantoms.
+
+    The graph is shared by all phantoms. Compute it from the stacked data so
+    that the prepass uses the averaged properties of the whole batch.
+
+    Parameters
+    ----------
+    graph, seq, min_signal, min_weight
+        Same as for :func:`main_pass.execute_graph`.
+    data : SimData | list[SimData]
+        Either a list of phantoms or the output of :func:`stack_sim_data`.
+    batch_size : int | None
+        Number of phantoms stacked in ``data``, required if ``data`` is the
+        output of :func:`stack_sim_data`. Must be None or ``len(data)`` for a
+        list of phantoms.
+    **kwargs
+        Passed on to :func:`main_pass.execute_graph` (e.g. ``max_memory``).
+
+    Returns
+    -------
+    signal : torch.Tensor
+        Tensor of shape (batch, samples, coils)
+    """
+    if not isinstance(data, mr0.SimData):
+        if batch_size not in (None, len(data)):
+            raise ValueError(f"batch_size {batch_size} != {len(data)} phantoms")
+        batch_size = len(data)
+        data = stack_sim_data(data)
+    elif batch_size is None:
+        raise ValueError("batch_size is required for stacked SimData")
+
+    signal = main_pass.execute_graph(
+        graph, seq, data, min_signal, min_weight,
+        batch_size=batch_size, **kwargs
+    )
+    return signal.view(signal.shape[0], batch_size, -1).transpose(0, 1)
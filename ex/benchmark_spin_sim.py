@@ -0,0 +1,69 @@
+# %% S0. SETUP env
+import MRzeroCore as mr0
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+import time
+
+import isochromat_sim
+
+# makes the ex folder your working directory
+import os
+os.environ['KMP_DUPLICATE_LIB_OK'] = 'True'
+os.chdir(os.path.abspath(os.path.dirname(__file__)))
+
+# Compares the isochromat simulation (ground truth) with the PDG simulation
+# (execute_graph) on the sequences written by the FLASH and spin echo
+# exercises. Run exE01_FLASH_2D.py and exA02_SpinEcho.py first.
+sequences = {
+    'FLASH': 'out/exE01_FLASH_2D_user_tag_fruit#.seq',
+    'spin echo': 'out/exA02_SpinEcho.seq',
+}
+sz = [64, 64]
+spin_count = 1000
+max_memory = 2**30  # bytes for the spin_sim events x voxels x spins tiles
+use_gpu = False  # spin_sim runs on the device of the phantom
+
+
+# %% S4: SETUP SPIN SYSTEM/object
+obj_p = mr0.VoxelGridPhantom.load_mat('../data/numerical_brain_cropped.mat')
+obj_p = obj_p.interpolate(sz[0], sz[1], 1)
+obj_p.T2dash[:] = 30e-3
+obj_p.D *= 0
+obj_p = obj_p.build()
+if use_gpu:
+    obj_p = obj_p.cuda()
+
+
+# %% S5:. SIMULATE with both simulations
+results = {}
+for name, file_name in sequences.items():
+    seq0 = mr0.Sequence.from_seq_file(mr0.PulseqFile(file_name))
+
+    start = time.perf_counter()
+    graph = mr0.compute_graph(seq0, obj_p, 200, 1e-3)
+    signal_pdg = mr0.execute_graph(graph, seq0, obj_p)
+    time_pdg = time.perf_counter() - start
+
+    start = time.perf_counter()
+    signal_iso = isochromat_sim.spin_sim(
+        seq0, obj_p, spin_count, max_memory=max_memory)
+    time_iso = time.perf_counter() - start
+
+    nrmse = float(torch.linalg.vector_norm(signal_pdg - signal_iso)
+                  / torch.linalg.vector_norm(signal_iso))
+    results[name] = (signal_pdg.cpu(), signal_iso.cpu())
+    print(f"\n{name}: execute_graph {time_pdg:.2f} s, "
+          f"spin_sim ({spin_count} spins) {time_iso:.2f} s, "
+          f"NRMSE {nrmse:.3%}")
+
+
+# %% S6: PLOT signals
+fig, axes = plt.subplots(len(results), 1, figsize=(10, 3 * len(results)))
+for ax, (name, (signal_pdg, signal_iso)) in zip(np.atleast_1d(axes), results.items()):
+    ax.plot(signal_iso[:, 0].abs(), label='spin_sim')
+    ax.plot(signal_pdg[:, 0].abs(), '--', label='execute_graph')
+    ax.set_title(name)
+    ax.legend()
+plt.tight_layout()
+plt.show()
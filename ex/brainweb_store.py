@@ -0,0 +1,211 @@
+"""Memory mapped BrainWeb phantoms that load single slices.
+
+``mr0.VoxelGridPhantom.brainweb`` decompresses all five 432³ maps of a
+``subjectXX.npz`` written by ``data/brainweb/generate_maps.py`` and computes
+the synthetic B0 and B1 maps on the full volume, even if only one slice is
+used afterwards. This module stores the maps uncompressed, one ``.npy`` per
+map in a directory next to the ``.npz``, with the z axis first so that every
+slice is contiguous on disk. :func:`brainweb` memory maps these files, reads
+only the requested slices and computes B0 and B1 only on them.
+
+B0 and B1 are normalized with their PD weighted average over the whole
+volume. These two numbers are computed once, slice by slice, and saved in
+``norm.json`` of the store, together with the size and modification time of
+the ``.npz`` they belong to. If the ``.npz`` changes, the store is rebuilt.
+
+.. code-block:: python
+
+    # Same as mr0.VoxelGridPhantom.brainweb(file_name).slices([216])
+    obj_p = brainweb_store.brainweb(
+        '../data/brainweb/output/subject05.npz', slices=[216])
+
+The store is created from the ``.npz`` on first use, or directly by
+``generate_maps.py``.
+"""
+
+from __future__ import annotations
+import os
+import json
+import numpy as np
+import torch
+import MRzeroCore as mr0
+
+
+MAPS = ('PD_map', 'T1_map', 'T2_map', 'T2dash_map', 'D_map')
+NORM_FILE = 'norm.json'
+# Increment if the layout of the store or the B0 / B1 maps change
+STORE_VERSION = 1
+
+
+def store_path(file_name: str) -> str:
+    """Store directory of ``subjectXX.npz``: ``subjectXX/`` next to it."""
+    if file_name.endswith('.npz'):
+        return file_name[:-4]
+    return file_name
+
+
+def _stamp(file_name: str) -> list[int]:
+    """Size and modification time, to detect a rewritten file."""
+    stat = os.stat(file_name)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _load_norm(path: str) -> dict | None:
+    """Content of ``norm.json``, None if it is missing or outdated."""
+    try:
+        with open(os.path.join(path, NORM_FILE)) as file:
+            norm = json.load(file)
+    except (OSError, ValueError):
+        return None  # Missing or corrupted, compute again
+    if not isinstance(norm, dict) or norm.get('version') != STORE_VERSION:
+        return None
+    return norm
+
+
+def is_stale(path: str, source: str | None) -> bool:
+    """If the store is incomplete or doesn't belong to the ``.npz`` source."""
+    maps = [os.path.join(path, name + '.npy') for name in MAPS]
+    if not all(os.path.isfile(map_file) for map_file in maps):
+        return True
+    if source is None:
+        return False
+    norm = _load_norm(path)
+    if norm is not None:
+        return norm.get('source') != _stamp(source)
+    # Not loaded yet (written by convert or generate_maps.py): the maps must
+    # have been written after the .npz
+    return os.path.getmtime(source) > min(os.path.getmtime(m) for m in maps)
+
+
+def convert(file_name: str) -> str:
+    """Write the store of a ``generate_maps.py`` ``.npz``, returns its path.
+
+    Maps are converted one at a time, so only one of them is in memory.
+    """
+    path = store_path(file_name)
+    os.makedirs(path, exist_ok=True)
+    # The normalization of the old maps must not be used for the new ones
+    if os.path.isfile(os.path.join(path, NORM_FILE)):
+        os.remove(os.path.join(path, NORM_FILE))
+    with np.load(file_name) as data:
+        for name in MAPS:
+            target = os.path.join(path, name + '.npy')
+            # Write to a temporary file first, an interrupted conversion
+            # must not leave a truncated map behind
+            tmp_name = target[:-4] + f'.{os.getpid()}.tmp.npy'
+            np.save(tmp_name, np.ascontiguousarray(data[name].transpose(2, 0, 1)))
+            os.replace(tmp_name, target)
+    return path
+
+
+def _open(path: str) -> dict[str, np.memmap]:
+    """Memory map all maps of a store, each has the shape (z, x, y)."""
+    return {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+            for name in MAPS}
+
+
+def _b_maps(shape: tuple[int, int, int], z: list[int] | np.ndarray
+            ) -> tuple[torch.Tensor, torch.Tensor]:
+    """Unnormalized B0 and B1 of ``VoxelGridPhantom.brainweb`` on slices z.
+
+    ``shape`` is the (x, y, z) shape of the full volume, the result has the
+    shape (x, y, len(z)).
+    """
+    x_pos, y_pos, z_pos = torch.meshgrid(
+        torch.linspace(-1, 1, shape[0]),
+        torch.linspace(-1, 1, shape[1]),
+        torch.linspace(-1, 1, shape[2])[torch.as_tensor(z, dtype=torch.long)],
+        indexing="ij"
+    )
+    B1 = torch.exp(-(0.4*x_pos**2 + 0.2*y_pos**2 + 0.3*z_pos**2))
+    dist2 = (0.4*x_pos**2 + 0.2*(y_pos - 0.7)**2 + 0.3*z_pos**2)
+    B0 = 7 / (0.05 + dist2) - 45 / (0.3 + dist2)
+    return B0, B1
+
+
+def normalization(path: str, source: str | None = None,
+                  chunk_size: int = 16) -> tuple[float, float]:
+    """PD weighted average of the B0 and B1 maps of the whole volume.
+
+    Computed in chunks of ``chunk_size`` slices and cached in ``norm.json``,
+    with the stamp of the ``source`` .npz the maps were converted from.
+    """
+    norm = _load_norm(path)
+    if norm is not None and 'B0_mean' in norm and 'B1_mean' in norm:
+        return norm['B0_mean'], norm['B1_mean']
+
+    PD = _open(path)['PD_map']
+    shape = (PD.shape[1], PD.shape[2], PD.shape[0])
+    PD_sum = B0_sum = B1_sum = 0.0
+    for start in range(0, shape[2], chunk_size):
+        z = np.arange(start, min(start + chunk_size, shape[2]))
+        weight = torch.from_numpy(PD[z]).permute(1, 2, 0).double()
+        B0, B1 = _b_maps(shape, z)
+        PD_sum += weight.sum().item()
+        B0_sum += (B0 * weight).sum().item()
+        B1_sum += (B1 * weight).sum().item()
+
+    norm = {'version': STORE_VERSION,
+            'source': None if source is None else _stamp(source),
+            'B0_mean': B0_sum / PD_sum, 'B1_mean': B1_sum / PD_sum}
+    norm_file = os.path.join(path, NORM_FILE)
+    tmp_name = norm_file + f'.{os.getpid()}.tmp'
+    with open(tmp_name, 'w') as file:
+        json.dump(norm, file)
+    os.replace(tmp_name, norm_file)
+    return norm['B0_mean'], norm['B1_mean']
+
+
+def brainweb(file_name: str, slices: list[int] | None = None
+             ) -> mr0.VoxelGridPhantom:
+    """Load (slices of) a BrainWeb phantom.
+
+    Result is the same as ``VoxelGridPhantom.brainweb(file_name)`` followed
+    by ``.slices(slices)``, up to float rounding of the B0 and B1
+    normalization.
+
+    Parameters
+    ----------
+    file_name : str
+        ``subjectXX.npz`` written by ``generate_maps.py`` or its store
+        directory. The store is created if it doesn't exist yet or the
+        ``.npz`` changed since (see :func:`is_stale`).
+    slices : list[int] | None
+        Indices of the z slices to load, all slices if ``None``
+
+    Returns
+    -------
+    VoxelGridPhantom
+        Phantom with the shape (x, y, len(slices)) and the FOV of the full
+        volume, like ``VoxelGridPhantom.slices``.
+    """
+    path = store_path(file_name)
+    source = None
+    if file_name.endswith('.npz') and os.path.isfile(file_name):
+        source = file_name
+    if is_stale(path, source):
+        convert(file_name)
+
+    data = _open(path)
+    z_count = data['PD_map'].shape[0]
+    if slices is None:
+        slices = list(range(z_count))
+    if not all(0 <= z < z_count for z in slices):
+        raise IndexError(f"Slices {slices} out of range for {z_count} slices")
+
+    # Fancy indexing of the memory maps only reads the selected slices
+    maps = {name: torch.from_numpy(mm[slices]).permute(1, 2, 0).contiguous()
+            for name, mm in data.items()}
+    PD = maps['PD_map']
+    B0, B1 = _b_maps((PD.shape[0], PD.shape[1], z_count), slices)
+    B0_mean, B1_mean = normalization(path, source)
+    B0 -= B0_mean
+    B1 /= B1_mean
+
+    return mr0.VoxelGridPhantom(
+        PD, maps['T1_map'], maps['T2_map'], maps['T2dash_map'], maps['D_map'],
+        B0, B1[None, ...],
+        coil_sens=torch.ones(1, *PD.shape),
+        base_fov=torch.tensor([0.192, 0.192, 0.192]),
+        rel_fov=torch.ones(3)
+    )
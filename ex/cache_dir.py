@@ -0,0 +1,93 @@
+"""Directory of cache files with atomic writes and LRU eviction.
+
+Used by the on-disk caches :class:`pre_pass.GraphCache`,
+:class:`sim_cache.SimCache` and :class:`artifact_store.ArtifactStore`.
+Files are written to a temporary name first and then renamed, so that an
+interrupted write never leaves a corrupted entry under the final name.
+The modification time of a file is its last use, updated by
+:meth:`CacheDir.touch` when an entry is read. :meth:`CacheDir.evict` deletes
+the least recently used files until the directory is below its size limit.
+"""
+
+from __future__ import annotations
+import os
+from typing import Callable
+
+
+class CacheDir:
+    """Cache files in one directory, kept below a size limit.
+
+    Only files ending with :attr:`suffix` are entries of the cache, temporary
+    files of running writes are never counted or evicted.
+
+    Attributes
+    ----------
+    path : str
+        Directory containing the cache files
+    max_size : int
+        Maximum total size of all entries in bytes
+    suffix : str
+        File extension of the entries, ``''`` for any file
+    """
+
+    def __init__(self, path: str, max_size: int, suffix: str = ''):
+        self.path = path
+        self.max_size = max_size
+        self.suffix = suffix
+
+    def file_name(self, name: str) -> str:
+        """Path of the entry ``name`` (including its extension)."""
+        return os.path.join(self.path, name)
+
+    def write(self, name: str, save: Callable[[str], None]) -> str:
+        """Create the entry ``name`` with ``save(file_name)``, then evict.
+
+        ``save`` writes a temporary file that has the same extension as
+        ``name`` (``np.save`` would append ``.npy`` otherwise), which then
+        replaces the entry. Returns the path of the entry.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        file_name = self.file_name(name)
+        stem, ext = os.path.splitext(file_name)
+        tmp_name = f'{stem}.{os.getpid()}.tmp{ext}'
+        try:
+            save(tmp_name)
+            os.replace(tmp_name, file_name)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+        self.evict()
+        return file_name
+
+    def touch(self, file_name: str) -> None:
+        """Mark an entry as recently used."""
+        os.utime(file_name)
+
+    def entries(self) -> list[tuple[float, int, str]]:
+        """``(mtime, size, name)`` of all entries, least recently used first."""
+        if not os.path.isdir(self.path):
+            return []
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(self.suffix) and '.tmp' not in name:
+                stat = os.stat(os.path.join(self.path, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        return entries
+
+    def evict(self) -> None:
+        """Delete least recently used entries until the size limit is met."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries[:-1]:  # never delete the newest entry
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+    def clear(self) -> None:
+        """Delete all entries."""
+        if os.path.isdir(self.path):
+            for name in os.listdir(self.path):
+                if name.endswith(self.suffix):
+                    os.remove(os.path.join(self.path, name))
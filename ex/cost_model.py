@@ -0,0 +1,298 @@
+"""Predict the cost of :func:`main_pass.execute_graph` without running it.
+
+The main pass cost is dominated by two parts:
+
+- every simulated distribution updates a ``voxels`` long magnetisation and
+  runs many small tensor operations (python and dispatch overhead)
+- every measured + distribution builds an ``events x voxels`` tensor and
+  multiplies it with the ``voxels x coils`` sensitivities
+
+:func:`estimate_cost` counts these from the graph and converts them to FLOPs,
+memory and time. Time uses per-machine constants measured by
+:func:`calibrate`, which are stored in ``out/cache`` and reused, and the
+overhead of the python loop in units of one small tensor operation, which
+:func:`fit_overhead` fits to profiled main pass runs.
+
+Example
+-------
+>>> graph = mr0.compute_graph(seq0, obj_p, 200, 1e-3)
+>>> cost = cost_model.estimate_cost(seq0, obj_p, graph)
+>>> cost['time'], cost['peak_memory'], cost['dominant']
+"""
+
+from __future__ import annotations
+import os
+import json
+import time
+import platform
+import numpy as np
+import torch
+import MRzeroCore as mr0
+
+import main_pass
+from main_pass import BYTES_PER_ELEMENT, voxel_chunk_size
+
+
+CALIBRATION_FILE = os.path.join(
+    os.path.dirname(__file__), 'out', 'cache', 'cost_calibration.json')
+
+# Floating point operations per element, counted from the main pass
+SIGNAL_FLOPS = 70  # relaxation, dephasing and phase of one event and voxel
+COIL_FLOPS = 8  # complex multiply-add per event, voxel and coil
+TRANSFORM_FLOPS = 8  # pulse transform of one ancestor per voxel
+RELAX_FLOPS = 20  # relaxation and diffusion at the end of the repetition
+# Overhead in units of one small tensor operation: per repetition, per
+# distribution in the graph (ancestor filtering) and per simulated
+# distribution. Used if the calibration doesn't contain fitted values.
+# Rounded results of fit_overhead on a CPU, pooled over the FLASH (exE01),
+# spin echo (exA02) and EPI (exB09) sequences of ex/out with a 16x16 phantom
+# and state counts of 20 and 200. Repeated fits differed by up to a factor
+# of two, only the order of magnitude is reliable.
+REP_OPS = 100
+GRAPH_DIST_OPS = 6
+DIST_OPS = 20
+
+
+def _bench(func, repeats: int = 5) -> float:
+    """Smallest wall time of ``repeats`` calls of ``func``."""
+    func()  # warm up
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def calibrate(device: torch.device | str = 'cpu',
+              cache_file: str | None = CALIBRATION_FILE) -> dict[str, float]:
+    """Measure the time constants of the main pass on this machine.
+
+    Returns seconds per ``events x voxels`` element of the signal kernel
+    (``signal``), per element and coil of the coil product (``coil``), per
+    voxel of a state update (``state``) and per small tensor operation
+    (``op``). Results are stored in ``cache_file``, keyed by machine, device
+    and thread count. Pass ``cache_file=None`` to always measure and store
+    nothing.
+    """
+    device = torch.device(device)
+    key = f"{platform.node()}/{device}/{torch.get_num_threads()}"
+    stored = {}
+    if cache_file is not None and os.path.isfile(cache_file):
+        try:
+            with open(cache_file) as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            pass  # Corrupted file, measure again and overwrite it
+        if key in stored:
+            return stored[key]
+
+    events, voxels, coils = 128, 4096, 8
+    traj = torch.rand(events, 4, device=device)
+    pos = torch.rand(voxels, 3, device=device)
+    T2 = torch.rand(voxels, device=device) + 0.1
+    B0 = torch.rand(voxels, device=device)
+    D = torch.rand(voxels, device=device)
+    b = torch.rand(events, 1, device=device)
+    mag = torch.rand(voxels, dtype=torch.cfloat, device=device)
+    sens = torch.rand(voxels, coils, dtype=torch.cfloat, device=device)
+    small = torch.rand(4, device=device)
+
+    def signal():
+        rot = torch.exp(2j * np.pi * ((traj[:, 3:] * B0) - (traj[:, :3] @ pos.T)))
+        relax = torch.exp(-traj[:, 3:] / T2) * torch.exp(-traj[:, 3:].abs() / T2)
+        return mag * rot * relax * torch.exp(-1e-9 * D * b)
+
+    transverse_mag = signal()
+    states = mag.expand(64, voxels)
+
+    def sync(result=None):
+        if device.type == 'cuda':
+            torch.cuda.synchronize(device)
+        return result
+
+    constants = {
+        'signal': _bench(lambda: sync(signal())) / (events * voxels),
+        'coil': _bench(lambda: sync(transverse_mag @ sens)) / (events * voxels * coils),
+        'state': _bench(lambda: sync(
+            (states * mag + states.conj() * mag) * T2 * torch.exp(-D))
+        ) / states.numel(),
+        'op': _bench(lambda: sync([torch.exp(small) for _ in range(100)])) / 100,
+    }
+
+    if cache_file is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        stored[key] = constants
+        tmp_name = cache_file + f'.{os.getpid()}.tmp'
+        with open(tmp_name, 'w') as file:
+            json.dump(stored, file, indent=1)
+        os.replace(tmp_name, cache_file)
+    return constants
+
+
+def graph_statistics(graph: mr0.Graph, min_signal: float = 1e-2,
+                     min_weight: float = 1e-2) -> np.ndarray:
+    """Count what the main pass computes for every repetition.
+
+    Applies the same ``min_weight`` / ``min_signal`` / ancestor rules as
+    :func:`main_pass.execute_graph`. Returns an integer array of shape
+    (repetitions, 4) with the number of simulated distributions, measured
+    + distributions, simulated ancestor edges and all distributions.
+    """
+    simulated = {id(graph[0][0])}
+    stats = np.zeros((len(graph) - 1, 4), dtype=np.int64)
+    for i, dists in enumerate(graph[1:]):
+        stats[i, 3] = len(dists)
+        current = set()
+        for dist in dists:
+            ancestors = [a for a in dist.ancestors if id(a[1]) in simulated]
+            if dist.dist_type != 'z0' and (
+                    dist.weight < min_weight or len(ancestors) == 0):
+                continue
+            current.add(id(dist))
+            stats[i, 0] += 1
+            stats[i, 2] += len(ancestors)
+            if dist.dist_type == '+' and dist.rel_signal >= min_signal:
+                stats[i, 1] += 1
+        simulated = current
+    return stats
+
+
+def _compute_time(stats: np.ndarray, events: np.ndarray, voxels: int,
+                  coils: int, calibration: dict[str, float]) -> np.ndarray:
+    """Time per repetition that scales with the voxel count, no overhead."""
+    simulated, measured, edges, _ = stats.T
+    return (
+        measured * events * voxels
+        * (calibration['signal'] + coils * calibration['coil'])
+        + (edges + simulated) * voxels * calibration['state']
+    )
+
+
+def estimate_cost(seq: mr0.Sequence,
+                  data: mr0.SimData,
+                  graph: mr0.Graph,
+                  min_signal: float = 1e-2,
+                  min_weight: float = 1e-2,
+                  max_memory: float | None = None,
+                  calibration: dict[str, float] | None = None,
+                  dominant_share: float = 0.5,
+                  calibration_file: str | None = CALIBRATION_FILE
+                  ) -> dict:
+    """Predict FLOPs, peak memory and wall time of the main pass.
+
+    Parameters
+    ----------
+    seq, data, graph, min_signal, min_weight, max_memory
+        Same as for :func:`main_pass.execute_graph`.
+    calibration : dict[str, float] | None
+        Time constants, by default the result of :func:`calibrate` on the
+        device of ``data``. Overhead values of :func:`fit_overhead` are
+        used if present, otherwise :data:`REP_OPS`, :data:`GRAPH_DIST_OPS`
+        and :data:`DIST_OPS`.
+    dominant_share : float
+        The most expensive repetitions that together take this share of
+        the predicted time are reported as ``dominant``.
+    calibration_file : str | None
+        Passed to :func:`calibrate` as ``cache_file`` if no ``calibration``
+        is given, ``None`` to measure without storing the result.
+
+    Returns
+    -------
+    cost : dict
+        ``flops``, ``peak_memory`` (bytes) and ``time`` (s) of the whole
+        main pass, ``rep_flops`` and ``rep_time`` per repetition and the
+        indices of the ``dominant`` repetitions, most expensive first.
+    """
+    if calibration is None:
+        calibration = calibrate(data.device, calibration_file)
+    stats = graph_statistics(graph, min_signal, min_weight)
+    simulated, measured, edges, dist_count = stats.T
+    events = np.array([rep.event_count for rep in seq])
+    voxels = data.PD.numel()
+    coils = data.coil_sens.shape[0]
+
+    rep_flops = (
+        measured * events * voxels * (SIGNAL_FLOPS + COIL_FLOPS * coils)
+        + edges * voxels * TRANSFORM_FLOPS + simulated * voxels * RELAX_FLOPS
+    )
+    rep_time = (
+        _compute_time(stats, events, voxels, coils, calibration)
+        + (calibration.get('rep_ops', REP_OPS)
+           + dist_count * calibration.get('graph_dist_ops', GRAPH_DIST_OPS)
+           + simulated * calibration.get('dist_ops', DIST_OPS))
+        * calibration['op']
+    )
+
+    # Magnetisation of this and the previous repetition + one signal tile
+    states = simulated + np.concatenate([[1], simulated[:-1]])
+    tile = np.array([
+        voxels if max_memory is None else voxel_chunk_size(e, voxels, max_memory)
+        for e in events
+    ])
+    rep_memory = (
+        states * voxels * 8
+        + np.where(measured > 0, events * tile * BYTES_PER_ELEMENT, 0)
+    )
+
+    order = np.argsort(-rep_time, kind='stable')
+    share = np.cumsum(rep_time[order]) / max(rep_time.sum(), 1e-30)
+    dominant = order[:int(np.searchsorted(share, dominant_share)) + 1]
+
+    return {
+        'flops': int(rep_flops.sum()),
+        'peak_memory': int(rep_memory.max(initial=0)),
+        'time': float(rep_time.sum()),
+        'rep_flops': rep_flops,
+        'rep_time': rep_time,
+        'dominant': dominant.tolist(),
+    }
+
+
+def fit_overhead(runs: list[tuple[mr0.Sequence, mr0.SimData, mr0.Graph]],
+                 calibration: dict[str, float] | None = None,
+                 repeats: int = 3,
+                 min_signal: float = 1e-2,
+                 min_weight: float = 1e-2) -> dict[str, float]:
+    """Fit the overhead constants to profiled main pass runs.
+
+    Every run is simulated ``repeats`` times with a profiler, the fastest
+    time of every repetition is used. The time that scales with the voxel
+    count is subtracted and the rest is fitted with least squares as
+    ``rep_ops + dist_count * graph_dist_ops + simulated * dist_ops`` small
+    tensor operations. Runs should differ in their state counts, so that
+    the distribution counts are not proportional to each other.
+
+    Returns
+    -------
+    calibration : dict[str, float]
+        Copy of ``calibration`` (by default :func:`calibrate` on the device
+        of the first run) with ``rep_ops``, ``graph_dist_ops`` and
+        ``dist_ops``, to be passed to :func:`estimate_cost`.
+    """
+    if calibration is None:
+        calibration = calibrate(runs[0][1].device)
+
+    rows = []
+    overhead = []
+    for seq, data, graph in runs:
+        wall_time = None
+        for _ in range(repeats):
+            records = []
+            main_pass.execute_graph(graph, seq, data, min_signal, min_weight,
+                                    profiler=records.append)
+            times = np.array([record['wall_time'] for record in records])
+            wall_time = times if wall_time is None else np.minimum(wall_time, times)
+
+        stats = graph_statistics(graph, min_signal, min_weight)
+        events = np.array([rep.event_count for rep in seq])
+        compute = _compute_time(stats, events, data.PD.numel(),
+                                data.coil_sens.shape[0], calibration)
+        rows.append(np.stack([np.ones(len(stats)), stats[:, 3], stats[:, 0]], 1))
+        overhead.append((wall_time - compute) / calibration['op'])
+
+    fit = np.linalg.lstsq(np.concatenate(rows), np.concatenate(overhead),
+                          rcond=None)[0]
+    rep_ops, graph_dist_ops, dist_ops = np.maximum(fit, 0.0)
+    return {**calibration, 'rep_ops': float(rep_ops),
+            'graph_dist_ops': float(graph_dist_ops), 'dist_ops': float(dist_ops)}
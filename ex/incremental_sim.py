@@ -0,0 +1,158 @@
+"""Re-simulate edited sequences starting from the first changed repetition.
+
+When only the tail of a sequence is changed (last phase encoding lines, a
+spoiler, the final ADC), all repetitions before the change produce the same
+magnetisation and signal as before. :class:`IncrementalSimulation` keeps
+snapshots of the distribution magnetisations at repetition boundaries and the
+signal of every repetition. The next simulation resumes from the last
+snapshot before the first changed repetition, so long preparation modules
+(inversion, FLAIR delay, dummy scans) are not simulated on every edit.
+
+Example
+-------
+>>> sim = incremental_sim.IncrementalSimulation(obj_p)
+>>> signal = sim.execute_graph(graph, seq0)
+>>> # edit the end of the sequence, recompute the graph
+>>> signal = sim.execute_graph(mr0.compute_graph(seq1, obj_p), seq1)
+
+Not intended for autograd: snapshots keep the computation graph alive.
+"""
+
+from __future__ import annotations
+import hashlib
+import torch
+import MRzeroCore as mr0
+
+import main_pass
+from pre_pass import repetition_hash
+
+
+def dist_key(dist) -> tuple:
+    """Identify a distribution within its repetition.
+
+    The pre-pass does not return the distributions of a repetition in a
+    deterministic order, so they are matched by type and k-t position.
+    """
+    return (dist.dist_type, tuple(dist.prepass_kt_vec))
+
+
+def graph_rep_hash(dists: list, min_signal: float, min_weight: float) -> str:
+    """Hash the parts of a graph repetition that the main pass depends on."""
+    state = sorted(
+        (
+            dist_key(dist),
+            dist.weight >= min_weight,
+            dist.rel_signal >= min_signal,
+            sorted((a[0], dist_key(a[1])) for a in dist.ancestors),
+        )
+        for dist in dists
+    )
+    return hashlib.sha256(repr(state).encode()).hexdigest()
+
+
+def _common_prefix(a: list, b: list) -> int:
+    count = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        count += 1
+    return count
+
+
+class IncrementalSimulation:
+    """Main pass that reuses results of the previous call.
+
+    Attributes
+    ----------
+    data : SimData
+        Simulated phantom, fixed for the lifetime of this object
+    snapshot_interval : int
+        A snapshot of the magnetisation is kept every ``snapshot_interval``
+        repetitions. Every snapshot stores the magnetisation of all simulated
+        states, smaller intervals resume closer to a change but need more
+        memory.
+    resumed_from : int
+        Repetition at which the last call started simulating
+    """
+
+    def __init__(self,
+                 data: mr0.SimData,
+                 min_signal: float = 1e-2,
+                 min_weight: float = 1e-2,
+                 snapshot_interval: int = 8,
+                 **kwargs) -> None:
+        """Create an incremental simulation of ``data``.
+
+        ``min_signal``, ``min_weight`` and ``kwargs`` are used for all calls
+        of :func:`main_pass.execute_graph`.
+        """
+        self.data = data
+        self.min_signal = min_signal
+        self.min_weight = min_weight
+        self.snapshot_interval = max(1, snapshot_interval)
+        self.kwargs = dict(
+            voxel_chunk=None, max_memory=None, measured_only=False,
+            separable_phase=False, nufft_tol=None, batch_size=1,
+            profiler=None
+        )
+        self.kwargs.update(kwargs)
+        self.resumed_from = 0
+
+        self._rep_hashes: list[str] = []
+        self._graph_hashes: list[str] = []
+        self._signals: list[torch.Tensor] = []
+        # repetition -> {dist_key: (mag, kt_vec)} of the states entering it
+        self._snapshots: dict[int, dict] = {}
+
+    def execute_graph(self, graph: mr0.Graph,
+                      seq: mr0.Sequence) -> torch.Tensor:
+        """Calculate the signal like :func:`main_pass.execute_graph`.
+
+        The result matches a full simulation up to float rounding (the
+        pre-pass can order ancestors differently, which changes the order of
+        summation).
+        """
+        rep_hashes = [repetition_hash(rep) for rep in seq]
+        graph_hashes = [
+            graph_rep_hash(dists, self.min_signal, self.min_weight)
+            for dists in graph
+        ]
+
+        if rep_hashes == self._rep_hashes and \
+                graph_hashes == self._graph_hashes:
+            self.resumed_from = len(seq)
+            return torch.cat(self._signals)
+
+        # Resuming at repetition `start` needs unchanged repetitions before it
+        # and unchanged graph repetitions up to and including graph[start]
+        last_valid = min(
+            _common_prefix(rep_hashes, self._rep_hashes),
+            _common_prefix(graph_hashes, self._graph_hashes) - 1
+        )
+        start = max(
+            [s for s in self._snapshots if s <= last_valid], default=0
+        )
+
+        if start > 0:
+            snapshot = self._snapshots[start]
+            for dist in graph[start]:
+                dist.mag, dist.kt_vec = snapshot.get(dist_key(dist), (None, None))
+        self._snapshots = {s: v for s, v in self._snapshots.items() if s <= start}
+        signals = self._signals[:start]
+        self.resumed_from = start
+
+        for i, rep_sig in main_pass.iter_execute_graph(
+            graph, seq, self.data, self.min_signal, self.min_weight,
+            start_rep=start, **self.kwargs
+        ):
+            signals.append(rep_sig)
+            if (i + 1) % self.snapshot_interval == 0 and i + 1 < len(seq):
+                self._snapshots[i + 1] = {
+                    dist_key(dist): (dist.mag, dist.kt_vec)
+                    for dist in graph[i + 1] if dist.mag is not None
+                }
+
+        self._rep_hashes = rep_hashes
+        self._graph_hashes = graph_hashes
+        self._signals = signals
+        return torch.cat(signals)
@@ -0,0 +1,212 @@
+"""Isochromat Bloch simulation, used as ground truth for the main pass.
+
+Same model as ``MRzeroCore.simulation.spin_sim``: every voxel contains
+``spin_count`` spins with R2-distributed positions and Cauchy-distributed
+off-resonances (T2'). Instead of rotating every spin with 3x3 matrices event
+by event, the transverse magnetisation is stored as complex number and the
+longitudinal as real number. Between two pulses, relaxation and precession
+of a spin are closed-form functions of the time and gradient moment since
+the pulse, so all measured events of a repetition are evaluated at once and
+the state is only advanced to the end of the repetition.
+
+.. code-block:: python
+
+    signal = isochromat_sim.spin_sim(seq, data, spin_count)
+    # Same format as returned by execute_graph(...)
+"""
+
+from __future__ import annotations
+import torch
+from numpy import pi
+import MRzeroCore as mr0
+
+
+# Estimated bytes per element of the events x voxels x spins tensors
+BYTES_PER_ELEMENT = 32
+
+
+def spin_distribution(data: mr0.SimData, spin_count: int
+                      ) -> tuple[torch.Tensor, torch.Tensor]:
+    """Intravoxel positions (3 x spins) and T2' frequencies (spins)."""
+    device = data.device
+    # RawSimData doesn't store the voxel shape. We use the nyquist
+    # frequencies, with a special case for ∞ (custom phantoms).
+    voxel_size = 0.5 / torch.as_tensor(data.nyquist, device=device)
+    if not torch.isfinite(voxel_size).all():
+        # Fallback voxel size
+        voxel_size = torch.tensor([0.1, 0.1, 0.1], device=device)
+
+    # 3 dimensional R2 sequence for intravoxel spin distribution
+    g = 1.22074408460575947536
+    a = 1.0 / torch.tensor([g**1, g**2, g**3], device=device)
+    indices = torch.arange(spin_count, device=device)
+    spin_pos = (0.5 + a[:, None] * indices) % 1
+    spin_pos = 2 * pi * (spin_pos - 0.5) * voxel_size.unsqueeze(1)
+
+    # Cauchy-distributed spin offset frequencies
+    off_res = torch.linspace(-0.5, 0.5, spin_count, device=device)
+    omega = torch.tan(pi * 0.999 * off_res)  # Cut off high frequencies
+    omega = omega[torch.randperm(spin_count).to(device)]
+    return spin_pos, omega
+
+
+def cis(phase: torch.Tensor) -> torch.Tensor:
+    """``exp(1j * phase)`` for real phases, cheaper than the complex exp."""
+    return torch.polar(torch.ones_like(phase), phase)
+
+
+def flip(mxy: torch.Tensor, mz: torch.Tensor, angle: torch.Tensor,
+         phase: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    """Rotate by ``Rz(phase) Rx(angle) Rz(-phase)`` (per voxel angles)."""
+    a = angle.unsqueeze(1)
+    p = phase.unsqueeze(1)
+    x, y = mxy.real, mxy.imag
+    sin_a, cos_a = torch.sin(a), torch.cos(a)
+    sin_p, cos_p = torch.sin(p), torch.cos(p)
+    xy = (1 - cos_a) * sin_p * cos_p
+
+    new_x = (sin_p**2 * cos_a + cos_p**2) * x + xy * y + sin_a * sin_p * mz
+    new_y = xy * x + (sin_p**2 + cos_a * cos_p**2) * y - sin_a * cos_p * mz
+    new_z = -sin_a * sin_p * x + sin_a * cos_p * y + cos_a * mz
+    return torch.complex(new_x, new_y), new_z
+
+
+def voxel_factor(data: mr0.SimData, time: torch.Tensor,
+                 gradm: torch.Tensor) -> torch.Tensor:
+    """T2 relaxation, B0 and gradient precession (events x voxels).
+
+    ``time`` (events) and ``gradm`` (events x 3) are relative to the pulse.
+    """
+    return torch.polar(torch.exp(-time[:, None] / data.T2), (
+        2 * pi * data.B0 * time[:, None]
+        - 2 * pi * (gradm @ data.voxel_pos.T)
+    ))
+
+
+def spin_phase(T2dash: torch.Tensor, spin_pos: torch.Tensor,
+               omega: torch.Tensor, time: torch.Tensor, gradm: torch.Tensor
+               ) -> torch.Tensor:
+    """T2' dephasing and intravoxel precession (events x voxels x spins)."""
+    return (
+        time[:, None, None] * (omega / T2dash.unsqueeze(1))
+        + (gradm @ spin_pos)[:, None, :]
+    )
+
+
+def chunk_sizes(event_count: int, voxel_count: int, spin_count: int,
+                max_memory: float) -> tuple[int, int]:
+    """Voxels and spins per chunk so that a chunk fits into max_memory."""
+    elements = max(1, int(max_memory // BYTES_PER_ELEMENT) // max(event_count, 1))
+    if elements >= spin_count:
+        return max(1, min(voxel_count, elements // spin_count)), spin_count
+    return 1, elements
+
+
+def spin_sim(seq: mr0.Sequence, data: mr0.SimData, spin_count: int,
+             perfect_spoiling=False, max_memory: float = 2**30
+             ) -> torch.Tensor:
+    """
+    Simulate ``seq`` on ``data`` with ``spin_count`` spins per voxel.
+
+    Drop-in for ``MRzeroCore.simulation.spin_sim.spin_sim``. Runs on the
+    device of ``data``. The magnetisation of all spins is kept in memory
+    (12 bytes per spin), the signal is computed in chunks of voxels (and
+    spins, if a single voxel doesn't fit) of at most ``max_memory`` bytes.
+
+    Parameters
+    ----------
+    seq: Sequence
+        The sequence that will be simulated
+    data: SimData
+        Simulation data that defines everything else
+    spin_count: int
+        Number of spins used for simulation
+    perfect_spoiling: bool
+        If ``True``, the transversal magnetization is set to zero on excitation
+    max_memory: float
+        Memory budget in bytes for the ``events x voxels x spins`` tensors
+
+    Returns
+    -------
+    torch.Tensor
+        Complex tensor with shape (sample_count, coil_count)
+    """
+    device = data.device
+    spin_pos, omega = spin_distribution(data, spin_count)
+
+    # Combine coil sensitivities and proton density to a voxels x coils tensor
+    coil_sensitivity = (
+        data.coil_sens.t().to(torch.cfloat)
+        * data.PD.unsqueeze(1) / spin_count
+    )
+
+    # Start off with relaxed magnetisation, shape: voxels x spins
+    voxel_count = data.PD.numel()
+    mxy = torch.zeros(voxel_count, spin_count,
+                      dtype=torch.cfloat, device=device)
+    mz = torch.ones(voxel_count, spin_count, device=device)
+
+    signal = []
+    for r, rep in enumerate(seq):
+        print(f"\r {r+1} / {len(seq)}", end="")
+
+        if perfect_spoiling and rep.pulse.usage == mr0.PulseUsage.EXCIT:
+            mxy = torch.zeros_like(mxy)
+
+        angle = torch.as_tensor(rep.pulse.angle)
+        phase = torch.as_tensor(rep.pulse.phase)
+        if angle.numel() == 1:
+            B1 = data.B1.sum(0)
+            angle = angle * B1.abs()
+            phase = phase + B1.angle()
+        else:  # pTx
+            B1 = (data.B1 * (angle * torch.exp(1j * phase))[:, None]).sum(0)
+            angle = B1.abs()
+            phase = B1.angle()
+        mxy, mz = flip(mxy, mz, angle, phase)
+
+        if rep.event_count == 0:
+            continue
+
+        # Time and gradient moment since the pulse at the end of every event
+        time = rep.event_time.cumsum(0)
+        gradm = rep.gradm.cumsum(0)
+
+        measured = rep.adc_usage > 0
+        if measured.any():
+            sample_time = time[measured]
+            sample_gradm = gradm[measured]
+            voxel_chunk, spin_chunk = chunk_sizes(
+                sample_time.numel(), voxel_count, spin_count, max_memory)
+
+            # sum over spins, shape: events x voxels
+            voxel_mag = torch.zeros(sample_time.numel(), voxel_count,
+                                    dtype=torch.cfloat, device=device)
+            for v_start in range(0, voxel_count, voxel_chunk):
+                v = slice(v_start, v_start + voxel_chunk)
+                for s_start in range(0, spin_count, spin_chunk):
+                    s = slice(s_start, s_start + spin_chunk)
+                    phase = spin_phase(data.T2dash[v], spin_pos[:, s],
+                                       omega[s], sample_time, sample_gradm)
+                    voxel_mag[:, v] += torch.einsum(
+                        'evs, vs -> ev', cis(phase), mxy[v, s])
+
+            # sum over voxels: events x coils
+            rep_sig = (
+                voxel_mag * voxel_factor(data, sample_time, sample_gradm)
+            ) @ coil_sensitivity
+            signal.append(
+                rep_sig * torch.exp(1j * rep.adc_phase[measured]).unsqueeze(1))
+
+        # Advance the state to the end of the repetition
+        mxy = mxy * cis(spin_phase(
+            data.T2dash, spin_pos, omega, time[-1:], gradm[-1:])[0])
+        mxy = mxy * voxel_factor(data, time[-1:], gradm[-1:])[0, :, None]
+        r1 = torch.exp(-time[-1] / data.T1).unsqueeze(1)
+        mz = mz * r1 + (1 - r1)
+
+    print(" - done")
+    if len(signal) == 0:
+        return torch.zeros(0, coil_sensitivity.shape[1],
+                           dtype=torch.cfloat, device=device)
+    return torch.cat(signal)
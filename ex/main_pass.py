@@ -0,0 +1,639 @@
+"""Variants of the MRzeroCore main pass (``mr0.execute_graph``).
+
+MRzeroCore is installed as a wheel (see data/), so its simulation code can't
+be changed from within this repository. The functions here re-implement the
+main pass on top of the public :class:`Graph`, :class:`Sequence` and
+:class:`SimData` types and add options the installed version does not
+provide. Called without any of the additional arguments, :func:`execute_graph`
+computes exactly the same signal as ``mr0.execute_graph``.
+"""
+
+from __future__ import annotations
+import time
+from typing import Callable, Iterator
+import torch
+import numpy as np
+import MRzeroCore as mr0
+
+from nufft import NufftPlan
+
+
+# Approximate number of bytes allocated per (event, voxel) element while the
+# signal of a single + distribution is calculated: phase argument and complex
+# rotation, T2, T2', diffusion and the intermediate products of transverse_mag
+BYTES_PER_ELEMENT = 64
+# SimData clamps D to at least this value, so phantoms built with D == 0
+# (``obj_p.D *= 0``) have D == D_FLOOR everywhere
+D_FLOOR = 1e-6
+
+
+def voxel_chunk_size(event_count: int, voxel_count: int,
+                     max_memory: float) -> int:
+    """Return how many voxels fit into one tile of ``max_memory`` bytes."""
+    chunk = int(max_memory // (BYTES_PER_ELEMENT * max(event_count, 1)))
+    return max(1, min(chunk, voxel_count))
+
+
+def has_diffusion(data: mr0.SimData) -> bool:
+    """If any voxel of ``data`` has a diffusion coefficient above the floor.
+
+    At ``D == D_FLOOR`` the diffusion factor ``exp(-1e-9 * D * b)`` differs
+    from one by less than float32 precision for any realistic b-factor.
+    """
+    return bool((data.D > D_FLOOR).any())
+
+
+def has_B0(data: mr0.SimData) -> bool:
+    """If any voxel of ``data`` has an off-resonance."""
+    return bool((data.B0 != 0).any())
+
+
+def grid_axes(data: mr0.SimData) -> list[tuple[torch.Tensor, torch.Tensor]] | None:
+    """Return the per-axis grid of ``data.voxel_pos`` or None.
+
+    For every axis, this returns the sorted unique voxel positions and the
+    index of every voxel into them. Voxels of a :class:`VoxelGridPhantom` lie
+    on such a grid, even if the PD mask removed some of them. None is returned
+    if positions are not evenly spaced or there are not less grid positions
+    than voxels, as the separable phase wouldn't be cheaper then.
+    """
+    axes = []
+    for dim in range(3):
+        pos, index = torch.unique(data.voxel_pos[:, dim], return_inverse=True)
+        if pos.numel() > 2:
+            step = pos.diff()
+            if (step - step.mean()).abs().max() > 1e-3 * step.mean().abs():
+                return None
+        axes.append((pos, index))
+
+    if sum(pos.numel() for pos, _ in axes) >= data.PD.numel():
+        return None
+    return axes
+
+
+def time_segments(time: torch.Tensor, tau: torch.Tensor, rate: float,
+                  tol: float) -> tuple[torch.Tensor, torch.Tensor]:
+    """Choose events at which voxel dependent factors are evaluated exactly.
+
+    Relaxation, diffusion and off-resonance of a voxel change with the event
+    time at most with ``rate`` (1/s). Between two nodes, they are linearly
+    interpolated, which has a relative error of ``(rate * spacing)**2 / 8``.
+    Nodes are placed so that this stays below ``tol``. The kink of ``|tau|``
+    at an echo can't be interpolated, the events around it are always nodes.
+
+    Parameters
+    ----------
+    time : torch.Tensor
+        (events, ) non-decreasing event times
+    tau : torch.Tensor
+        (events, ) dephasing time of the distribution at every event
+    rate : float
+        Upper bound of the change rate of the voxel factors
+    tol : float
+        Tolerated relative interpolation error
+
+    Returns
+    -------
+    nodes : torch.Tensor
+        Indices of the node events
+    interp : torch.Tensor
+        (events, nodes) linear interpolation weights
+    """
+    # Callers pass a column of the (events, 1) time tensor, searchsorted
+    # warns about (and copies) non-contiguous inputs on every call
+    time = time.contiguous()
+    event_count = time.numel()
+    spacing = np.sqrt(8 * tol) / rate if rate > 0 else float('inf')
+    echoes = ((tau[:-1] < 0) & (tau[1:] >= 0)).nonzero()[:, 0].tolist()
+    forced = sorted(set(echoes) | set(e + 1 for e in echoes))
+
+    nodes = [0]
+    while nodes[-1] < event_count - 1:
+        last = nodes[-1]
+        node = int(torch.searchsorted(time, time[last] + spacing, right=True)) - 1
+        node = max(node, last + 1)
+        node = min([node] + [f for f in forced if f > last])
+        nodes.append(node)
+    nodes = torch.tensor(nodes, device=time.device)
+
+    interp = torch.zeros(event_count, len(nodes), device=time.device)
+    if len(nodes) == 1:
+        interp[:, 0] = 1
+        return nodes, interp
+
+    event = torch.arange(event_count, device=time.device)
+    segment = (torch.searchsorted(nodes, event, right=True) - 1).clamp(max=len(nodes) - 2)
+    t0 = time[nodes[segment]]
+    t1 = time[nodes[segment + 1]]
+    duration = t1 - t0
+    weight = torch.where(duration > 0, (t1 - time) / duration.clamp(min=1e-12), 1.0)
+    weight = torch.where(event == nodes[segment + 1], 0.0, weight)
+    interp[event, segment] = weight
+    interp[event, segment + 1] = 1 - weight
+    return nodes, interp
+
+
+def nufft_signal(plan: NufftPlan,
+                 data: mr0.SimData,
+                 mag: torch.Tensor,
+                 coil_sensitivity: torch.Tensor,
+                 traj: torch.Tensor,
+                 time: torch.Tensor,
+                 b: torch.Tensor,
+                 rate: float,
+                 tol: float
+                 ) -> torch.Tensor:
+    """Signal (events x coils) of a + distribution via the NUFFT.
+
+    ``traj``, ``time`` and ``b`` are the k-t trajectory (events x 4), time
+    since the pulse (events x 1) and cumulative diffusion b-factor (events)
+    of the simulated events. ``b`` is None if the phantom has no diffusion.
+    The dephasing function is not applied.
+    """
+    nodes, interp = time_segments(time[:, 0], traj[:, 3], rate, tol)
+    # shape: nodes x voxels
+    exponent = (
+        - time[nodes] / torch.abs(data.T2)
+        - torch.abs(traj[nodes, 3:]) / torch.abs(data.T2dash)
+    )
+    if b is not None:
+        exponent = exponent - 1e-9 * data.D * b[nodes, None]
+    node_factor = torch.polar(
+        torch.exp(exponent), 2 * np.pi * (traj[nodes, 3:] * data.B0))
+    # shape: (nodes * coils) x voxels
+    images = (
+        (mag * node_factor)[:, None, :] * coil_sensitivity.t()[None, :, :]
+    ).flatten(0, 1)
+
+    samples = plan(images, traj[:, :3]).view(
+        len(nodes), coil_sensitivity.shape[1], traj.shape[0]
+    )
+    return torch.einsum('en, nce -> ec', interp.to(samples.dtype), samples)
+
+
+def execute_graph(graph: mr0.Graph,
+                  seq: mr0.Sequence,
+                  data: mr0.SimData,
+                  min_signal: float = 1e-2,
+                  min_weight: float = 1e-2,
+                  voxel_chunk: int | None = None,
+                  max_memory: float | None = None,
+                  measured_only: bool = False,
+                  separable_phase: bool = False,
+                  nufft_tol: float | None = None,
+                  batch_size: int = 1,
+                  profiler: Callable[[dict], None] | None = None,
+                  ) -> torch.Tensor:
+    """Calculate the signal of the sequence by computing the graph.
+
+    Same as ``mr0.execute_graph``, but the ``events x voxels`` tensors needed
+    for the signal of every + distribution can be computed in tiles along the
+    voxel axis. Peak memory then depends on the tile size instead of the
+    phantom size. Tiling only changes the summation order of the final
+    ``voxels -> coils`` product, results match up to float rounding.
+
+    With ``measured_only``, the signal is only evaluated for the measured
+    events (``adc_usage > 0``) of every repetition instead of all events.
+    Spoilers, preparation delays and other unmeasured events then only
+    contribute to the end-of-repetition relaxation and diffusion.
+
+    With ``separable_phase``, phantoms whose voxels lie on a cartesian grid
+    (see :func:`grid_axes`) use ``exp(-2πi k·r) = exp(-2πi kx x) exp(-2πi ky
+    y) exp(-2πi kz z)``: the spatial encoding is computed once per event and
+    grid position and gathered for every voxel. The remaining voxel dependent
+    terms (relaxation, diffusion, off-resonance) are combined into a single
+    exponential. Other phantoms are simulated with the default kernel.
+
+    With ``nufft_tol``, the ``(events x voxels) @ (voxels x coils)`` product
+    of grid phantoms is replaced by a gridding NUFFT (see :mod:`nufft`).
+    Relaxation, diffusion and B0 depend on the event, so they are evaluated
+    exactly at a few node events per distribution (see :func:`time_segments`)
+    and linearly interpolated in between; one NUFFT is computed per node and
+    coil. Half of the tolerance is given to the NUFFT kernel and half to the
+    time interpolation. Cost scales with the oversampled grid size and the
+    number of nodes instead of ``events x voxels``.
+
+    Phantoms without diffusion (``D == 0``, clamped to :data:`D_FLOOR` by
+    ``SimData``) or off-resonance (``B0 == 0``) are detected automatically
+    (see :func:`has_diffusion` and :func:`has_B0`): the b-factor integral,
+    the diffusion tensors and the B0 phase are then not computed. These
+    terms are one (or zero) up to float32 precision in that case.
+
+    ``batch_size`` > 1 simulates multiple phantoms with one pass over the
+    graph, use :func:`batch_sim.execute_graph_batch` which prepares ``data``.
+
+    ``profiler`` is called with a record (dict) of statistics after every
+    repetition, see :class:`sim_profiler.SimProfiler`. Progress is not
+    printed if a profiler is given.
+
+    Parameters
+    ----------
+    graph : list[list[Distribution]]
+        Distribution graph that will be executed.
+    seq : Sequence
+        Sequence that will be simulated and was used to create ``graph``.
+    data : SimData
+        Physical properties of phantom and scanner.
+    min_signal : float
+        Minimum relative signal of a state for it to be measured.
+    min_weight : float
+        Minimum "weight" metric of a state for it to be simulated. Should be
+        less than min_signal.
+    voxel_chunk : int | None
+        Maximum number of voxels per tile. If None, all voxels are simulated
+        at once (unless ``max_memory`` is given).
+    max_memory : float | None
+        Memory budget in bytes for the ``events x voxels`` tensors of a tile.
+        The tile size is chosen per repetition from its event count. If both
+        ``voxel_chunk`` and ``max_memory`` are given, the smaller tile is used.
+    measured_only : bool
+        If true, rotation, relaxation and dephasing are only calculated for
+        the measured events. The default computes them for all events and
+        masks the signal at the end, like ``mr0.execute_graph`` does.
+    separable_phase : bool
+        If true and the voxels are on a grid, evaluate the spatial encoding
+        with per-axis phase factors. Results match up to float rounding.
+    nufft_tol : float | None
+        If set, use the NUFFT forward model with this relative error bound
+        (w.r.t. the largest sample). Requires voxels on a grid, errors don't
+        go below ~1e-6 because of single precision.
+    batch_size : int
+        Number of phantoms interleaved in ``data``: voxel ``v`` of phantom
+        ``b`` is stored at index ``v * batch_size + b``. The returned signal
+        then has ``batch_size * coils`` columns, ordered by phantom.
+    profiler : Callable[[dict], None] | None
+        Called after every repetition with a dict containing ``repetition``,
+        ``wall_time`` (s), ``event_count``, ``dist_count``, ``simulated``,
+        ``skipped_weight``, ``skipped_ancestors``, ``measured``,
+        ``skipped_signal`` and ``peak_tensor_bytes``. The latter is the size
+        of the largest ``events x voxels`` tensor (or oversampled NUFFT grid
+        set) of the repetition, on CUDA devices the peak allocated memory.
+
+    Returns
+    -------
+    signal : torch.Tensor
+        The simulated signal of the sequence.
+    """
+    return torch.cat([rep_sig for _, rep_sig in iter_execute_graph(
+        graph, seq, data, min_signal, min_weight, voxel_chunk, max_memory,
+        measured_only, separable_phase, nufft_tol, batch_size, profiler
+    )])
+
+
+def iter_execute_graph(graph: mr0.Graph,
+                       seq: mr0.Sequence,
+                       data: mr0.SimData,
+                       min_signal: float = 1e-2,
+                       min_weight: float = 1e-2,
+                       voxel_chunk: int | None = None,
+                       max_memory: float | None = None,
+                       measured_only: bool = False,
+                       separable_phase: bool = False,
+                       nufft_tol: float | None = None,
+                       batch_size: int = 1,
+                       profiler: Callable[[dict], None] | None = None,
+                       start_rep: int = 0,
+                       ) -> Iterator[tuple[int, torch.Tensor]]:
+    """Run the main pass, yielding the signal of every repetition.
+
+    Takes the same arguments as :func:`execute_graph`. Yields
+    ``(repetition_index, signal)`` as soon as a repetition is simulated,
+    ``signal`` only contains the measured samples (``adc_usage > 0``) of the
+    repetition. The generator keeps no reference to it, so consumers like a
+    live reconstruction can process and drop the signal of every repetition
+    instead of holding the signal of the whole sequence.
+
+    Example
+    -------
+    >>> kspace = torch.zeros(Nread * Nphase, 1, dtype=torch.cfloat)
+    >>> offset = 0
+    >>> for i, rep_sig in main_pass.iter_execute_graph(graph, seq, data):
+    ...     kspace[offset:offset + rep_sig.shape[0]] = rep_sig
+    ...     offset += rep_sig.shape[0]
+
+    If ``start_rep`` is not zero, simulation starts with repetition
+    ``start_rep``. The caller must have set ``mag`` and ``kt_vec`` of the
+    distributions in ``graph[start_rep]``, e.g. from a snapshot of a previous
+    run (see :mod:`incremental_sim`).
+    """
+    k_to_si = 2*np.pi / data.fov
+
+    # Proton density can be baked into coil sensitivity. shape: voxels x coils
+    coil_sensitivity = (
+        data.coil_sens.t().to(torch.cfloat)
+        * torch.abs(data.PD).unsqueeze(1)
+    )
+    coil_count = int(coil_sensitivity.shape[1])
+    voxel_count = data.PD.numel()
+    if voxel_count % batch_size != 0:
+        raise ValueError("Voxel count is not a multiple of batch_size")
+    # Skip terms that are constant for all voxels
+    use_diffusion = has_diffusion(data)
+    use_B0 = has_B0(data)
+    axes = None
+    plan = None
+    if separable_phase or nufft_tol is not None:
+        axes = grid_axes(data)
+    if nufft_tol is not None:
+        if batch_size > 1:
+            raise ValueError("nufft_tol does not support batched phantoms")
+        if axes is None:
+            raise ValueError("nufft_tol requires voxels on a cartesian grid")
+        plan = NufftPlan(axes, nufft_tol / 2)
+        # Upper bound of the voxel factor change rates without diffusion
+        # (which depends on the gradients, see time_segments)
+        max_rate = float(
+            (1 / data.T2).max() + (1 / data.T2dash).max()
+            + 2 * np.pi * data.B0.abs().max()
+        )
+        max_D = float(data.D.max())
+
+    if start_rep == 0:
+        # The first repetition contains only one element: A fully relaxed z0
+        graph[0][0].mag = torch.ones(
+            voxel_count, dtype=torch.cfloat, device=data.device
+        )
+        # Calculate kt_vec ourselves for autograd
+        graph[0][0].kt_vec = torch.zeros(4, device=data.device)
+
+    cuda_stats = profiler is not None and data.device.type == 'cuda'
+
+    for i in range(start_rep, len(seq)):
+        dists = graph[i + 1]
+        rep = seq[i]
+        if profiler is None:
+            print(f"\rCalculating repetition {i+1} / {len(seq)}", end='')
+        else:
+            rep_start = time.perf_counter()
+            if cuda_stats:
+                torch.cuda.reset_peak_memory_stats(data.device)
+        # Number of distributions by main pass decision, max tensor size
+        skipped_weight = skipped_ancestors = measured = 0
+        peak_bytes = 0
+
+        chunk = voxel_count if voxel_chunk is None else max(1, voxel_chunk)
+        if max_memory is not None:
+            chunk = min(chunk, voxel_chunk_size(
+                rep.event_count, voxel_count, max_memory))
+        # Tiles must contain the same voxels of all phantoms of a batch
+        chunk = max(1, chunk // batch_size) * batch_size
+
+        angle = torch.as_tensor(rep.pulse.angle)
+        phase = torch.as_tensor(rep.pulse.phase)
+
+        # 1Tx or pTx?
+        if angle.numel() == 1:
+            assert phase.numel() == 1
+            B1 = data.B1.sum(0)
+            angle = angle * B1.abs()
+            phase = phase + B1.angle()
+        else:
+            assert angle.numel() == phase.numel() == data.B1.shape[0]
+            B1 = (data.B1 * (angle * torch.exp(1j * phase))[:, None]).sum(0)
+            angle = B1.abs()
+            phase = B1.angle()
+
+        # Unaffected magnetisation
+        z_to_z = torch.cos(angle)
+        p_to_p = torch.cos(angle/2)**2
+        # Excited magnetisation
+        z_to_p = -0.70710678118j * torch.sin(angle) * torch.exp(1j*phase)
+        p_to_z = -z_to_p.conj()
+        m_to_z = -z_to_p
+        # Refocussed magnetisation
+        m_to_p = (1 - p_to_p) * torch.exp(2j*phase)
+
+        def calc_mag(ancestor: tuple) -> torch.Tensor:
+            if ancestor[0] == 'zz':
+                return ancestor[1].mag * z_to_z
+            elif ancestor[0] == '++':
+                return ancestor[1].mag * p_to_p
+            elif ancestor[0] == 'z+':
+                return ancestor[1].mag * z_to_p
+            elif ancestor[0] == '+z':
+                return ancestor[1].mag * p_to_z
+            elif ancestor[0] == '-z':
+                return ancestor[1].mag.conj() * m_to_z
+            elif ancestor[0] == '-+':
+                return ancestor[1].mag.conj() * m_to_p
+            else:
+                raise ValueError(f"Unknown transform {ancestor[0]}")
+
+        # Events for which the signal is calculated
+        if measured_only:
+            events = rep.adc_usage > 0
+            event_count = int(events.sum())
+        else:
+            events = slice(None)
+            event_count = rep.event_count
+
+        # shape: events x coils
+        rep_sig = torch.zeros(event_count, batch_size * coil_count,
+                              dtype=torch.cfloat, device=data.device)
+
+        # shape: events x 4
+        trajectory = torch.cumsum(torch.cat([
+            rep.gradm, rep.event_time[:, None]
+        ], 1), 0)
+        dt = rep.event_time
+
+        total_time = rep.event_time.sum()
+        r1 = torch.exp(-total_time / torch.abs(data.T1))
+        r2 = torch.exp(-total_time / torch.abs(data.T2))
+
+        # Use the same adc phase for all coils
+        adc_rot = torch.exp(1j * rep.adc_phase[events]).unsqueeze(1)
+
+        for dist in dists:
+            # Create a list only containing ancestors that were simulated
+            ancestors = list(filter(
+                lambda edge: edge[1].mag is not None, dist.ancestors
+            ))
+
+            if dist.dist_type != 'z0' and dist.weight < min_weight:
+                skipped_weight += 1
+                continue  # skip unimportant distributions
+            if dist.dist_type != 'z0' and len(ancestors) == 0:
+                skipped_ancestors += 1
+                continue  # skip dists for which no ancestors were simulated
+
+            dist.mag = sum([calc_mag(ancestor) for ancestor in ancestors])
+            # The pre_pass already calculates kt_vec, but that does not
+            # work with autograd -> we need to calculate it with torch
+            if dist.dist_type == 'z0':
+                dist.kt_vec = torch.zeros(4, device=data.device)
+            elif ancestors[0][0] in ['-+', '-z']:
+                dist.kt_vec = -1.0 * ancestors[0][1].kt_vec
+            else:
+                dist.kt_vec = ancestors[0][1].kt_vec.clone()
+
+            # shape: events x 4
+            dist_traj = dist.kt_vec + trajectory
+
+            # Diffusion
+            if use_diffusion:
+                k2 = dist_traj[:, :3] * k_to_si
+                k1 = torch.empty_like(k2)  # Calculate k-space at start of event
+                k1[0, :] = dist.kt_vec[:3] * k_to_si
+                k1[1:, :] = k2[:-1, :]
+                # Integrate over each event to get b factor (lin. interp. grad)
+                b = 1/3 * dt * (k1**2 + k1*k2 + k2**2).sum(1)
+                # shape: events. The per-voxel diffusion tensor is only built
+                # for the voxels of the current tile
+                b_cum = torch.cumsum(b, 0)
+
+            # NOTE: Without measured_only, we are calculating the signal for
+            # samples that are not measured (adc_usage == 0), see the note in
+            # mr0.execute_graph.
+
+            # NOTE: The bracketing / order of calculations is suprisingly
+            # important for the numerical precision. An error of 4% is achieved
+            # just by switching 2pi * (pos @ grad) to 2pi * pos @ grad
+
+            if (dist.dist_type == '+' and dist.rel_signal >= min_signal
+                    and event_count > 0):
+                measured += 1
+                # shape: (measured) events x 4
+                sample_traj = dist_traj[events]
+                sample_time = trajectory[events, 3:]
+                sample_b = b_cum[events] if use_diffusion else None
+                dephasing = data.dephasing_func(sample_traj[:, :3], data.nyquist)[:, None]
+
+                if plan is not None:
+                    rate = max_rate
+                    if use_diffusion:
+                        rate += 1e-9 * max_D * float(
+                            (b / dt.clamp(min=1e-12)).max())
+                    rep_sig += dephasing * nufft_signal(
+                        plan, data, 1.41421356237 * dist.mag,
+                        coil_sensitivity, sample_traj, sample_time, sample_b,
+                        rate, nufft_tol / 2
+                    )
+                    # complex64 oversampled grids of all coils
+                    peak_bytes = max(peak_bytes, 8 * coil_count * int(
+                        np.prod(plan.shape)))
+                else:
+                    if axes is not None:
+                        # shape: events x grid positions (per axis)
+                        axis_rot = [
+                            torch.exp(-2j * np.pi * (sample_traj[:, dim:dim+1] * pos))
+                            for dim, (pos, _) in enumerate(axes)
+                        ]
+
+                    for start in range(0, voxel_count, chunk):
+                        v = slice(start, start + chunk)
+
+                        # shape: events x tile voxels
+                        if axes is None:
+                            T2 = torch.exp(-sample_time / torch.abs(data.T2[v]))
+                            T2dash = torch.exp(-torch.abs(sample_traj[:, 3:]) / torch.abs(data.T2dash[v]))
+                            if use_B0:
+                                rot = torch.exp(2j * np.pi * (
+                                    (sample_traj[:, 3:] * data.B0[v])
+                                    - (sample_traj[:, :3] @ data.voxel_pos[v].T)
+                                ))
+                            else:  # 0 - x is exactly -x
+                                rot = torch.exp(2j * np.pi * (
+                                    -(sample_traj[:, :3] @ data.voxel_pos[v].T)
+                                ))
+
+                            if use_diffusion:
+                                diffusion = torch.exp(-1e-9 * data.D[v] * sample_b[:, None])
+                                transverse_mag = (
+                                    1.41421356237 * dist.mag[v].unsqueeze(0)  # Add event dimension
+                                    * rot * T2 * T2dash * diffusion * dephasing
+                                )
+                            else:  # multiplying with exp(0) = 1 is exact
+                                transverse_mag = (
+                                    1.41421356237 * dist.mag[v].unsqueeze(0)
+                                    * rot * T2 * T2dash * dephasing
+                                )
+                        else:
+                            # T2, T2', diffusion and B0 in one exponential
+                            exponent = (
+                                - sample_time / torch.abs(data.T2[v])
+                                - torch.abs(sample_traj[:, 3:]) / torch.abs(data.T2dash[v])
+                            )
+                            if use_diffusion:
+                                exponent = exponent - 1e-9 * data.D[v] * sample_b[:, None]
+                            if use_B0:
+                                rot = torch.polar(torch.exp(exponent), 2 * np.pi * (
+                                    sample_traj[:, 3:] * data.B0[v]))
+                            else:  # real, promoted by the first phase factor
+                                rot = torch.exp(exponent)
+                            for (pos, index), phase in zip(axes, axis_rot):
+                                if pos.numel() > 1:
+                                    rot = rot * phase[:, index[v]]
+                                else:  # e.g. single slice: same for all voxels
+                                    rot = rot * phase
+
+                            transverse_mag = (
+                                1.41421356237 * dist.mag[v].unsqueeze(0)
+                                * rot * dephasing
+                            )
+
+                        peak_bytes = max(peak_bytes, transverse_mag.numel()
+                                         * transverse_mag.element_size())
+
+                        # (events x voxels) @ (voxels x coils) = (events x coils)
+                        if batch_size == 1:
+                            rep_sig += transverse_mag @ coil_sensitivity[v, :]
+                        else:  # separately for every phantom of the batch
+                            rep_sig += torch.einsum(
+                                'evb, vbc -> ebc',
+                                transverse_mag.view(event_count, -1, batch_size),
+                                coil_sensitivity[v, :].view(-1, batch_size, coil_count)
+                            ).flatten(1)
+
+            if dist.dist_type == '+':
+                # Diffusion for whole trajectory + T2 relaxation
+                dist.mag = dist.mag * r2
+                if use_diffusion:
+                    dist.mag = dist.mag * torch.exp(-1e-9 * data.D * b_cum[-1])
+                dist.kt_vec = dist_traj[-1]
+            else:  # z or z0
+                dist.mag = dist.mag * r1
+                if use_diffusion:
+                    k = torch.linalg.vector_norm(dist.kt_vec[:3] * k_to_si)
+                    dist.mag = dist.mag * torch.exp(
+                        -1e-9 * data.D * total_time * k**2)
+            if dist.dist_type == 'z0':
+                dist.mag = dist.mag + 1 - r1
+
+        rep_sig *= adc_rot
+
+        # Remove ancestors to save memory as we don't need them anymore.
+        # When running with autograd this doesn't change memory consumption
+        # bc. the values are still stored in the computation graph.
+        for dist in dists:
+            for ancestor in dist.ancestors:
+                ancestor[1].mag = None
+
+        if profiler is not None:
+            skipped_signal = sum(
+                dist.dist_type == '+' and dist.mag is not None
+                for dist in dists
+            ) - measured
+            if cuda_stats:
+                peak_bytes = torch.cuda.max_memory_allocated(data.device)
+            profiler({
+                'repetition': i,
+                'wall_time': time.perf_counter() - rep_start,
+                'event_count': rep.event_count,
+                'dist_count': len(dists),
+                'simulated': len(dists) - skipped_weight - skipped_ancestors,
+                'skipped_weight': skipped_weight,
+                'skipped_ancestors': skipped_ancestors,
+                'measured': measured,
+                'skipped_signal': skipped_signal,
+                'peak_tensor_bytes': peak_bytes,
+            })
+
+        # Only return measured samples
+        if not measured_only:
+            rep_sig = rep_sig[rep.adc_usage > 0, :]
+        yield i, rep_sig
+        del rep_sig  # don't keep it alive while simulating the next rep
+
+    if profiler is None:
+        print(" - done")
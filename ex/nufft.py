@@ -0,0 +1,146 @@
+"""Gridding NUFFT for simulating phantoms defined on a voxel grid.
+
+The signal of a + distribution is a sum over voxels of ``exp(-2πi k·r)``
+weighted by voxel properties. If the voxels lie on a cartesian grid, this is a
+type 2 non-uniform Fourier transform of the (masked) voxel image, evaluated at
+the k-space positions of the events. It is computed by FFT on a 2x
+oversampled grid and interpolation with a Kaiser-Bessel kernel.
+
+Error budget: the relative error of the kernel interpolation is about
+``10**-(width - 1)``; :func:`kernel_width` picks the width for a requested
+tolerance. With single precision tensors, errors don't go below ~1e-6.
+"""
+
+from __future__ import annotations
+import torch
+import numpy as np
+
+
+def kernel_width(tol: float) -> int:
+    """Kaiser-Bessel kernel width (in oversampled grid points) for ``tol``."""
+    return int(np.clip(np.ceil(-np.log10(tol)) + 1, 2, 8))
+
+
+def kaiser_bessel(x: torch.Tensor, width: int, beta: float) -> torch.Tensor:
+    """Kaiser-Bessel kernel, zero for ``|x| > width / 2``."""
+    z = 1 - (2 * x / width)**2
+    return torch.where(
+        z >= 0, torch.special.i0(beta * torch.sqrt(z.clamp(min=0))), 0.0
+    )
+
+
+def kaiser_bessel_ft(f: torch.Tensor, width: int, beta: float) -> torch.Tensor:
+    """Continuous Fourier transform of :func:`kaiser_bessel`."""
+    a = beta**2 - (np.pi * width * f)**2
+    s = torch.sqrt(a.abs())
+    return torch.where(
+        a > 0, width * torch.sinh(s) / s, width * torch.sinc(s / np.pi)
+    )
+
+
+class NufftPlan:
+    """Type 2 NUFFT from the voxels of a grid phantom to k-space positions.
+
+    Axes with a single grid position (e.g. the slice axis of a 2D phantom)
+    are not transformed, their encoding is a phase that only depends on k.
+
+    Attributes
+    ----------
+    width : int
+        Kernel width in oversampled grid points
+    beta : float
+        Kaiser-Bessel shape parameter
+    dims : list[int]
+        Phantom axes (0, 1, 2 for x, y, z) with more than one grid position
+    shape : list[int]
+        Oversampled grid size for every axis in ``dims``
+    step : torch.Tensor
+        Grid spacing for every axis in ``dims``
+    center : torch.Tensor
+        (3, ) position of the grid center (index ``N // 2``) or of the single
+        position of not transformed axes
+    grid_index : torch.Tensor
+        Flat index of every voxel into the oversampled grid
+    deapod : torch.Tensor
+        Per voxel factor compensating for the interpolation kernel
+    """
+
+    def __init__(self, axes: list[tuple[torch.Tensor, torch.Tensor]],
+                 tol: float, oversampling: float = 2.0) -> None:
+        """Create a plan for voxels on the grid returned by ``grid_axes``."""
+        self.width = kernel_width(tol)
+        self.beta = float(np.pi * np.sqrt(
+            self.width**2 / oversampling**2 * (oversampling - 0.5)**2 - 0.8
+        ))
+        self.dims = []
+        self.shape = []
+        step = []
+        center = []
+        grid_index = 0
+        deapod = 1.0
+
+        for dim, (pos, index) in enumerate(axes):
+            count = pos.numel()
+            center.append(pos[count // 2])
+            if count == 1:
+                continue
+
+            size = int(np.ceil(oversampling * count))
+            centered = index - count // 2
+            self.dims.append(dim)
+            self.shape.append(size)
+            step.append(pos[1] - pos[0])
+            grid_index = grid_index * size + centered % size
+            deapod = deapod / kaiser_bessel_ft(
+                centered.to(torch.float64) / size, self.width, self.beta
+            )
+
+        self.step = torch.stack(step) if step else torch.zeros(0)
+        self.center = torch.stack(center)
+        self.grid_index = torch.as_tensor(grid_index)
+        self.deapod = torch.as_tensor(deapod, dtype=torch.float32)
+
+    def __call__(self, images: torch.Tensor, k: torch.Tensor) -> torch.Tensor:
+        """Evaluate the Fourier transforms of ``images`` at ``k``.
+
+        Parameters
+        ----------
+        images : torch.Tensor
+            (batch, voxels) complex voxel values
+        k : torch.Tensor
+            (events, 3) k-space positions (same units as ``mr0.Sequence``)
+
+        Returns
+        -------
+        torch.Tensor
+            (batch, events) tensor of ``sum(images * exp(-2πi k·r))``
+        """
+        batch = images.shape[0]
+        # Phase of the grid center (and of all not transformed axes)
+        shift = torch.exp(-2j * np.pi * (k @ self.center))
+
+        if len(self.dims) == 0:
+            return images.sum(1, keepdim=True) * shift
+
+        grid = torch.zeros(batch, int(np.prod(self.shape)),
+                           dtype=images.dtype, device=images.device)
+        grid[:, self.grid_index] = images * self.deapod
+        grid = torch.fft.fftn(
+            grid.view(batch, *self.shape),
+            dim=list(range(1, len(self.shape) + 1))
+        ).view(batch, -1)
+
+        # Flat grid indices and kernel weights of the width**dims neighbours
+        # of every event, shape: events x neighbours
+        offsets = torch.arange(self.width, device=k.device)
+        index = torch.zeros(k.shape[0], 1, dtype=torch.long, device=k.device)
+        weight = torch.ones(k.shape[0], 1, device=k.device)
+        for dim, size, step in zip(self.dims, self.shape, self.step):
+            x = k[:, dim] * step * size
+            m = torch.floor(x - self.width / 2).long()[:, None] + 1 + offsets
+            w = kaiser_bessel(x[:, None] - m, self.width, self.beta)
+            index = (index[:, :, None] * size + (m % size)[:, None, :]).flatten(1)
+            weight = (weight[:, :, None] * w[:, None, :]).flatten(1)
+
+        samples = (grid[:, index] * weight).sum(2)
+        return samples * shift
@@ -0,0 +1,272 @@
+"""Packed (struct of arrays) representation of ``mr0.Sequence``.
+
+``mr0.Sequence`` is a list of repetitions with small tensors each, so its
+k-space and contrast helpers loop over repetitions in python.
+:class:`PackedSequence` stores the events of all repetitions in concatenated
+tensors plus offsets, and the pulses as per-repetition arrays. Conversion in
+both directions is lossless.
+
+:meth:`PackedSequence.get_full_kspace` computes the trajectory, including the
+resets of EXCIT, REFOC and STORE pulses, with cumulative sums over all events
+at once:
+
+- a REFOC pulse negates the k-t position, so between two excitations the
+  position is the sum of all event moments, each multiplied by the parity
+  of the refocusing pulses since then (a cumulative product of signs)
+- an EXCIT pulse resets to the position stored by the last STORE pulse,
+  which itself is an affine function of the position at an earlier
+  excitation. These chains are resolved by pointer doubling.
+
+.. code-block:: python
+
+    packed = packed_sequence.PackedSequence.from_sequence(seq0)
+    kspace = packed.get_kspace()  # same as seq0.get_kspace()
+"""
+
+from __future__ import annotations
+import torch
+import MRzeroCore as mr0
+
+
+# Index of the usage in the ``pulse_usage`` tensor
+PULSE_USAGES = list(mr0.PulseUsage)
+
+
+class PackedSequence:
+    """Sequence with the events of all repetitions in concatenated tensors.
+
+    The events of repetition ``r`` are ``rep_offset[r]:rep_offset[r + 1]``,
+    its pulse angles and phases are ``pulse_offset[r]:pulse_offset[r + 1]``
+    (one element, or one per channel for pTx pulses).
+
+    Attributes
+    ----------
+    event_time : torch.Tensor
+        (events, ) duration of every event (seconds)
+    gradm : torch.Tensor
+        (events, 3) gradient moment of every event
+    adc_phase : torch.Tensor
+        (events, ) adc rotation
+    adc_usage : torch.Tensor
+        (events, ) contrast of every event, ``<= 0`` is not measured
+    rep_offset : torch.Tensor
+        (repetitions + 1, ) start of every repetition in the event tensors
+    pulse_usage : torch.Tensor
+        (repetitions, ) index into :data:`PULSE_USAGES`
+    pulse_angle : torch.Tensor
+        (pulse elements, ) flip angles in radians
+    pulse_phase : torch.Tensor
+        (pulse elements, ) pulse phases in radians
+    pulse_offset : torch.Tensor
+        (repetitions + 1, ) start of every pulse in the angle and phase tensors
+    pulse_scalar : torch.Tensor
+        (repetitions, ) if the pulse angle and phase are 0-dim tensors
+    pulse_selective : torch.Tensor
+        (repetitions, ) ``Pulse.selective``
+    """
+
+    __slots__ = ('event_time', 'gradm', 'adc_phase', 'adc_usage',
+                 'rep_offset', 'pulse_usage', 'pulse_angle', 'pulse_phase',
+                 'pulse_offset', 'pulse_scalar', 'pulse_selective')
+
+    def __init__(self, **tensors: torch.Tensor) -> None:
+        """Create from tensors named like the attributes, see
+        :meth:`from_sequence` to pack a ``mr0.Sequence``."""
+        missing = set(self.__slots__) - set(tensors)
+        if missing:
+            raise ValueError(f"Missing tensors: {sorted(missing)}")
+        for name in self.__slots__:
+            setattr(self, name, tensors.pop(name))
+        if tensors:
+            raise ValueError(f"Unknown tensors: {sorted(tensors)}")
+
+        event_count = self.event_time.shape[0]
+        if self.rep_offset[-1] != event_count or self.gradm.shape != (event_count, 3):
+            raise ValueError("Event tensors don't match rep_offset")
+        if self.pulse_offset[-1] != self.pulse_angle.shape[0]:
+            raise ValueError("Pulse tensors don't match pulse_offset")
+
+    @classmethod
+    def from_sequence(cls, seq: mr0.Sequence) -> PackedSequence:
+        """Pack a list based sequence, copies all tensors."""
+        if len(seq) == 0:
+            raise ValueError("Can't pack a sequence without repetitions")
+        angles, phases = [], []
+        for rep in seq:
+            angle = torch.as_tensor(rep.pulse.angle, dtype=torch.float)
+            phase = torch.as_tensor(rep.pulse.phase, dtype=torch.float)
+            if angle.shape != phase.shape or angle.dim() > 1:
+                raise ValueError(
+                    "Pulse angle and phase must be scalars or vectors of the "
+                    f"same length, got {tuple(angle.shape)} and {tuple(phase.shape)}"
+                )
+            angles.append(angle.reshape(-1))
+            phases.append(phase.reshape(-1))
+
+        def offsets(counts):
+            return torch.cumsum(torch.tensor([0] + counts), 0)
+
+        device = seq[0].device
+        return cls(
+            event_time=torch.cat([rep.event_time for rep in seq]),
+            gradm=torch.cat([rep.gradm for rep in seq]),
+            adc_phase=torch.cat([rep.adc_phase for rep in seq]),
+            adc_usage=torch.cat([rep.adc_usage for rep in seq]),
+            rep_offset=offsets([rep.event_count for rep in seq]).to(device),
+            pulse_usage=torch.tensor(
+                [PULSE_USAGES.index(rep.pulse.usage) for rep in seq],
+                device=device),
+            pulse_angle=torch.cat(angles).to(device),
+            pulse_phase=torch.cat(phases).to(device),
+            pulse_offset=offsets([a.numel() for a in angles]).to(device),
+            pulse_scalar=torch.tensor(
+                [torch.as_tensor(rep.pulse.angle).dim() == 0 for rep in seq],
+                device=device),
+            pulse_selective=torch.tensor(
+                [bool(rep.pulse.selective) for rep in seq], device=device),
+        )
+
+    def to_sequence(self) -> mr0.Sequence:
+        """Unpack into a ``mr0.Sequence``.
+
+        The tensors of the repetitions are views into the packed tensors, use
+        ``.clone()`` on the result if both are modified independently.
+        """
+        rep_offset = self.rep_offset.tolist()
+        pulse_offset = self.pulse_offset.tolist()
+        usage = self.pulse_usage.tolist()
+        scalar = self.pulse_scalar.tolist()
+        selective = self.pulse_selective.tolist()
+
+        seq = mr0.Sequence()
+        for r in range(len(self)):
+            e = slice(rep_offset[r], rep_offset[r + 1])
+            p = slice(pulse_offset[r], pulse_offset[r + 1])
+            angle, phase = self.pulse_angle[p], self.pulse_phase[p]
+            if scalar[r]:
+                angle, phase = angle[0], phase[0]
+            seq.append(mr0.Repetition(
+                mr0.Pulse(PULSE_USAGES[usage[r]], angle, phase, selective[r]),
+                self.event_time[e], self.gradm[e],
+                self.adc_phase[e], self.adc_usage[e]
+            ))
+        return seq
+
+    def to(self, device: torch.device | str) -> PackedSequence:
+        """Copy of self with all tensors on ``device``."""
+        return PackedSequence(**{
+            name: getattr(self, name).to(device) for name in self.__slots__})
+
+    def cuda(self) -> PackedSequence:
+        return self.to('cuda')
+
+    def cpu(self) -> PackedSequence:
+        return self.to('cpu')
+
+    @property
+    def device(self) -> torch.device:
+        return self.gradm.device
+
+    def __len__(self) -> int:
+        return self.rep_offset.numel() - 1
+
+    @property
+    def event_count(self) -> torch.Tensor:
+        """(repetitions, ) number of events per repetition."""
+        return self.rep_offset.diff()
+
+    def rep_index(self) -> torch.Tensor:
+        """(events, ) repetition of every event."""
+        return torch.repeat_interleave(
+            torch.arange(len(self), device=self.device), self.event_count)
+
+    def get_duration(self) -> float:
+        """Calculate the total duration of self in seconds."""
+        return self.event_time.sum(dtype=torch.double).item()
+
+    def get_full_kspace(self, split: bool = True
+                        ) -> list[torch.Tensor] | torch.Tensor:
+        """Compute the k-t trajectory like ``Sequence.get_full_kspace``.
+
+        Accumulates in double precision, so it can differ from the list
+        version by float rounding.
+
+        Parameters
+        ----------
+        split : bool
+            Return a list with one (``event_count``, 4) tensor per repetition
+            (like ``mr0.Sequence``), otherwise one (events, 4) tensor.
+        """
+        device = self.device
+        reps = len(self)
+        rep_index = torch.arange(reps, device=device)
+        start, end = self.rep_offset[:-1], self.rep_offset[1:]
+
+        # Cumulative event moments, per repetition sums are differences
+        moments = torch.cat([self.gradm, self.event_time[:, None]], 1).double()
+        cum = torch.cat([moments.new_zeros(1, 4), torch.cumsum(moments, 0)])
+        delta = cum[end] - cum[start]
+
+        usage = self.pulse_usage
+        excit = usage == PULSE_USAGES.index(mr0.PulseUsage.EXCIT)
+        refoc = usage == PULSE_USAGES.index(mr0.PulseUsage.REFOC)
+        store = usage == PULSE_USAGES.index(mr0.PulseUsage.STORE)
+
+        # sign[r]: parity of all refocusing pulses up to r. Between two
+        # excitations, end[r] = sign[r] * (base + sum_j sign[j] * delta[j])
+        sign = 1.0 - 2.0 * (torch.cumsum(refoc.long(), 0) % 2).double()
+        signed_cum = torch.cumsum(sign[:, None] * delta, 0)
+        # Index reps of the padded tensors is a zero row / 1.0 sign
+        signed_cum = torch.cat([signed_cum, signed_cum.new_zeros(1, 4)])
+        sign = torch.cat([sign, sign.new_ones(1)])
+        last_excit = torch.cummax(torch.where(excit, rep_index, -1), 0)[0]
+
+        def before_segment(e):
+            """Signed sum up to the excitation e (-1: sequence start)."""
+            return signed_cum[torch.where(e > 0, e - 1, reps)]
+
+        # Signed base of an excitation: sign[e] * k_end[s - 1] with s the
+        # last STORE before e: an affine function of the base of the
+        # excitation that preceeds s - 1. Roots (no STORE or no excitation
+        # before it) have a = 0.
+        last_store = torch.cummax(torch.where(store, rep_index, -1), 0)[0]
+        s = torch.cat([last_store.new_full((1, ), -1), last_store[:-1]])
+        before = torch.where(s > 0, s - 1, reps)
+        parent = torch.where(s > 0, last_excit[before.clamp(max=reps - 1)], -1)
+        a = torch.where(parent >= 0, sign[:reps] * sign[before], 0.0)
+        b = (sign[:reps] * sign[before])[:, None] * (
+            signed_cum[before] - before_segment(parent))
+        b = torch.where((s > 0)[:, None], b, 0.0)
+        parent = torch.where(parent >= 0, parent, rep_index)
+
+        # Pointer doubling: base[e] = a[e] * base[parent[e]] + b[e]
+        a, b = torch.where(excit, a, 0.0), torch.where(excit[:, None], b, 0.0)
+        while bool((a != 0).any()):
+            b = b + a[:, None] * b[parent]
+            a = a * a[parent]
+            parent = parent[parent]
+
+        e = last_excit
+        base = torch.where((e >= 0)[:, None], b[e.clamp(min=0)], 0.0)
+        k_end = sign[:reps, None] * (base + signed_cum[:reps] - before_segment(e))
+        k_start = k_end - delta
+
+        trajectory = (
+            k_start.repeat_interleave(self.event_count, 0)
+            + cum[1:] - cum[start].repeat_interleave(self.event_count, 0)
+        ).to(self.event_time.dtype)
+        if split:
+            return list(torch.split(trajectory, self.event_count.tolist()))
+        return trajectory
+
+    def get_kspace(self) -> torch.Tensor:
+        """(samples, 4) k-t position of measured events, like ``Sequence``."""
+        return self.get_full_kspace(split=False)[self.adc_usage > 0]
+
+    def get_contrast_mask(self, contrast: int) -> torch.Tensor:
+        """Mask of the measured events that belong to ``contrast``."""
+        return self.adc_usage[self.adc_usage != 0] == contrast
+
+    def get_contrasts(self) -> list[int]:
+        """Return a sorted list of all contrasts used by this sequence."""
+        return torch.unique(self.adc_usage).tolist()
@@ -0,0 +1,152 @@
+"""Run the main pass on voxel shards of a phantom in parallel processes.
+
+The simulated signal is linear in the voxels: every voxel only contributes
+``transverse_mag @ coil_sensitivity`` to it. A phantom can therefore be split
+into shards that are simulated independently with the same :class:`Graph`,
+the signal of the whole phantom is the sum of the shard signals.
+
+Workers are forked and receive graph, sequence and phantom through the pool
+initializer, which doesn't pickle them with ``fork`` (the prepass
+distributions can't be pickled). On systems
+without ``fork`` (Windows), the shards are simulated one after another.
+"""
+
+from __future__ import annotations
+import os
+import io
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+import MRzeroCore as mr0
+
+import main_pass
+
+
+def select_voxels(data: mr0.SimData, index) -> mr0.SimData:
+    """Return a :class:`SimData` that only contains the selected voxels.
+
+    ``index`` can be anything that indexes the voxel dimension: a slice, a
+    bool mask or a tensor of indices. The recover function is not kept, as
+    the shard can't be converted back into the original phantom.
+    """
+    return mr0.SimData(
+        data.PD[index],
+        data.T1[index],
+        data.T2[index],
+        data.T2dash[index],
+        data.D[index],
+        data.B0[index],
+        data.B1[:, index],
+        data.coil_sens[:, index],
+        data.fov,
+        data.voxel_pos[index, :],
+        data.nyquist,
+        data.dephasing_func,
+    )
+
+
+def split_voxels(data: mr0.SimData, shard_count: int) -> list[slice]:
+    """Split the voxels of ``data`` into at most ``shard_count`` slices."""
+    voxel_count = data.PD.numel()
+    shard_count = max(1, min(shard_count, voxel_count))
+    size, rest = divmod(voxel_count, shard_count)
+
+    shards = []
+    start = 0
+    for i in range(shard_count):
+        stop = start + size + (1 if i < rest else 0)
+        shards.append(slice(start, stop))
+        start = stop
+    return shards
+
+
+def _simulate_shard(job: tuple, index: int) -> torch.Tensor:
+    graph, seq, data, shards, threads, kwargs = job
+    torch.set_num_threads(threads)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return main_pass.execute_graph(
+            graph, seq, select_voxels(data, shards[index]), **kwargs
+        )
+
+
+# Arguments of execute_graph_parallel in a worker process, set by the pool
+# initializer. Forked workers receive them without pickling.
+_worker_job = None
+
+
+def _init_worker(job: tuple) -> None:
+    global _worker_job
+    _worker_job = job
+
+
+def _run_shard(index: int) -> torch.Tensor:
+    return _simulate_shard(_worker_job, index)
+
+
+def execute_graph_parallel(graph: mr0.Graph,
+                           seq: mr0.Sequence,
+                           data: mr0.SimData,
+                           min_signal: float = 1e-2,
+                           min_weight: float = 1e-2,
+                           workers: int | None = None,
+                           shard_count: int | None = None,
+                           verbose: bool = True,
+                           **kwargs
+                           ) -> torch.Tensor:
+    """Calculate the signal like :func:`main_pass.execute_graph` in parallel.
+
+    Parameters
+    ----------
+    graph, seq, data, min_signal, min_weight
+        Same as for :func:`main_pass.execute_graph`.
+    workers : int | None
+        Number of worker processes, defaults to the number of CPU cores.
+    shard_count : int | None
+        Number of voxel shards, defaults to ``workers``. More shards than
+        workers give a better load balance if voxels are unevenly expensive.
+    verbose : bool
+        Print how the shards are simulated. The progress output of the
+        shards themselves is always suppressed.
+    **kwargs
+        Passed on to :func:`main_pass.execute_graph` (e.g. ``max_memory``).
+
+    Returns
+    -------
+    signal : torch.Tensor
+        The simulated signal of the sequence, sum of all shard signals.
+    """
+    if kwargs.get("profiler") is not None:
+        # Records would be collected in the worker processes
+        raise ValueError("profiler is not supported by parallel simulation")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if shard_count is None:
+        shard_count = workers
+    shards = split_voxels(data, shard_count)
+    workers = max(1, min(workers, len(shards)))
+    threads = max(1, torch.get_num_threads() // workers)
+    kwargs.update(min_signal=min_signal, min_weight=min_weight)
+
+    if workers == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        if verbose:
+            print("Simulating voxel shards sequentially")
+        # Keep the thread count of this process
+        job = (graph, seq, data, shards, torch.get_num_threads(), kwargs)
+        results = [_simulate_shard(job, i) for i in range(len(shards))]
+    else:
+        if verbose:
+            print(f"Simulating {len(shards)} voxel shards "
+                  f"with {workers} processes")
+        job = (graph, seq, data, shards, threads, kwargs)
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(workers, mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(job, )) as pool:
+            results = list(pool.map(_run_shard, range(len(shards))))
+
+    # Sum in fixed shard order so that the result is deterministic
+    signal = results[0]
+    for shard_signal in results[1:]:
+        signal = signal + shard_signal
+    return signal
@@ -0,0 +1,394 @@
+"""Helpers around the MRzeroCore pre-pass (``mr0.compute_graph``).
+
+The pre-pass is deterministic: the graph only depends on the sequence, a few
+averaged phantom properties and the state budget. :class:`GraphCache` stores
+computed graphs on disk, keyed by a hash of exactly these inputs, so that
+re-running a script with an unchanged sequence skips the pre-pass.
+
+Loaded graphs consist of :class:`Distribution` objects instead of the
+distributions created by the Rust pre-pass, they have the same attributes
+and can be passed to ``mr0.execute_graph`` and :func:`main_pass.execute_graph`.
+"""
+
+from __future__ import annotations
+import os
+import sys
+import hashlib
+import contextlib
+import numpy as np
+import torch
+import MRzeroCore as mr0
+
+from cache_dir import CacheDir
+
+
+# Increment if the stored arrays change, old cache entries are ignored then
+GRAPH_FORMAT_VERSION = 1
+
+DIST_TYPES = ['z0', 'z', '+']
+TRANSFORMS = ['zz', '++', 'z+', '+z', '-z', '-+']
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'out', 'cache', 'graph')
+
+
+class Distribution:
+    """Python counterpart of the distributions created by the pre-pass.
+
+    Attributes
+    ----------
+    dist_type : str
+        One of ``'z0'``, ``'z'`` and ``'+'``
+    ancestors : list[tuple[str, Distribution, complex]]
+        Transform, distribution of the previous repetition and prepass
+        transition factor for all ancestors
+    weight : float
+        Pre-pass estimate how important this distribution is
+    signal : float
+        Pre-pass estimate of the signal of this distribution
+    rel_signal : float
+        Signal relative to the strongest distribution of the repetition
+    prepass_mag : complex
+        Magnetisation calculated by the pre-pass
+    prepass_kt_vec : list[float]
+        k-t position calculated by the pre-pass
+    mag : torch.Tensor | None
+        Per voxel magnetisation, set by the main pass
+    kt_vec : torch.Tensor | None
+        k-t position, set by the main pass
+    """
+
+    __slots__ = ('dist_type', 'ancestors', 'weight', 'signal', 'rel_signal',
+                 'prepass_mag', 'prepass_kt_vec', 'mag', 'kt_vec')
+
+    def __init__(self, dist_type: str, weight: float, signal: float,
+                 rel_signal: float, prepass_mag: complex,
+                 prepass_kt_vec: list[float]) -> None:
+        self.dist_type = dist_type
+        self.ancestors = []
+        self.weight = weight
+        self.signal = signal
+        self.rel_signal = rel_signal
+        self.prepass_mag = prepass_mag
+        self.prepass_kt_vec = prepass_kt_vec
+        self.mag = None
+        self.kt_vec = None
+
+    def __repr__(self) -> str:
+        return (f"Dist(type: {self.dist_type}, signal: {self.signal}, "
+                f"kt: {self.prepass_kt_vec}, #ancestors: {len(self.ancestors)})")
+
+
+def graph_to_arrays(graph: mr0.Graph) -> dict[str, np.ndarray]:
+    """Convert the pre-pass data of a graph into flat numpy arrays.
+
+    Distributions of all repetitions are concatenated, ``rep_offset`` and
+    ``ancestor_offset`` contain the start index of every repetition and of
+    the ancestors of every distribution. Ancestors reference distributions by
+    their index into the concatenated arrays.
+    """
+    index = {}
+    for dists in graph:
+        for dist in dists:
+            index[id(dist)] = len(index)
+    dists = [dist for rep in graph for dist in rep]
+
+    ancestors = [ancestor for dist in dists for ancestor in dist.ancestors]
+    return {
+        'rep_offset': np.cumsum([0] + [len(rep) for rep in graph]),
+        'dist_type': np.array(
+            [DIST_TYPES.index(d.dist_type) for d in dists], dtype=np.int8),
+        'weight': np.array([d.weight for d in dists], dtype=np.float32),
+        'signal': np.array([d.signal for d in dists], dtype=np.float32),
+        'rel_signal': np.array(
+            [d.rel_signal for d in dists], dtype=np.float32),
+        'prepass_mag': np.array(
+            [d.prepass_mag for d in dists], dtype=np.complex64),
+        'prepass_kt_vec': np.array(
+            [d.prepass_kt_vec for d in dists], dtype=np.float32
+        ).reshape(-1, 4),
+        'ancestor_offset': np.cumsum([0] + [len(d.ancestors) for d in dists]),
+        'ancestor_type': np.array(
+            [TRANSFORMS.index(a[0]) for a in ancestors], dtype=np.int8),
+        'ancestor_index': np.array(
+            [index[id(a[1])] for a in ancestors], dtype=np.int64),
+        'ancestor_factor': np.array(
+            [a[2] for a in ancestors], dtype=np.complex64),
+    }
+
+
+def graph_from_arrays(arrays: dict[str, np.ndarray]) -> mr0.Graph:
+    """Rebuild a graph from the output of :func:`graph_to_arrays`."""
+    dists = [
+        Distribution(
+            DIST_TYPES[dist_type], float(weight), float(signal),
+            float(rel_signal), complex(mag), kt_vec.tolist()
+        ) for dist_type, weight, signal, rel_signal, mag, kt_vec in zip(
+            arrays['dist_type'], arrays['weight'], arrays['signal'],
+            arrays['rel_signal'], arrays['prepass_mag'],
+            arrays['prepass_kt_vec']
+        )
+    ]
+
+    offset = arrays['ancestor_offset']
+    ancestor_type = arrays['ancestor_type']
+    ancestor_index = arrays['ancestor_index']
+    ancestor_factor = arrays['ancestor_factor']
+    for i, dist in enumerate(dists):
+        dist.ancestors = [
+            (TRANSFORMS[ancestor_type[a]], dists[ancestor_index[a]],
+             complex(ancestor_factor[a]))
+            for a in range(offset[i], offset[i + 1])
+        ]
+
+    rep_offset = arrays['rep_offset']
+    return mr0.Graph([
+        dists[rep_offset[r]:rep_offset[r + 1]]
+        for r in range(len(rep_offset) - 1)
+    ])
+
+
+def _hash_update(h, value) -> None:
+    if isinstance(value, torch.Tensor):
+        value = value.detach().cpu()
+        h.update(str((value.dtype, tuple(value.shape))).encode())
+        h.update(value.numpy().tobytes())
+    else:
+        h.update(repr(value).encode())
+
+
+def repetition_hash(rep: mr0.Repetition) -> str:
+    """Hash of everything that defines a repetition of a sequence."""
+    h = hashlib.sha256()
+    _hash_update(h, rep.pulse.usage.value)
+    _hash_update(h, rep.pulse.selective)
+    _hash_update(h, torch.as_tensor(rep.pulse.angle, dtype=torch.float32))
+    _hash_update(h, torch.as_tensor(rep.pulse.phase, dtype=torch.float32))
+    _hash_update(h, rep.event_time)
+    _hash_update(h, rep.gradm)
+    _hash_update(h, rep.adc_phase)
+    _hash_update(h, rep.adc_usage)
+    return h.hexdigest()
+
+
+def graph_key(seq: mr0.Sequence, data: mr0.SimData,
+              max_state_count: int, min_state_mag: float) -> str:
+    """Hash all inputs that ``mr0.compute_graph`` passes to the pre-pass."""
+    h = hashlib.sha256()
+    _hash_update(h, GRAPH_FORMAT_VERSION)
+    _hash_update(h, [repetition_hash(rep) for rep in seq])
+
+    # Same values as calculated by mr0.compute_graph
+    _hash_update(h, float(torch.mean(data.T1)))
+    _hash_update(h, float(torch.mean(data.T2)))
+    _hash_update(h, float(torch.mean(data.T2dash)))
+    _hash_update(h, float(torch.mean(data.D)))
+    _hash_update(h, data.nyquist.tolist())
+    _hash_update(h, data.fov.tolist())
+    _hash_update(h, data.avg_B1_trig)
+    _hash_update(h, int(max_state_count))
+    _hash_update(h, float(min_state_mag))
+    return h.hexdigest()
+
+
+class GraphCache(CacheDir):
+    """Content-addressed on-disk cache for pre-pass graphs.
+
+    Every graph is stored as compressed ``<key>.npz`` file in ``path``. Loading
+    a graph marks it as recently used, if the cache grows above ``max_size``
+    bytes, least recently used graphs are deleted (see :class:`CacheDir`).
+
+    Attributes
+    ----------
+    path : str
+        Directory containing the cached graphs
+    max_size : int
+        Maximum total size of all cached graphs in bytes
+    hits : int
+        Number of graphs loaded from the cache
+    misses : int
+        Number of graphs computed with the pre-pass
+    """
+
+    def __init__(self, path: str = CACHE_DIR, max_size: int = 256 * 2**20):
+        super().__init__(path, max_size, '.npz')
+        self.hits = 0
+        self.misses = 0
+
+    def compute_graph(self, seq: mr0.Sequence, data: mr0.SimData,
+                      max_state_count: int = 200,
+                      min_state_mag: float = 1e-4) -> mr0.Graph:
+        """Load the graph from the cache or compute and store it.
+
+        Same arguments and result as ``mr0.compute_graph``.
+        """
+        key = graph_key(seq, data, max_state_count, min_state_mag)
+        file_name = self.file_name(key + '.npz')
+
+        if os.path.isfile(file_name):
+            try:
+                with np.load(file_name) as arrays:
+                    graph = graph_from_arrays(arrays)
+            except (OSError, ValueError, KeyError):
+                pass  # Corrupted entry, recompute and overwrite it
+            else:
+                self.touch(file_name)
+                self.hits += 1
+                return graph
+
+        self.misses += 1
+        graph = mr0.compute_graph(seq, data, max_state_count, min_state_mag)
+        arrays = graph_to_arrays(graph)
+        self.write(key + '.npz', lambda tmp: np.savez_compressed(tmp, **arrays))
+        return graph
+
+
+_default_cache = None
+
+
+def compute_graph(seq: mr0.Sequence, data: mr0.SimData,
+                  max_state_count: int = 200,
+                  min_state_mag: float = 1e-4) -> mr0.Graph:
+    """Drop-in for ``mr0.compute_graph`` using the default :class:`GraphCache`.
+
+    Scripts can replace ``mr0.compute_graph(seq0, obj_p, 200, 1e-3)`` with
+    ``pre_pass.compute_graph(seq0, obj_p, 200, 1e-3)``.
+    """
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = GraphCache()
+    return _default_cache.compute_graph(
+        seq, data, max_state_count, min_state_mag)
+
+
+# Candidate state counts of compute_graph_adaptive, ascending
+STATE_COUNT_LADDER = [10, 20, 50, 100, 200, 500, 1000, 2000]
+
+# Estimated signals of reference graphs of compute_graph_adaptive, by key
+_references: dict[str, np.ndarray] = {}
+
+
+@contextlib.contextmanager
+def _quiet():
+    """Suppress the timing output that the Rust pre-pass writes to stdout.
+
+    Rust writes to file descriptor 1 directly, so ``sys.stdout`` can't be
+    redirected. The descriptor is pointed to ``os.devnull`` instead.
+    """
+    sys.stdout.flush()
+    saved = os.dup(1)
+    try:
+        with open(os.devnull, 'w') as devnull:
+            os.dup2(devnull.fileno(), 1)
+            yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+
+
+def _estimated_signal(graph: mr0.Graph) -> np.ndarray:
+    """Pre-pass estimate of the signal of every repetition."""
+    return np.array([
+        sum(dist.signal for dist in dists if dist.dist_type == '+')
+        for dists in graph[1:]
+    ])
+
+
+def compute_graph_adaptive(seq: mr0.Sequence, data: mr0.SimData,
+                           target_error: float = 1e-3,
+                           max_state_limit: int = STATE_COUNT_LADDER[-1],
+                           reference_state_count: int | None = None,
+                           reference_mag: float | None = None,
+                           ) -> tuple[mr0.Graph, dict]:
+    """Compute the graph with the smallest state budget meeting an error.
+
+    The pre-pass estimates the signal of every distribution. A reference
+    graph is computed with ``reference_state_count`` states and
+    ``reference_mag`` as ``min_state_mag``. The error of a budget is the
+    largest deviation of its estimated per-repetition signal from the
+    reference, relative to the largest repetition signal. Budgets are tried
+    from the smallest state count of :data:`STATE_COUNT_LADDER` upwards with
+    ``min_state_mag = target_error * 1e-2``, the first one that meets
+    ``target_error`` is used. Only if ``max_state_limit`` states don't meet
+    it, ``min_state_mag`` is lowered to ``target_error * 1e-3``.
+
+    The estimated signal of the reference is kept for the lifetime of the
+    process, so repeated calls for the same sequence and phantom averages
+    (e.g. parameter sweeps) only run the pre-passes of the ladder. Their
+    timing output is suppressed.
+
+    The estimated error is a proxy, not the error of the simulated signal.
+    The per-repetition estimate is the sum of the non-negative signal
+    estimates of all ``+`` distributions: phases are ignored, so it can't
+    see distributions whose signals cancel each other, or the dephasing
+    and off-resonance of the actual phantom, which the pre-pass only knows
+    by its averages. On the FLASH and spin echo test sequences, the error of
+    ``main_pass.execute_graph`` against the reference graph stays below the
+    estimate, but this is no guarantee. Compare the executed signals of a
+    coarse phantom if the budget must hold.
+
+    The budget applies to all repetitions, the pre-pass has no per-repetition
+    limits. The estimate only covers the truncation of the pre-pass, the
+    error of the main pass thresholds (``min_weight``, ``min_signal``) comes
+    on top.
+
+    Parameters
+    ----------
+    seq, data
+        Sequence and phantom, as for ``mr0.compute_graph``
+    target_error : float
+        Maximum estimated error, relative to the largest repetition signal
+    max_state_limit : int
+        Largest state count that is tried
+    reference_state_count : int | None
+        State count of the reference graph, defaults to ``max_state_limit``
+    reference_mag : float | None
+        ``min_state_mag`` of the reference graph, defaults to
+        ``target_error * 1e-4``
+
+    Returns
+    -------
+    graph : Graph
+        Graph computed with the chosen budget
+    budget : dict
+        ``max_state_count``, ``min_state_mag``, ``estimated_error`` and
+        ``mean_states`` / ``max_states`` per repetition of ``graph``
+    """
+    if reference_state_count is None:
+        reference_state_count = max_state_limit
+    if reference_mag is None:
+        reference_mag = target_error * 1e-4
+    key = graph_key(seq, data, reference_state_count, reference_mag)
+    reference = _references.get(key)
+    if reference is None:
+        with _quiet():
+            reference = _estimated_signal(mr0.compute_graph(
+                seq, data, reference_state_count, reference_mag))
+        _references[key] = reference
+    scale = max(float(np.abs(reference).max()), 1e-12)
+
+    def estimate(max_state_count, min_state_mag):
+        with _quiet():
+            graph = mr0.compute_graph(seq, data, max_state_count, min_state_mag)
+        error = float(np.abs(
+            _estimated_signal(graph) - reference).max()) / scale
+        return graph, error
+
+    min_state_mag = target_error * 1e-2
+    counts = [c for c in STATE_COUNT_LADDER if c < max_state_limit]
+    for max_state_count in counts + [max_state_limit]:
+        graph, error = estimate(max_state_count, min_state_mag)
+        if error <= target_error:
+            break
+    else:
+        min_state_mag = target_error * 1e-3
+        graph, error = estimate(max_state_limit, min_state_mag)
+
+    state_counts = [len(dists) for dists in graph]
+    budget = {
+        'max_state_count': max_state_count,
+        'min_state_mag': float(min_state_mag),
+        'estimated_error': error,
+        'mean_states': float(np.mean(state_counts)),
+        'max_states': max(state_counts),
+    }
+    return graph, budget
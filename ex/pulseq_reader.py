@@ -0,0 +1,489 @@
+"""Fast reader for Pulseq files, returns ``mr0.PulseqFile`` objects.
+
+``mr0.PulseqFile`` parses the file line by line and decompresses shapes with
+a python loop, which takes seconds for sequences with long arbitrary
+gradients. :func:`read_pulseq` reads every section as one block of text,
+converts its numbers with a single numpy call and expands run-length encoded
+shapes with ``np.repeat``. The result is a ``mr0.PulseqFile`` with the same
+contents, it can be passed to ``mr0.Sequence.from_seq_file``.
+
+:func:`load_pulseq` additionally stores the parsed file as uncompressed
+``.npz`` sidecar next to it (``external.seq.npz``). The sidecar is keyed by
+the hash of the ``.seq`` file and :data:`PARSER_VERSION`; if it matches, its
+arrays are memory mapped instead of parsing the text again.
+
+.. code-block:: python
+
+    seq0 = mr0.Sequence.from_seq_file(pulseq_reader.read_pulseq(
+        "out/external.seq"))
+    # Same, but cached
+    seq0 = pulseq_reader.import_file("out/external.seq")
+"""
+
+from __future__ import annotations
+import os
+import re
+import struct
+import hashlib
+import itertools
+import zipfile
+import numpy as np
+import MRzeroCore as mr0
+from MRzeroCore.pulseq.pulseq_loader.pulseq_file import (
+    helpers, Definitions, Block, Rf, Gradient, Trap, Adc
+)
+
+
+# Increment if the parser or the layout of the sidecar files changes
+PARSER_VERSION = 1
+SIDECAR_SUFFIX = '.npz'
+
+_SECTION = re.compile(r'^[ \t]*\[([^\]\n]*)\][ \t]*$', re.MULTILINE)
+_COMMENT = re.compile(r'^[ \t]*#.*$', re.MULTILINE)
+_SHAPE_HEADER = re.compile(
+    r'^[ \t]*shape_id[ \t]+(\d+)[ \t]*\n[ \t]*num_\w+[ \t]+(\d+)',
+    re.MULTILINE | re.IGNORECASE
+)
+
+
+def file_to_sections(file_name: str) -> dict[str, str]:
+    """Split a Pulseq file into the text of its sections, without comments.
+
+    Sections that appear multiple times are concatenated.
+    """
+    with open(file_name) as file:
+        text = _COMMENT.sub('', file.read())
+
+    parts = _SECTION.split(text)
+    if parts[0].strip():
+        raise ValueError("Pulseq file has content before the first section")
+
+    sections = {}
+    for name, content in zip(parts[1::2], parts[2::2]):
+        sections[name] = sections.get(name, '') + '\n' + content
+    return sections
+
+
+def section_lines(text: str) -> list[str]:
+    """Non-empty, stripped lines of a section (``mr0.PulseqFile`` format)."""
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def parse_table(text: str, columns: int | tuple[int, ...],
+                integer: tuple[int, ...] | None = (0, )) -> np.ndarray:
+    """Parse a section of numbers into a (rows x columns) float64 array.
+
+    ``columns`` can be a tuple of allowed column counts. Every line must
+    have the same number of columns. The values of the ``integer`` columns
+    (IDs, delays in us, ...), all columns if ``None``, must be integers.
+    """
+    if isinstance(columns, int):
+        columns = (columns, )
+    tokens = [line.split() for line in section_lines(text)]
+    counts = {len(line) for line in tokens}
+    # Checked per line: a short line followed by a long one has the right
+    # total count, but shifts all following columns
+    if len(counts) > 1 or not counts <= set(columns):
+        raise ValueError(
+            f"Expected {columns} columns in every line, got {sorted(counts)}")
+    count = counts.pop() if counts else columns[0]
+    table = np.array(list(itertools.chain.from_iterable(tokens)),
+                     dtype=np.float64).reshape(len(tokens), count)
+
+    checked = table if integer is None else table[:, list(integer)]
+    if not np.all(checked == np.round(checked)):
+        raise ValueError(f"Expected integers in the columns {integer}")
+
+    ids = table[:, 0]
+    if np.any(ids <= 0) or len(np.unique(ids)) != len(ids):
+        raise ValueError("IDs must be positive and unique")
+    return table
+
+
+def decompress_shape(compressed: np.ndarray, count: int,
+                     version: int) -> np.ndarray:
+    """Expand a (run-length encoded derivative) shape to ``count`` samples.
+
+    A run is stored as ``value, value, repetitions``; every other sample is
+    a single derivative sample.
+    """
+    # Uncompressed shapes are introduced with 1.4.0 but also used
+    # for pTx pulses by Martin's pTx extension
+    if len(compressed) == count and (version == 140 or version == 139):
+        return compressed
+
+    # Candidate runs: two equal samples followed by a repetition count.
+    # Runs can't overlap, a candidate directly following one is a sample
+    # or count of the previous run.
+    n = len(compressed)
+    starts = np.flatnonzero(compressed[:n - 2] == compressed[1:n - 1]) if n > 2 \
+        else np.zeros(0, dtype=np.int64)
+    if np.any(np.diff(starts) < 3):
+        valid = []
+        next_free = 0
+        for start in starts.tolist():
+            if start >= next_free:
+                valid.append(start)
+                next_free = start + 3
+        starts = np.array(valid, dtype=np.int64)
+
+    repeats = np.ones(n, dtype=np.int64)
+    if len(starts) > 0:
+        run_count = compressed[starts + 2]
+        if np.any(run_count != np.floor(run_count)) or np.any(run_count < 0):
+            raise ValueError("Invalid run length in compressed shape")
+        repeats[starts] = run_count.astype(np.int64) + 2
+        repeats[starts + 1] = 0
+        repeats[starts + 2] = 0
+
+    derivative = np.repeat(compressed, repeats)
+    assert len(derivative) == count, (
+        f"Decompressed shape has len: {len(derivative)}, expected: {count}"
+    )
+    return derivative.cumsum()
+
+
+def parse_shapes(text: str, version: int) -> dict[int, np.ndarray]:
+    """Parse and decompress all shapes of the [SHAPES] section."""
+    assert 120 <= version <= 140
+    headers = list(_SHAPE_HEADER.finditer(text))
+    shapes = {}
+    for i, header in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        shape_id = int(header.group(1))
+        samples = np.array(text[header.end():end].split(), dtype=np.float64)
+        assert len(samples) >= 1  # at least one sample
+        assert shape_id > 0 and shape_id not in shapes
+        shapes[shape_id] = decompress_shape(
+            samples, int(header.group(2)), version)
+    return shapes
+
+
+def parse_rfs(text: str, version: int) -> dict[int, Rf]:
+    assert 120 <= version <= 140
+    columns = 7 + (version == 140) + 2 * (version == 139)
+    # IDs, delay and the shim IDs of 1.3.9
+    integer = (0, 2, 3, 4) + ((5, ) if version == 140 else ()) \
+        + ((7, 8) if version == 139 else ())
+    rfs = {}
+    for row in parse_table(text, columns, integer).tolist():
+        rf_id, amp, mag_id, phase_id = row[:4]
+        rest = row[4:]
+        time_id = int(rest.pop(0)) if version == 140 else 0
+        delay, freq, phase = rest[:3]
+        shim = rest[3:] if version == 139 else [0, 0]
+        rfs[int(rf_id)] = Rf(
+            amp, int(mag_id), int(phase_id), time_id, int(delay) * 1e-6,
+            freq, phase, int(shim[0]), int(shim[1])
+        )
+    return rfs
+
+
+def parse_gradients(text: str, version: int) -> dict[int, Gradient]:
+    assert 120 <= version <= 140
+    grads = {}
+    integer = (0, 2, 3, 4) if version == 140 else (0, 2, 3)
+    for row in parse_table(text, 5 if version == 140 else 4, integer).tolist():
+        time_id = int(row[3]) if version == 140 else 0  # default raster
+        grads[int(row[0])] = Gradient(
+            row[1], int(row[2]), time_id, int(row[-1]) * 1e-6)
+    return grads
+
+
+def parse_traps(text: str, version: int) -> dict[int, Trap]:
+    assert 120 <= version <= 140
+    return {
+        int(row[0]): Trap(row[1], int(row[2]) * 1e-6, int(row[3]) * 1e-6,
+                          int(row[4]) * 1e-6, int(row[5]) * 1e-6)
+        for row in parse_table(text, 6, (0, 2, 3, 4, 5)).tolist()
+    }
+
+
+def parse_adcs(text: str, version: int) -> dict[int, Adc]:
+    assert 120 <= version <= 140
+    return {
+        int(row[0]): Adc(int(row[1]), row[2] * 1e-9, int(row[3]) * 1e-6,
+                         row[4], row[5])
+        for row in parse_table(text, 6, (0, 1, 3)).tolist()
+    }
+
+
+def parse_delays(text: str, version: int) -> dict[int, float]:
+    assert 120 <= version <= 140
+    return {
+        int(row[0]): int(row[1]) * 1e-6
+        for row in parse_table(text, 2, None).tolist()
+    }
+
+
+def parse_blocks(text: str, version: int, delays: dict[int, float] | None,
+                 block_duration_raster: float | None) -> dict[int, Block]:
+    """Parse the [BLOCKS] section, see ``mr0.PulseqFile`` for the arguments."""
+    table = parse_table(text, 7 if version < 130 else 8, None).astype(np.int64)
+    if version == 140:
+        durations = (table[:, 1] * block_duration_raster).tolist()
+    else:
+        durations = [delays.get(d, 0.0) for d in table[:, 1].tolist()]
+    if table.shape[1] == 7:
+        table = np.concatenate([table, np.zeros_like(table[:, :1])], 1)
+
+    return {
+        row[0]: Block(duration, *row[2:])
+        for row, duration in zip(table.tolist(), durations)
+    }
+
+
+def block_duration(pulseq: mr0.PulseqFile, block: Block) -> float:
+    """Duration of a block, the longest of all its events."""
+    durs = [block.duration]  # delay event for 1.3.x
+    defs = pulseq.definitions
+
+    if block.adc_id != 0:
+        durs.append(pulseq.adcs[block.adc_id].get_duration())
+    if block.rf_id != 0:
+        durs.append(pulseq.rfs[block.rf_id].get_duration(
+            defs.rf_raster_time, pulseq.shapes))
+    for grad_id in [block.gx_id, block.gy_id, block.gz_id]:
+        grad = pulseq.grads.get(grad_id, None)
+        if isinstance(grad, Gradient):
+            durs.append(grad.get_duration(defs.grad_raster_time, pulseq.shapes))
+        if isinstance(grad, Trap):
+            durs.append(grad.get_duration())
+    return max(durs)
+
+
+def parse_libraries(pulseq: mr0.PulseqFile, sections: dict[str, str]
+                    ) -> tuple[dict[int, float] | None, float | None]:
+    """Parse everything but [BLOCKS] into ``pulseq``.
+
+    Parsed sections are removed from ``sections``. Returns the ``delays`` and
+    ``block_duration_raster`` arguments of :func:`parse_blocks`.
+    """
+    assert "VERSION" in sections
+    pulseq.version = version = helpers.parse_version(
+        section_lines(sections.pop("VERSION")))
+    assert 120 <= version <= 140 or version == 145
+
+    # mandatory sections
+    assert "BLOCKS" in sections
+    assert version < 140 or "DEFINITIONS" in sections
+    assert not ((version >= 140 and version != 145) and "DELAYS" in sections)
+
+    if "DEFINITIONS" in sections:
+        pulseq.definitions = Definitions.parse(
+            section_lines(sections.pop("DEFINITIONS")), version)
+    else:
+        pulseq.definitions = Definitions({}, version)
+
+    def maybe_parse(sec_name, parser):
+        if sec_name not in sections:
+            return {}
+        return parser(sections.pop(sec_name), version)
+
+    pulseq.rfs = maybe_parse("RF", parse_rfs)
+    pulseq.grads = helpers.merge_dicts(
+        maybe_parse("GRADIENTS", parse_gradients),
+        maybe_parse("TRAP", parse_traps),
+    )
+    pulseq.adcs = maybe_parse("ADC", parse_adcs)
+    pulseq.shapes = maybe_parse("SHAPES", parse_shapes)
+
+    if version >= 140 and version != 145:
+        return None, pulseq.definitions.block_raster_time
+    return maybe_parse("DELAYS", parse_delays), None
+
+
+def read_pulseq(file_name: str) -> mr0.PulseqFile:
+    """Read a Pulseq file, equivalent to ``mr0.PulseqFile(file_name)``."""
+    sections = file_to_sections(file_name)
+    pulseq = mr0.PulseqFile.__new__(mr0.PulseqFile)
+    delays, block_duration_raster = parse_libraries(pulseq, sections)
+    pulseq.blocks = parse_blocks(sections.pop("BLOCKS"), pulseq.version,
+                                 delays, block_duration_raster)
+
+    if len(sections) > 0:
+        print(f"Some sections were ignored: {list(sections.keys())}")
+
+    for block in pulseq.blocks.values():
+        block.duration = block_duration(pulseq, block)
+    return pulseq
+
+
+def file_hash(file_name: str) -> str:
+    """SHA-256 of the contents of a file."""
+    h = hashlib.sha256()
+    with open(file_name, 'rb') as file:
+        for chunk in iter(lambda: file.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def pulseq_to_arrays(pulseq: mr0.PulseqFile) -> dict[str, np.ndarray]:
+    """Convert a parsed file into arrays, see :func:`pulseq_from_arrays`.
+
+    Every event library becomes a float64 table with the ID in the first
+    column, shapes are concatenated into one array with offsets.
+    """
+    defs = pulseq.definitions
+    gradients = {i: g for i, g in pulseq.grads.items() if isinstance(g, Gradient)}
+    traps = {i: g for i, g in pulseq.grads.items() if isinstance(g, Trap)}
+    shape_ids = sorted(pulseq.shapes)
+    shape_lengths = [len(pulseq.shapes[i]) for i in shape_ids]
+
+    def table(events, columns, attrs):
+        rows = [[i] + [getattr(e, a) for a in attrs] for i, e in events.items()]
+        return np.array(rows, dtype=np.float64).reshape(-1, columns)
+
+    return {
+        'version': np.array(pulseq.version),
+        'raster_times': np.array([
+            defs.grad_raster_time, defs.rf_raster_time,
+            defs.adc_raster_time, defs.block_raster_time
+        ]),
+        'fov': np.array(defs.fov, dtype=np.float64),
+        'def_keys': np.array(list(defs.defs.keys()), dtype=str),
+        'def_values': np.array(list(defs.defs.values()), dtype=str),
+        'rfs': table(pulseq.rfs, 10, [
+            'amp', 'mag_id', 'phase_id', 'time_id', 'delay', 'freq', 'phase',
+            'shim_mag_id', 'shim_phase_id'
+        ]),
+        'gradients': table(gradients, 5, [
+            'amp', 'shape_id', 'time_id', 'delay']),
+        'traps': table(traps, 6, ['amp', 'rise', 'flat', 'fall', 'delay']),
+        'adcs': table(pulseq.adcs, 6, ['num', 'dwell', 'delay', 'freq', 'phase']),
+        'shape_ids': np.array(shape_ids, dtype=np.int64),
+        'shape_offset': np.cumsum([0] + shape_lengths, dtype=np.int64),
+        'shape_samples': np.concatenate(
+            [np.asarray(pulseq.shapes[i], dtype=np.float64) for i in shape_ids]
+            + [np.zeros(0)]
+        ),
+        'blocks': np.array([
+            [i, b.rf_id, b.gx_id, b.gy_id, b.gz_id, b.adc_id, b.ext_id]
+            for i, b in pulseq.blocks.items()
+        ], dtype=np.int64).reshape(-1, 7),
+        'block_duration': np.array(
+            [b.duration for b in pulseq.blocks.values()], dtype=np.float64),
+    }
+
+
+def pulseq_from_arrays(arrays: dict[str, np.ndarray]) -> mr0.PulseqFile:
+    """Inverse of :func:`pulseq_to_arrays`.
+
+    Shapes are views into ``arrays['shape_samples']``, so they stay memory
+    mapped if the arrays are.
+    """
+    pulseq = mr0.PulseqFile.__new__(mr0.PulseqFile)
+    pulseq.version = int(arrays['version'])
+
+    defs = Definitions.__new__(Definitions)
+    (defs.grad_raster_time, defs.rf_raster_time,
+     defs.adc_raster_time, defs.block_raster_time) = arrays['raster_times'].tolist()
+    defs.fov = tuple(arrays['fov'].tolist())
+    defs.defs = dict(zip(arrays['def_keys'].tolist(),
+                         arrays['def_values'].tolist()))
+    pulseq.definitions = defs
+
+    pulseq.rfs = {
+        int(r[0]): Rf(r[1], int(r[2]), int(r[3]), int(r[4]), r[5], r[6], r[7],
+                      int(r[8]), int(r[9]))
+        for r in arrays['rfs'].tolist()
+    }
+    pulseq.grads = helpers.merge_dicts(
+        {int(r[0]): Gradient(r[1], int(r[2]), int(r[3]), r[4])
+         for r in arrays['gradients'].tolist()},
+        {int(r[0]): Trap(*r[1:]) for r in arrays['traps'].tolist()},
+    )
+    pulseq.adcs = {
+        int(r[0]): Adc(int(r[1]), *r[2:]) for r in arrays['adcs'].tolist()
+    }
+
+    samples = arrays['shape_samples']
+    offset = arrays['shape_offset'].tolist()
+    pulseq.shapes = {
+        shape_id: samples[offset[i]:offset[i + 1]]
+        for i, shape_id in enumerate(arrays['shape_ids'].tolist())
+    }
+
+    pulseq.blocks = {
+        row[0]: Block(duration, *row[1:])
+        for row, duration in zip(arrays['blocks'].tolist(),
+                                 arrays['block_duration'].tolist())
+    }
+    return pulseq
+
+
+def load_npz_mmap(file_name: str) -> dict[str, np.ndarray]:
+    """Memory map all arrays of an uncompressed ``.npz`` file.
+
+    ``np.load`` ignores ``mmap_mode`` for ``.npz`` archives. Members written
+    by ``np.savez`` are stored uncompressed ``.npy`` files, so each array is
+    mapped directly at its offset in the archive (copy on write).
+    """
+    arrays = {}
+    with zipfile.ZipFile(file_name) as archive, open(file_name, 'rb') as file:
+        for info in archive.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{info.filename} is compressed")
+            # Local file header: 30 bytes + name + extra field
+            file.seek(info.header_offset)
+            header = file.read(30)
+            if header[:4] != b'PK\x03\x04':
+                raise ValueError(f"Invalid local header of {info.filename}")
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            file.seek(info.header_offset + 30 + name_len + extra_len)
+
+            major, _ = np.lib.format.read_magic(file)
+            if major == 1:
+                shape, fortran, dtype = np.lib.format.read_array_header_1_0(file)
+            else:
+                shape, fortran, dtype = np.lib.format.read_array_header_2_0(file)
+            if dtype.hasobject:
+                raise ValueError(f"{info.filename} contains python objects")
+
+            name = info.filename.removesuffix('.npy')
+            if np.prod(shape) == 0:
+                arrays[name] = np.zeros(shape, dtype)
+            else:
+                arrays[name] = np.memmap(
+                    file_name, dtype, 'c', file.tell(), shape,
+                    'F' if fortran else 'C'
+                )
+    return arrays
+
+
+def load_pulseq(file_name: str, cache: bool = True) -> mr0.PulseqFile:
+    """Read a Pulseq file using its ``.npz`` sidecar if it is up to date.
+
+    If the sidecar is missing, outdated or unreadable, the file is parsed
+    with :func:`read_pulseq` and the sidecar is (re)written. Not being able
+    to write it (read-only directory) is not an error.
+    """
+    if not cache:
+        return read_pulseq(file_name)
+
+    key = f"{PARSER_VERSION}:{file_hash(file_name)}"
+    sidecar = file_name + SIDECAR_SUFFIX
+
+    if os.path.isfile(sidecar):
+        try:
+            arrays = load_npz_mmap(sidecar)
+            if str(arrays['key']) == key:
+                return pulseq_from_arrays(arrays)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            pass  # Corrupted sidecar, parse and overwrite it
+
+    pulseq = read_pulseq(file_name)
+    # Write to a temporary file first, so that an interrupted write never
+    # leaves a corrupted sidecar under the final name
+    tmp_name = sidecar[:-4] + f'.{os.getpid()}.tmp.npz'
+    try:
+        np.savez(tmp_name, key=np.array(key), **pulseq_to_arrays(pulseq))
+        os.replace(tmp_name, sidecar)
+    except OSError:
+        pass
+    return pulseq
+
+
+def import_file(file_name: str, cache: bool = True) -> mr0.Sequence:
+    """Load a ``.seq`` file as ``mr0.Sequence``, using the sidecar cache."""
+    return mr0.Sequence.from_seq_file(load_pulseq(file_name, cache))
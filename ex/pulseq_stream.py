@@ -0,0 +1,270 @@
+"""Streaming reader for very large Pulseq files.
+
+``mr0.PulseqFile`` keeps every line of the file and one ``Block`` object per
+block in memory, and ``intermediate`` converts all blocks before splitting
+them into repetitions. For 3D sequences with hundreds of thousands of blocks
+this needs a lot more memory than the resulting ``mr0.Sequence``.
+
+:class:`LazyPulseqFile` scans the file once to index the byte ranges of its
+sections, parses the (small) event libraries eagerly and reads ``[BLOCKS]``
+in chunks whenever its blocks are iterated. :func:`iter_intermediate` and
+:func:`sequence_from_file` convert it repetition by repetition, so at most
+one chunk of blocks and one repetition are held at once. Blocks with the same
+events are only decoded once, so the conversion time scales with the number
+of unique blocks.
+
+.. code-block:: python
+
+    seq0 = pulseq_stream.sequence_from_file("out/3d_sequence.seq")
+"""
+
+from __future__ import annotations
+from typing import Iterator
+import numpy as np
+import torch
+import MRzeroCore as mr0
+from MRzeroCore.pulseq.pulseq_loader import Pulse, Spoiler, Adc
+from MRzeroCore.pulseq.pulseq_loader.pulseq_file import Block
+
+from pulseq_reader import parse_libraries, parse_blocks, block_duration
+
+
+def index_sections(file_name: str
+                   ) -> tuple[dict[str, list[tuple[int, int]]], int]:
+    """Byte ranges (start, end) of the contents of every section.
+
+    Sections that appear multiple times have multiple ranges. Also returns
+    the number of block lines, counted while scanning.
+    """
+    index = {}
+    block_count = 0
+    name = None
+    start = pos = 0
+    with open(file_name, 'rb') as file:
+        for line in file:
+            stripped = line.strip()
+            if stripped.startswith(b'['):
+                if name is not None:
+                    index.setdefault(name, []).append((start, pos))
+                name = stripped[1:-1].decode()
+                assert not ("[" in name or "]" in name)  # section name filtering error
+                start = pos + len(line)
+            elif name == "BLOCKS" and stripped and not stripped.startswith(b'#'):
+                block_count += 1
+            elif name is None and stripped and not stripped.startswith(b'#'):
+                raise ValueError("Pulseq file has content before the first section")
+            pos += len(line)
+    if name is not None:
+        index.setdefault(name, []).append((start, pos))
+    return index, block_count
+
+
+def _read_lines(file_name: str, ranges: list[tuple[int, int]]) -> Iterator[str]:
+    """Non-empty lines of the given byte ranges, without comments."""
+    with open(file_name, 'rb') as file:
+        for start, end in ranges:
+            file.seek(start)
+            while file.tell() < end:
+                line = file.readline().strip()
+                if line and not line.startswith(b'#'):
+                    yield line.decode()
+
+
+class LazyBlocks:
+    """Read-only view of the [BLOCKS] section of a :class:`LazyPulseqFile`.
+
+    Supports the dict methods used by the loader (``values``, ``items``,
+    iteration over IDs and ``len``). Every iteration reads the section again
+    in chunks of ``chunk_size`` blocks, ``Block.duration`` is computed per
+    chunk like ``mr0.PulseqFile`` does for the whole file.
+    """
+
+    def __init__(self, pulseq: LazyPulseqFile, ranges: list[tuple[int, int]],
+                 count: int, delays: dict[int, float] | None,
+                 block_duration_raster: float | None,
+                 chunk_size: int) -> None:
+        self.pulseq = pulseq
+        self.ranges = ranges
+        self.count = count
+        self.delays = delays
+        self.block_duration_raster = block_duration_raster
+        self.chunk_size = chunk_size
+
+    def chunks(self) -> Iterator[dict[int, Block]]:
+        """Parse the blocks chunk by chunk, IDs are unique within a chunk."""
+        lines = []
+        for line in _read_lines(self.pulseq.file_name, self.ranges):
+            lines.append(line)
+            if len(lines) == self.chunk_size:
+                yield self._parse(lines)
+                lines = []
+        if len(lines) > 0:
+            yield self._parse(lines)
+
+    def _parse(self, lines: list[str]) -> dict[int, Block]:
+        blocks = parse_blocks('\n'.join(lines), self.pulseq.version,
+                              self.delays, self.block_duration_raster)
+        for block in blocks.values():
+            block.duration = block_duration(self.pulseq, block)
+        return blocks
+
+    def items(self) -> Iterator[tuple[int, Block]]:
+        for chunk in self.chunks():
+            yield from chunk.items()
+
+    def values(self) -> Iterator[Block]:
+        for chunk in self.chunks():
+            yield from chunk.values()
+
+    def __iter__(self) -> Iterator[int]:
+        for chunk in self.chunks():
+            yield from chunk.keys()
+
+    def __len__(self) -> int:
+        return self.count
+
+
+class LazyPulseqFile(mr0.PulseqFile):
+    """``mr0.PulseqFile`` that reads its blocks lazily.
+
+    Everything except ``blocks`` is parsed on construction, as in
+    ``mr0.PulseqFile``; ``blocks`` is a :class:`LazyBlocks`.
+
+    Parameters
+    ----------
+    file_name : str
+        Path to the ``.seq`` file, which must not change while this object
+        is used.
+    chunk_size : int
+        Number of blocks parsed at once.
+    """
+
+    def __init__(self, file_name: str, chunk_size: int = 10000) -> None:
+        self.file_name = file_name
+        index, block_count = index_sections(file_name)
+        sections = {
+            name: '\n'.join(_read_lines(file_name, ranges))
+            for name, ranges in index.items() if name != "BLOCKS"
+        }
+        if "BLOCKS" in index:
+            sections["BLOCKS"] = ''  # Read by LazyBlocks
+        delays, block_duration_raster = parse_libraries(self, sections)
+        sections.pop("BLOCKS")
+
+        self.blocks = LazyBlocks(
+            self, index["BLOCKS"], block_count,
+            delays, block_duration_raster, chunk_size
+        )
+
+        if len(sections) > 0:
+            print(f"Some sections were ignored: {list(sections.keys())}")
+
+
+def decode_block(block: Block, file: mr0.PulseqFile
+                 ) -> list[Pulse | Spoiler | Adc]:
+    """Convert a block into intermediate events, like ``intermediate``."""
+    assert block.rf_id == 0 or block.adc_id == 0
+
+    if block.rf_id != 0:
+        return list(Pulse.parse(block, file))
+    elif block.adc_id != 0:
+        return list(Adc.parse(block, file))
+    else:
+        return [Spoiler.parse(block, file)]
+
+
+def iter_intermediate(file: mr0.PulseqFile, memoize: bool = True
+                      ) -> Iterator[list[int, Pulse, list[Spoiler | Adc]]]:
+    """Generator version of ``pulseq_loader.intermediate``.
+
+    Yields the same ``[event_count, pulse, events]`` repetitions, each one as
+    soon as the next pulse (or the end of the file) is reached.
+
+    Decoding only depends on the event IDs and the duration of a block, so
+    with ``memoize``, every unique ``(rf, gx, gy, gz, adc, duration)``
+    combination is decoded once and its events are reused for all blocks
+    with the same IDs. Reused events are the same objects, don't modify
+    them in place.
+    """
+    decoded = {}
+    current = None  # Events before the first pulse are dropped
+    for block in file.blocks.values():
+        if memoize:
+            key = (block.rf_id, block.gx_id, block.gy_id, block.gz_id,
+                   block.adc_id, block.duration)
+            parsed = decoded.get(key)
+            if parsed is None:
+                parsed = decoded[key] = decode_block(block, file)
+        else:
+            parsed = decode_block(block, file)
+
+        for item in parsed:
+            if isinstance(item, Pulse):
+                if current is not None:
+                    yield current
+                current = [0, item, []]
+            elif current is not None:
+                if isinstance(item, Adc):
+                    current[0] += len(item.event_time)
+                else:  # Spoiler
+                    current[0] += 1
+                current[2].append(item)
+
+    if current is not None:
+        yield current
+
+
+def intermediate(file: mr0.PulseqFile, memoize: bool = True
+                 ) -> list[list[int, Pulse, list[Spoiler | Adc]]]:
+    """Drop-in for ``pulseq_loader.intermediate`` with memoized decoding."""
+    return list(iter_intermediate(file, memoize))
+
+
+def sequence_from_file(file: str | mr0.PulseqFile, chunk_size: int = 10000,
+                       memoize: bool = True) -> mr0.Sequence:
+    """Same as ``mr0.Sequence.from_seq_file``, but streamed.
+
+    ``file`` is either a path, which is opened as :class:`LazyPulseqFile`, or
+    an already loaded Pulseq file. ``memoize`` is passed to
+    :func:`iter_intermediate`.
+    """
+    if isinstance(file, str):
+        file = LazyPulseqFile(file, chunk_size)
+
+    seq = mr0.Sequence()
+    for event_count, pulse, events in iter_intermediate(file, memoize):
+        rep = seq.new_rep(event_count)
+        rep.pulse.angle = torch.as_tensor(pulse.angle, dtype=torch.float)
+        rep.pulse.phase = torch.as_tensor(pulse.phase, dtype=torch.float)
+
+        # Refocussing pulses are pulses with > 90° angle.
+        # Pulses are potentially pTx but we don't have B1 maps: use a rough CP approximation
+        flip = rep.pulse.angle.mean() / np.sqrt(1 / rep.pulse.angle.numel())
+        if flip > 100 * torch.pi/180:
+            rep.pulse.usage = mr0.PulseUsage.REFOC
+        else:
+            rep.pulse.usage = mr0.PulseUsage.EXCIT
+
+        # Concatenate all events in numpy and convert once per repetition,
+        # same values as the per event assignments of from_seq_file
+        event_time, gradm, adc_phase, adc_usage = [], [], [], []
+        for block in events:
+            if isinstance(block, Spoiler):
+                event_time.append([block.duration])
+                gradm.append(block.gradm[None, :])
+                adc_phase.append([0.0])
+                adc_usage.append([0])
+            else:
+                num = len(block.event_time)
+                event_time.append(block.event_time)
+                gradm.append(block.gradm)
+                adc_phase.append(np.full(num, np.pi/2 - block.phase))
+                adc_usage.append(np.ones(num, dtype=np.int64))
+        i = sum(len(t) for t in event_time)
+        if i > 0:
+            rep.event_time[:] = torch.from_numpy(np.concatenate(event_time))
+            rep.gradm[:] = torch.from_numpy(np.concatenate(gradm))
+            rep.adc_phase[:] = torch.from_numpy(np.concatenate(adc_phase))
+            rep.adc_usage[:] = torch.from_numpy(np.concatenate(adc_usage))
+        assert i == event_count
+    return seq
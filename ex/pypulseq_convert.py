@@ -0,0 +1,166 @@
+"""Convert a ``pypulseq.Sequence`` into ``mr0.Sequence`` without a .seq file.
+
+The exercises write the sequence with ``seq.write("out/external.seq")`` and
+read it back with ``mr0.Sequence.import_file``. :func:`sequence_from_pypulseq`
+builds the ``mr0.PulseqFile`` directly from the block and event libraries of
+the pypulseq object and converts it like ``Sequence.from_seq_file``. Writing
+the file is only needed for the scanner and can run in the background with
+:func:`write_async`.
+
+By default, all values are rounded like ``pypulseq.Sequence.write`` formats
+them (e.g. 6 significant digits for amplitudes, delays in us), so the result
+is identical to writing and reading the file.
+
+.. code-block:: python
+
+    seq0 = pypulseq_convert.sequence_from_pypulseq(seq)
+    pypulseq_convert.write_async(seq, 'out/external.seq')
+"""
+
+from __future__ import annotations
+import atexit
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+import numpy as np
+import pypulseq as pp
+import MRzeroCore as mr0
+from MRzeroCore.pulseq.pulseq_loader.pulseq_file import (
+    helpers, Definitions, Block, Rf, Gradient, Trap, Adc
+)
+
+from pulseq_reader import decompress_shape, block_duration
+from pulseq_stream import sequence_from_file
+
+
+# Created on the first write_async call, single worker so that writes of the
+# same file happen in call order
+_writer = None
+
+
+def _default_writer() -> ThreadPoolExecutor:
+    global _writer
+    if _writer is None:
+        _writer = ThreadPoolExecutor(max_workers=1)
+        # Finish pending writes before the interpreter exits
+        atexit.register(_writer.shutdown)
+    return _writer
+
+
+def write_async(seq: pp.Sequence, file_name: str,
+                executor: Executor | None = None) -> Future:
+    """Call ``seq.write(file_name)`` in a background thread.
+
+    ``seq`` must not be modified until the returned future is done. Writes
+    are submitted to ``executor``, by default to a module wide single thread
+    executor that is created on first use.
+    """
+    if executor is None:
+        executor = _default_writer()
+    return executor.submit(seq.write, file_name)
+
+
+def _definition_lines(definitions: dict) -> list[str]:
+    """[DEFINITIONS] lines as written by ``pypulseq.Sequence.write``."""
+    lines = []
+    for key, value in definitions.items():
+        if isinstance(value, str):
+            values = [value]
+        elif isinstance(value, (int, float)):
+            values = [f'{value:0.9g}']
+        elif isinstance(value, (list, tuple, np.ndarray)):
+            values = [f'{v:0.9g}' if isinstance(v, (int, float)) else str(v)
+                      for v in value]
+        else:
+            raise RuntimeError('Unsupported definition')
+        lines.append(f'{key} ' + ' '.join(values))
+    return lines
+
+
+def pulseq_file_from_pypulseq(seq: pp.Sequence, round_like_file: bool = True
+                              ) -> mr0.PulseqFile:
+    """Build the ``mr0.PulseqFile`` that reading ``seq.write(...)`` returns.
+
+    Parameters
+    ----------
+    seq : pypulseq.Sequence
+        Sequence with the 1.3.x event libraries (pypulseq 1.3)
+    round_like_file : bool
+        Round all values like they are formatted by ``seq.write``. If
+        ``False``, the unrounded values of the libraries are used.
+    """
+    pulseq = mr0.PulseqFile.__new__(mr0.PulseqFile)
+    pulseq.version = version = helpers.parse_version([
+        f'major {seq.version_major}',
+        f'minor {seq.version_minor}',
+        f'revision {seq.version_revision}',
+    ])
+    if not 120 <= version < 140:
+        raise ValueError(f"Unsupported pypulseq sequence version {version}")
+
+    def value(x: float, fmt: str = 'g') -> float:
+        return float(format(x, fmt)) if round_like_file else float(x)
+
+    def micros(x: float, fmt: str = 'g') -> float:
+        # Times are written in integer us
+        return int(float(format(np.round(x * 1e6), fmt))) * 1e-6 if round_like_file else float(x)
+
+    if len(seq.dict_definitions) > 0:
+        pulseq.definitions = Definitions.parse(
+            _definition_lines(seq.dict_definitions), version)
+    else:
+        pulseq.definitions = Definitions({}, version)
+
+    pulseq.rfs = {}
+    for k in seq.rf_library.keys:
+        amp, mag_id, phase_id, delay, freq, phase = seq.rf_library.data[k][:6]
+        pulseq.rfs[int(k)] = Rf(
+            value(amp, '12g'), int(mag_id), int(phase_id), 0,
+            micros(delay), value(freq), value(phase), 0, 0
+        )
+
+    gradients, traps = {}, {}
+    for k in seq.grad_library.keys:
+        data = seq.grad_library.data[k]
+        if seq.grad_library.type[k] == 'g':
+            gradients[int(k)] = Gradient(
+                value(data[0], '12g'), int(data[1]), 0, micros(data[2], '.0f'))
+        else:
+            traps[int(k)] = Trap(value(data[0], '12g'),
+                                 *(micros(t) for t in data[1:5]))
+    pulseq.grads = helpers.merge_dicts(gradients, traps)
+
+    pulseq.adcs = {}
+    for k in seq.adc_library.keys:
+        num, dwell, delay, freq, phase = seq.adc_library.data[k][:5]
+        pulseq.adcs[int(k)] = Adc(
+            int(num),
+            value(dwell * 1e9, '.0f') * 1e-9 if round_like_file else float(dwell),
+            int(value(delay * 1e6, '.0f')) * 1e-6 if round_like_file else float(delay),
+            value(freq), value(phase)
+        )
+
+    pulseq.shapes = {}
+    for k in seq.shape_library.keys:
+        data = np.asarray(seq.shape_library.data[k], dtype=np.float64)
+        compressed = data[1:]
+        if round_like_file:
+            compressed = np.char.mod('%.9g', compressed).astype(np.float64)
+        pulseq.shapes[int(k)] = decompress_shape(compressed, int(data[0]), version)
+
+    delays = {int(k): micros(seq.delay_library.data[k][0], '.0f')
+              for k in seq.delay_library.keys}
+    pulseq.blocks = {}
+    for i in range(1, len(seq.dict_block_events) + 1):
+        delay_id, *event_ids = (int(x) for x in seq.dict_block_events[i])
+        pulseq.blocks[i] = Block(delays.get(delay_id, 0.0), *event_ids)
+    for block in pulseq.blocks.values():
+        block.duration = block_duration(pulseq, block)
+    return pulseq
+
+
+def sequence_from_pypulseq(seq: pp.Sequence, round_like_file: bool = True
+                           ) -> mr0.Sequence:
+    """Same as ``mr0.Sequence.from_seq_file`` of the written ``seq``.
+
+    See :func:`pulseq_file_from_pypulseq` for ``round_like_file``.
+    """
+    return sequence_from_file(pulseq_file_from_pypulseq(seq, round_like_file))
@@ -0,0 +1,245 @@
+"""Disk cache for simulated signals, from .seq file and phantom to signal.
+
+Rerunning an exercise where only the plotting cells changed repeats S4
+(load, interpolate and build the phantom) and S5 (import the sequence,
+``compute_graph``, ``execute_graph``) with identical results.
+:meth:`SimCache.simulate` runs this chain only if its result isn't cached
+yet. The cache key is the hash of everything the signal depends on: the
+contents of the .seq file and of the phantom file, the selected slices, the
+interpolation size, the modifications applied to the phantom, the simulation
+parameters and the MRzeroCore version. Signals are stored in
+``out/cache/sim``, least recently used signals are deleted if the cache grows
+above its size limit.
+
+.. code-block:: python
+
+    cache = sim_cache.SimCache()
+    signal = cache.simulate(
+        "out/external.seq", "../data/numerical_brain_cropped.mat", sz=[64, 64],
+        modify=[('T2dash', '=', 30e-3), ('D', '*=', 0), ('B0', '*=', 1)],
+    )
+    print(cache.stats())
+
+Phantom files are ``.mat`` files (``VoxelGridPhantom.load_mat``) or BrainWeb
+``subjectXX.npz`` files, which are loaded with :func:`brainweb_store.brainweb`.
+Phantoms built in code (e.g. ``mr0.CustomVoxelPhantom``) can be passed
+instead of a file name, they are identified by the contents of their tensors.
+"""
+
+from __future__ import annotations
+import os
+import copy
+import hashlib
+import importlib.metadata
+from typing import Any, Iterable
+import numpy as np
+import torch
+import MRzeroCore as mr0
+
+import brainweb_store
+from cache_dir import CacheDir
+from pulseq_reader import file_hash, import_file
+
+
+CACHE_DIR = os.path.join(os.path.dirname(__file__), 'out', 'cache', 'sim')
+# Increment if the key or the stored format changes
+SIM_CACHE_VERSION = 1
+MODIFY_OPS = ('=', '*=')
+
+
+def phantom_fingerprint(phantom: Any) -> str:
+    """Hash the contents of a phantom (all tensors and other attributes)."""
+    h = hashlib.sha256()
+    h.update(type(phantom).__name__.encode())
+    for name, value in sorted(vars(phantom).items()):
+        h.update(name.encode())
+        if isinstance(value, torch.Tensor):
+            value = value.detach().cpu().contiguous()
+            h.update(f"{value.dtype}{tuple(value.shape)}".encode())
+            h.update(value.numpy().tobytes())
+        else:
+            h.update(repr(value).encode())
+    return h.hexdigest()
+
+
+def _normalize(value: Any) -> Any:
+    """Make modification values (tensors, arrays) hashable by repr."""
+    if isinstance(value, (torch.Tensor, np.ndarray)):
+        return value.tolist()
+    return value
+
+
+def apply_modifications(phantom: Any,
+                        modify: Iterable[tuple[str, str, Any]]) -> None:
+    """Apply ``(attribute, op, value)`` modifications in place.
+
+    ``'='`` fills a tensor attribute (``obj_p.T2dash[:] = 30e-3``) or
+    replaces any other attribute, ``'*='`` scales it (``obj_p.D *= 0``).
+    """
+    for name, op, value in modify:
+        current = getattr(phantom, name, None)
+        if op == '=':
+            if isinstance(current, torch.Tensor) and np.ndim(value) == 0:
+                current[:] = value
+            else:
+                setattr(phantom, name, value)
+        elif op == '*=':
+            setattr(phantom, name, current * value)
+        else:
+            raise ValueError(f"Unknown modification {op!r}, use one of {MODIFY_OPS}")
+
+
+def load_phantom(file_name: str, sz: Iterable[int] | None = None,
+                 slices: Iterable[int] | None = None) -> mr0.VoxelGridPhantom:
+    """Load a ``.mat`` or BrainWeb ``.npz`` phantom, not built yet.
+
+    Only the z ``slices`` are kept (all if ``None``), then the phantom is
+    interpolated to ``sz`` (2 or 3 values) if given.
+    """
+    if file_name.endswith('.npz'):
+        obj_p = brainweb_store.brainweb(
+            file_name, None if slices is None else list(slices))
+    else:
+        obj_p = mr0.VoxelGridPhantom.load_mat(file_name)
+        if slices is not None:
+            obj_p = obj_p.slices(list(slices))
+    if sz is not None:
+        sz = list(sz) + [1] * (3 - len(sz))
+        obj_p = obj_p.interpolate(*sz)
+    return obj_p
+
+
+class SimCache(CacheDir):
+    """LRU disk cache of simulated signals, see :class:`CacheDir`.
+
+    Attributes
+    ----------
+    path : str
+        Directory containing the cached signals
+    max_size : int
+        Maximum total size of all cached signals in bytes
+    hits : int
+        Number of signals loaded from the cache
+    misses : int
+        Number of signals that were simulated
+    """
+
+    def __init__(self, path: str = CACHE_DIR, max_size: int = 256 * 2**20):
+        super().__init__(path, max_size, '.npy')
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, seq_file: str, phantom: str | Any,
+            sz: Iterable[int] | None = None,
+            modify: Iterable[tuple[str, str, Any]] = (),
+            **params: Any) -> str:
+        """Hash of everything the signal of :meth:`simulate` depends on."""
+        h = hashlib.sha256()
+        parts = [
+            SIM_CACHE_VERSION,
+            importlib.metadata.version('MRzeroCore'),
+            file_hash(seq_file),
+            file_hash(phantom) if isinstance(phantom, str)
+            else phantom_fingerprint(phantom),
+            None if sz is None else list(sz),
+            [(name, op, _normalize(value)) for name, op, value in modify],
+            sorted(params.items()),
+        ]
+        h.update(repr(parts).encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> torch.Tensor | None:
+        """Load a cached signal, counts as hit or miss."""
+        file_name = self.file_name(key + '.npy')
+        if os.path.isfile(file_name):
+            try:
+                signal = torch.from_numpy(np.load(file_name))
+            except (OSError, ValueError):
+                pass  # Corrupted entry, recompute and overwrite it
+            else:
+                self.touch(file_name)
+                self.hits += 1
+                return signal
+        self.misses += 1
+        return None
+
+    def put(self, key: str, signal: torch.Tensor) -> None:
+        """Store a signal, then evict old entries."""
+        array = signal.detach().cpu().numpy()
+        self.write(key + '.npy', lambda tmp_name: np.save(tmp_name, array))
+
+    def simulate(self, seq_file: str, phantom: str | Any,
+                 sz: Iterable[int] | None = None,
+                 modify: Iterable[tuple[str, str, Any]] = (),
+                 slices: Iterable[int] | None = None,
+                 max_state_count: int = 200,
+                 min_state_mag: float = 1e-3,
+                 min_signal: float = 1e-2,
+                 min_weight: float = 1e-2) -> torch.Tensor:
+        """Simulate ``seq_file`` on ``phantom``, or load the cached signal.
+
+        Parameters
+        ----------
+        seq_file : str
+            Path to the .seq file
+        phantom : str | VoxelGridPhantom | CustomVoxelPhantom
+            Path to a ``.mat`` or BrainWeb ``.npz`` phantom (see
+            :func:`load_phantom`) or an unbuilt phantom object, which is
+            copied and not modified
+        sz : list[int] | None
+            Interpolate the phantom to ``sz`` (2 or 3 values), only for
+            phantoms loaded from a file
+        modify : list[tuple[str, str, Any]]
+            Applied to the phantom after interpolation, see
+            :func:`apply_modifications`
+        slices : list[int] | None
+            Indices of the z slices to simulate, only for phantoms loaded
+            from a file
+        max_state_count, min_state_mag
+            Passed to ``mr0.compute_graph``
+        min_signal, min_weight
+            Passed to ``mr0.execute_graph``
+
+        Returns
+        -------
+        signal : torch.Tensor
+            The simulated signal (on the cpu).
+        """
+        modify = list(modify)
+        key = self.key(seq_file, phantom, sz, modify,
+                       slices=None if slices is None else list(slices),
+                       max_state_count=max_state_count,
+                       min_state_mag=min_state_mag,
+                       min_signal=min_signal, min_weight=min_weight)
+        signal = self.get(key)
+        if signal is not None:
+            return signal
+
+        # S4: phantom
+        if isinstance(phantom, str):
+            obj_p = load_phantom(phantom, sz, slices)
+        else:
+            # Modify a copy, the caller's phantom (and so its fingerprint)
+            # must stay unchanged
+            obj_p = copy.deepcopy(phantom)
+        apply_modifications(obj_p, modify)
+        obj_p = obj_p.build()
+
+        # S5: simulation
+        seq0 = import_file(seq_file)
+        graph = mr0.compute_graph(seq0, obj_p, max_state_count, min_state_mag)
+        signal = mr0.execute_graph(graph, seq0, obj_p, min_signal, min_weight)
+        self.put(key, signal)
+        return signal.cpu()
+
+    def stats(self) -> dict:
+        """Hits, misses and hit rate of this instance, entries and bytes on disk."""
+        sizes = [size for _, size, _ in self.entries()]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+            'entries': len(sizes),
+            'size': sum(sizes),
+        }
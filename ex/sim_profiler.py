@@ -0,0 +1,100 @@
+"""Per-repetition statistics of the main pass.
+
+:class:`SimProfiler` collects the records passed to the ``profiler`` callback
+of :func:`main_pass.execute_graph` and exports them for later analysis.
+
+Example
+-------
+>>> with sim_profiler.SimProfiler() as prof:
+...     signal = main_pass.execute_graph(graph, seq, data, profiler=prof)
+>>> print(prof.summary())
+>>> prof.to_csv('out/profile.csv')
+"""
+
+from __future__ import annotations
+import csv
+import json
+import time
+
+
+FIELDS = ['repetition', 'wall_time', 'event_count', 'dist_count', 'simulated',
+          'skipped_weight', 'skipped_ancestors', 'measured', 'skipped_signal',
+          'peak_tensor_bytes']
+
+
+class SimProfiler:
+    """Collects main pass statistics, one record per repetition.
+
+    Can be used as context manager to additionally measure the total wall
+    time including everything that is not part of a repetition.
+
+    Attributes
+    ----------
+    records : list[dict]
+        Statistics of all simulated repetitions, see ``profiler`` of
+        :func:`main_pass.execute_graph` for the contained keys
+    total_time : float | None
+        Wall time of the ``with`` block in seconds
+    """
+
+    def __init__(self) -> None:
+        self.records = []
+        self.total_time = None
+        self._start = None
+
+    def __call__(self, record: dict) -> None:
+        self.records.append(record)
+
+    def __enter__(self) -> SimProfiler:
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.total_time = time.perf_counter() - self._start
+
+    def totals(self) -> dict:
+        """Sum of all records (maximum for ``peak_tensor_bytes``)."""
+        totals = {
+            key: sum(r[key] for r in self.records)
+            for key in FIELDS[1:-1]
+        }
+        totals['repetition_count'] = len(self.records)
+        totals['peak_tensor_bytes'] = max(
+            (r['peak_tensor_bytes'] for r in self.records), default=0)
+        return totals
+
+    def summary(self, top: int = 5) -> str:
+        """Short text report with the ``top`` slowest repetitions."""
+        totals = self.totals()
+        lines = [
+            f"{totals['repetition_count']} repetitions in "
+            f"{totals['wall_time']:.3f} s, "
+            f"peak tensor size {totals['peak_tensor_bytes'] / 2**20:.1f} MiB",
+            f"distributions: {totals['simulated']} simulated "
+            f"({totals['measured']} measured), "
+            f"{totals['skipped_weight']} skipped by min_weight, "
+            f"{totals['skipped_signal']} not measured by min_signal",
+        ]
+        slowest = sorted(self.records, key=lambda r: -r['wall_time'])[:top]
+        for r in slowest:
+            lines.append(
+                f"  rep {r['repetition']:5d}: {r['wall_time'] * 1e3:8.2f} ms, "
+                f"{r['event_count']} events, {r['measured']} measured dists"
+            )
+        return "\n".join(lines)
+
+    def to_json(self, file_name: str) -> None:
+        """Write totals and all records to a JSON file."""
+        with open(file_name, 'w') as file:
+            json.dump({
+                'total_time': self.total_time,
+                'totals': self.totals(),
+                'records': self.records,
+            }, file, indent=1)
+
+    def to_csv(self, file_name: str) -> None:
+        """Write all records to a CSV file, one row per repetition."""
+        with open(file_name, 'w', newline='') as file:
+            writer = csv.DictWriter(file, FIELDS)
+            writer.writeheader()
+            writer.writerows(self.records)
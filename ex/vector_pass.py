@@ -0,0 +1,278 @@
+"""Main pass operating on all distributions of a repetition at once.
+
+:func:`main_pass.execute_graph` loops over the distributions of every
+repetition in python: it filters the ancestors, dispatches on the transform
+name and computes the k-t position of every distribution separately. For small
+phantoms this python overhead dominates the simulation time. Here, the graph
+is converted into arrays (:func:`columnar_graph`) and every repetition is
+simulated with a few gather / scatter operations on a
+``distributions x voxels`` magnetisation tensor. Only the signal of measured
+distributions is still computed per distribution, which are few per
+repetition.
+
+Results match :func:`main_pass.execute_graph` up to float rounding.
+"""
+
+from __future__ import annotations
+import numpy as np
+import torch
+import MRzeroCore as mr0
+
+from pre_pass import DIST_TYPES, TRANSFORMS, graph_to_arrays
+from main_pass import has_diffusion, has_B0
+
+
+Z0, Z, PLUS = (DIST_TYPES.index(t) for t in ['z0', 'z', '+'])
+# Transforms that use the conjugate magnetisation of the ancestor
+CONJ_TRANSFORMS = [TRANSFORMS.index(t) for t in ['-z', '-+']]
+
+
+class GraphRepetition:
+    """Columnar pre-pass data of the distributions of one repetition.
+
+    Ancestor edges are stored as three parallel arrays, ``ancestor_dist``
+    references a distribution of this repetition, ``ancestor_index`` one of
+    the previous repetition.
+
+    Attributes
+    ----------
+    dist_type : torch.Tensor
+        (dists, ) index into :data:`pre_pass.DIST_TYPES`
+    weight : torch.Tensor
+        (dists, ) pre-pass weight
+    rel_signal : torch.Tensor
+        (dists, ) pre-pass relative signal
+    prepass_kt_vec : torch.Tensor
+        (dists, 4) pre-pass k-t position
+    ancestor_dist : torch.Tensor
+        (edges, ) distribution the edge ends in
+    ancestor_index : torch.Tensor
+        (edges, ) ancestor distribution in the previous repetition
+    ancestor_type : torch.Tensor
+        (edges, ) index into :data:`pre_pass.TRANSFORMS`
+    """
+
+    __slots__ = ('dist_type', 'weight', 'rel_signal', 'prepass_kt_vec',
+                 'ancestor_dist', 'ancestor_index', 'ancestor_type')
+
+    def __init__(self, arrays: dict[str, np.ndarray], rep: int) -> None:
+        """Extract repetition ``rep`` from :func:`pre_pass.graph_to_arrays`."""
+        start, end = arrays['rep_offset'][rep:rep + 2]
+        prev_start = arrays['rep_offset'][rep - 1] if rep > 0 else start
+        a_start, a_end = arrays['ancestor_offset'][[start, end]]
+
+        self.dist_type = torch.as_tensor(arrays['dist_type'][start:end]).long()
+        self.weight = torch.as_tensor(arrays['weight'][start:end])
+        self.rel_signal = torch.as_tensor(arrays['rel_signal'][start:end])
+        self.prepass_kt_vec = torch.as_tensor(
+            arrays['prepass_kt_vec'][start:end])
+        self.ancestor_dist = torch.as_tensor(np.repeat(
+            np.arange(end - start),
+            np.diff(arrays['ancestor_offset'][start:end + 1])
+        )).long()
+        self.ancestor_index = torch.as_tensor(
+            arrays['ancestor_index'][a_start:a_end] - prev_start).long()
+        self.ancestor_type = torch.as_tensor(
+            arrays['ancestor_type'][a_start:a_end]).long()
+
+        if a_end > a_start and (self.ancestor_index.min() < 0
+                                or self.ancestor_index.max() >= start - prev_start):
+            raise ValueError(
+                f"Repetition {rep} has ancestors outside of the previous one")
+
+    def to(self, device: torch.device) -> GraphRepetition:
+        """Move all arrays to ``device`` (in place), returns self."""
+        for name in self.__slots__:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    def __len__(self) -> int:
+        return self.dist_type.numel()
+
+
+def columnar_graph(graph: mr0.Graph) -> list[GraphRepetition]:
+    """Convert a graph into one :class:`GraphRepetition` per repetition.
+
+    The first entry contains the initial z0 distribution, like ``graph[0]``.
+    """
+    arrays = graph_to_arrays(graph)
+    return [GraphRepetition(arrays, rep) for rep in range(len(graph))]
+
+
+def execute_graph_vectorized(graph: mr0.Graph | list[GraphRepetition],
+                             seq: mr0.Sequence,
+                             data: mr0.SimData,
+                             min_signal: float = 1e-2,
+                             min_weight: float = 1e-2,
+                             verbose: bool = True,
+                             ) -> torch.Tensor:
+    """Calculate the signal of the sequence like ``mr0.execute_graph``.
+
+    Parameters
+    ----------
+    graph : Graph | list[GraphRepetition]
+        Distribution graph or its :func:`columnar_graph`, which can be reused
+        for multiple phantoms
+    seq, data, min_signal, min_weight
+        Same as for :func:`main_pass.execute_graph`.
+    verbose : bool
+        Print the progress of the simulation.
+
+    Returns
+    -------
+    signal : torch.Tensor
+        The simulated signal of the sequence.
+    """
+    if isinstance(graph, mr0.Graph):
+        graph = columnar_graph(graph)
+    graph = [rep.to(data.device) for rep in graph]
+    device = data.device
+    k_to_si = 2*np.pi / data.fov
+    voxel_count = data.PD.numel()
+
+    # Proton density can be baked into coil sensitivity. shape: voxels x coils
+    coil_sensitivity = (
+        data.coil_sens.t().to(torch.cfloat)
+        * torch.abs(data.PD).unsqueeze(1)
+    )
+    use_diffusion = has_diffusion(data)
+    use_B0 = has_B0(data)
+    conj_transforms = torch.tensor(CONJ_TRANSFORMS, device=device)
+
+    # State of the distributions of the previous repetition
+    mag = torch.ones(1, voxel_count, dtype=torch.cfloat, device=device)
+    kt_vec = torch.zeros(1, 4, device=device)
+    simulated = torch.ones(1, dtype=torch.bool, device=device)
+
+    signal = []
+    for i, rep in enumerate(seq):
+        dists = graph[i + 1]
+        if verbose:
+            print(f"\rCalculating repetition {i+1} / {len(seq)}", end='')
+
+        angle = torch.as_tensor(rep.pulse.angle)
+        phase = torch.as_tensor(rep.pulse.phase)
+
+        # 1Tx or pTx?
+        if angle.numel() == 1:
+            B1 = data.B1.sum(0)
+            angle = angle * B1.abs()
+            phase = phase + B1.angle()
+        else:
+            B1 = (data.B1 * (angle * torch.exp(1j * phase))[:, None]).sum(0)
+            angle = B1.abs()
+            phase = B1.angle()
+
+        # shape: transforms x voxels, same order as pre_pass.TRANSFORMS
+        z_to_p = -0.70710678118j * torch.sin(angle) * torch.exp(1j*phase)
+        p_to_p = torch.cos(angle/2)**2
+        transform = torch.stack([
+            torch.cos(angle).to(torch.cfloat),  # zz
+            p_to_p.to(torch.cfloat),  # ++
+            z_to_p,  # z+
+            -z_to_p.conj(),  # +z
+            -z_to_p,  # -z
+            (1 - p_to_p) * torch.exp(2j*phase),  # -+
+        ])
+
+        # Edges from simulated ancestors, dists need one to be simulated
+        edge = simulated[dists.ancestor_index]
+        has_ancestor = torch.zeros(len(dists), dtype=torch.bool, device=device)
+        has_ancestor[dists.ancestor_dist[edge]] = True
+        simulated = (dists.dist_type == Z0) | (
+            (dists.weight >= min_weight) & has_ancestor)
+        edge &= simulated[dists.ancestor_dist]
+
+        src = dists.ancestor_index[edge]
+        dst = dists.ancestor_dist[edge]
+        kind = dists.ancestor_type[edge]
+        conj = torch.isin(kind, conj_transforms)
+
+        # Magnetisation after the pulse: sum over all ancestors
+        src_mag = torch.where(conj[:, None], mag[src].conj(), mag[src])
+        mag = torch.zeros(len(dists), voxel_count, dtype=torch.cfloat,
+                          device=device).index_add(0, dst, src_mag * transform[kind])
+
+        # k-t position of the first simulated ancestor, zero for z0
+        if edge.numel() > 0:
+            edge_count = edge.numel()
+            edge_pos = torch.arange(edge_count, device=device)[edge]
+            first = torch.full((len(dists), ), edge_count, device=device)
+            first = first.scatter_reduce(0, dst, edge_pos, 'amin')
+            has_first = (first < edge_count) & (dists.dist_type != Z0)
+            first = first.clamp(max=edge_count - 1)
+            sign = torch.where(
+                torch.isin(dists.ancestor_type[first], conj_transforms), -1.0, 1.0)
+            kt_prev = kt_vec[dists.ancestor_index[first]] * sign[:, None]
+            kt_vec = torch.where(has_first[:, None], kt_prev, 0.0)
+        else:
+            kt_vec = torch.zeros(len(dists), 4, device=device)
+
+        # shape: events x 4
+        trajectory = torch.cumsum(torch.cat([
+            rep.gradm, rep.event_time[:, None]
+        ], 1), 0)
+        dt = rep.event_time
+        total_time = rep.event_time.sum()
+        r1 = torch.exp(-total_time / torch.abs(data.T1))
+        r2 = torch.exp(-total_time / torch.abs(data.T2))
+
+        plus = (simulated & (dists.dist_type == PLUS)).nonzero()[:, 0]
+        longitudinal = (simulated & (dists.dist_type != PLUS)).nonzero()[:, 0]
+
+        # shape: + dists x events x 4
+        dist_traj = kt_vec[plus, None, :] + trajectory[None, :, :]
+        if use_diffusion:
+            k2 = dist_traj[:, :, :3] * k_to_si
+            k1 = torch.cat([kt_vec[plus, None, :3] * k_to_si, k2[:, :-1, :]], 1)
+            # shape: + dists x events
+            b_cum = torch.cumsum(1/3 * dt * (k1**2 + k1*k2 + k2**2).sum(2), 1)
+
+        # Signal of measured + distributions
+        rep_sig = torch.zeros(rep.event_count, coil_sensitivity.shape[1],
+                              dtype=torch.cfloat, device=device)
+        measured = (dists.rel_signal[plus] >= min_signal).nonzero()[:, 0]
+        if rep.event_count == 0:
+            measured = measured[:0]
+        if len(measured) > 0:  # same for all distributions
+            T2 = torch.exp(-trajectory[:, 3:] / torch.abs(data.T2))
+        for p in measured.tolist():
+            traj = dist_traj[p]
+            dephasing = data.dephasing_func(traj[:, :3], data.nyquist)[:, None]
+            T2dash = torch.exp(-torch.abs(traj[:, 3:]) / torch.abs(data.T2dash))
+            rot_phase = -(traj[:, :3] @ data.voxel_pos.T)
+            if use_B0:
+                rot_phase = rot_phase + traj[:, 3:] * data.B0
+            rot = torch.exp(2j * np.pi * rot_phase)
+            transverse_mag = (
+                1.41421356237 * mag[plus[p]].unsqueeze(0)
+                * rot * T2 * T2dash * dephasing
+            )
+            if use_diffusion:
+                transverse_mag = transverse_mag * torch.exp(
+                    -1e-9 * data.D * b_cum[p, :, None])
+            rep_sig = rep_sig + transverse_mag @ coil_sensitivity
+
+        # Relaxation and diffusion until the end of the repetition
+        plus_mag = mag[plus] * r2
+        long_mag = mag[longitudinal] * r1
+        if use_diffusion:
+            plus_mag = plus_mag * torch.exp(-1e-9 * data.D * b_cum[:, -1:])
+            k = torch.linalg.vector_norm(kt_vec[longitudinal, :3] * k_to_si, dim=1)
+            long_mag = long_mag * torch.exp(
+                -1e-9 * data.D * total_time * k[:, None]**2)
+        is_z0 = dists.dist_type[longitudinal] == Z0
+        long_mag = long_mag + torch.where(is_z0[:, None], 1 - r1, 0.0)
+
+        mag = torch.zeros_like(mag).index_put(
+            (torch.cat([plus, longitudinal]), ),
+            torch.cat([plus_mag, long_mag])
+        )
+        kt_vec = kt_vec.index_put((plus, ), dist_traj[:, -1, :])
+
+        rep_sig = rep_sig * torch.exp(1j * rep.adc_phase).unsqueeze(1)
+        signal.append(rep_sig[rep.adc_usage > 0, :])
+
+    if verbose:
+        print(" - done")
+    return torch.cat(signal)
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The modules in ex/ import each other as top-level modules, like the
+# exercise scripts that are run from within ex/
+EX_DIR = os.path.join(os.path.dirname(__file__), '..', 'ex')
+DATA_DIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+sys.path.insert(0, os.path.abspath(EX_DIR))
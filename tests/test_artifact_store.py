@@ -0,0 +1,80 @@
+import os
+import numpy as np
+import torch
+
+import artifact_store
+from conftest import EX_DIR
+
+
+SEQ_FILE = os.path.join(EX_DIR, 'out', 'exA02_SpinEcho.seq')
+
+
+def test_put_and_get(tmp_path):
+    store = artifact_store.ArtifactStore(str(tmp_path))
+    key = store.put_bytes(b'signal')
+    assert store.put_bytes(b'signal') == key  # stored once
+    assert store.get_bytes(key) == b'signal'
+    assert store.get_bytes('0' * 64) is None
+    assert store.blob_path(key) == os.path.join(
+        tmp_path, 'blobs', key + artifact_store.BLOB_SUFFIX)
+
+    tensor = torch.randn(5, 3, dtype=torch.cfloat)
+    key = store.put_tensor(tensor)
+    assert torch.equal(store.get_tensor(key), tensor)
+    assert store.put_tensor(tensor.numpy()) == key
+    assert store.get_tensor('0' * 64) is None
+
+
+def test_export(tmp_path):
+    store = artifact_store.ArtifactStore(str(tmp_path / 'store'))
+    key = store.put_seq(SEQ_FILE)
+    assert store.put_file(SEQ_FILE) == key
+
+    target = str(tmp_path / 'external.seq')
+    assert store.export(key, target)
+    with open(target, 'rb') as exported, open(SEQ_FILE, 'rb') as original:
+        assert exported.read() == original.read()
+    # Writing to the exported file doesn't change the blob
+    with open(target, 'w') as file:
+        file.write('changed')
+    assert store.get_bytes(key) == open(SEQ_FILE, 'rb').read()
+    assert not store.export('0' * 64, target)
+
+
+def test_evict(tmp_path):
+    store = artifact_store.ArtifactStore(str(tmp_path), max_size=250)
+    keys = [store.put_bytes(bytes([i]) * 100) for i in range(2)]
+    os.utime(store.blob_path(keys[0]), (0, 0))
+    store.get_bytes(keys[0])  # now the most recently used
+    os.utime(store.blob_path(keys[1]), (1, 1))
+    keys.append(store.put_bytes(b'x' * 100))
+
+    assert store.blob_path(keys[0]) is not None
+    assert store.blob_path(keys[1]) is None
+    assert store.blob_path(keys[2]) is not None
+
+    # References to evicted blobs are dropped from the runs
+    store.record('exp', seq=keys[1], signal=keys[2], phantom='brain')
+    assert store.runs() == [
+        {'experiment_id': 'exp', 'time': store.runs()[0]['time'],
+         'signal': keys[2], 'phantom': 'brain'}]
+
+
+def test_find(tmp_path):
+    store = artifact_store.ArtifactStore(str(tmp_path))
+    seq = store.put_bytes(b'seq')
+    first = store.put_tensor(np.zeros(3))
+    second = store.put_tensor(np.ones(3))
+    store.record('flash', seq=seq, phantom='brain', signal=first)
+    store.record('flash', seq=seq, phantom='brain', signal=second)
+    store.record('epi', seq=seq, phantom='sphere', signal=first)
+
+    assert store.find(seq=seq, phantom='brain')['signal'] == second
+    assert store.find('epi', seq=seq)['signal'] == first
+    assert store.find('epi', phantom='brain') is None
+    assert [run['experiment_id'] for run in store.runs()] == \
+        ['flash', 'flash', 'epi']
+    assert len(store.runs('flash')) == 2
+
+    store.clear()
+    assert store.runs() == [] and store.get_bytes(seq) is None
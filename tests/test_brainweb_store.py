@@ -0,0 +1,68 @@
+import os
+import numpy as np
+import torch
+import MRzeroCore as mr0
+
+import brainweb_store
+
+
+def write_subject(file_name, n=24, radius=0.8):
+    x = np.linspace(-1, 1, n, dtype=np.float32)
+    r = np.sqrt(x[:, None, None]**2 + x[None, :, None]**2
+                + (x[None, None, :] - 0.2)**2)
+    tissue = np.where(r < radius, 1 + 0.3 * np.sin(7 * r), 0).astype(np.float32)
+    np.savez_compressed(file_name, **{
+        name: tissue * scale for name, scale in zip(
+            brainweb_store.MAPS, [0.8, 1.5, 0.09, 0.3, 0.8])
+    })
+
+
+def assert_same(phantom, expected):
+    for name in ['PD', 'T1', 'T2', 'T2dash', 'D', 'B0', 'B1', 'coil_sens',
+                 'base_fov', 'rel_fov']:
+        a, b = getattr(phantom, name), getattr(expected, name)
+        assert a.shape == b.shape, name
+        assert torch.allclose(a, b, rtol=1e-5, atol=1e-4), name
+
+
+def test_same_as_mr0(tmp_path):
+    file_name = str(tmp_path / 'subject05.npz')
+    write_subject(file_name)
+    expected = mr0.VoxelGridPhantom.brainweb(file_name)
+
+    assert_same(brainweb_store.brainweb(file_name), expected)
+    assert_same(brainweb_store.brainweb(file_name, slices=[3, 12]),
+                expected.slices([3, 12]))
+    # Loading the store directory gives the same result
+    assert_same(brainweb_store.brainweb(str(tmp_path / 'subject05'), [12]),
+                expected.slices([12]))
+
+
+def test_regenerated_npz(tmp_path):
+    file_name = str(tmp_path / 'subject05.npz')
+    write_subject(file_name)
+    brainweb_store.brainweb(file_name, slices=[12])
+
+    # Regenerated without SAVE_STORE: the store is rebuilt
+    write_subject(file_name, radius=0.5)
+    assert brainweb_store.is_stale(str(tmp_path / 'subject05'), file_name)
+    assert_same(brainweb_store.brainweb(file_name, slices=[12]),
+                mr0.VoxelGridPhantom.brainweb(file_name).slices([12]))
+
+
+def test_regenerated_store(tmp_path):
+    file_name = str(tmp_path / 'subject05.npz')
+    write_subject(file_name)
+    brainweb_store.brainweb(file_name, slices=[12])
+
+    # Regenerated with SAVE_STORE, like generate_maps.py does
+    write_subject(file_name, radius=0.5)
+    path = brainweb_store.store_path(file_name)
+    os.remove(os.path.join(path, brainweb_store.NORM_FILE))
+    with np.load(file_name) as data:
+        for name in brainweb_store.MAPS:
+            np.save(os.path.join(path, name + '.npy'),
+                    np.ascontiguousarray(data[name].transpose(2, 0, 1)))
+    assert not brainweb_store.is_stale(path, file_name)
+    assert_same(brainweb_store.brainweb(file_name, slices=[12]),
+                mr0.VoxelGridPhantom.brainweb(file_name).slices([12]))
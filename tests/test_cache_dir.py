@@ -0,0 +1,48 @@
+import os
+import pytest
+
+from cache_dir import CacheDir
+
+
+def write_bytes(data):
+    def save(file_name):
+        with open(file_name, 'wb') as file:
+            file.write(data)
+    return save
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = CacheDir(str(tmp_path), max_size=300)
+    for i, name in enumerate(['a.bin', 'b.bin', 'c.bin']):
+        file_name = cache.write(name, write_bytes(b'x' * 100))
+        os.utime(file_name, (i, i))
+    cache.touch(cache.file_name('a.bin'))
+    cache.max_size = 250
+    cache.evict()
+    assert sorted(os.listdir(tmp_path)) == ['a.bin', 'c.bin']
+
+    # The newest entry is kept even if it alone exceeds the limit
+    cache.max_size = 1
+    cache.evict()
+    assert os.listdir(tmp_path) == ['a.bin']
+
+
+def test_failed_write_leaves_no_file(tmp_path):
+    cache = CacheDir(str(tmp_path), max_size=2**20)
+
+    def save(file_name):
+        write_bytes(b'partial')(file_name)
+        raise RuntimeError("interrupted")
+
+    with pytest.raises(RuntimeError):
+        cache.write('a.npz', save)
+    assert os.listdir(tmp_path) == []
+
+
+def test_suffix_selects_entries(tmp_path):
+    cache = CacheDir(str(tmp_path), max_size=0, suffix='.npz')
+    (tmp_path / 'other.txt').write_text('kept')
+    cache.write('a.npz', write_bytes(b'a'))
+    assert [name for _, _, name in cache.entries()] == ['a.npz']
+    cache.clear()
+    assert os.listdir(tmp_path) == ['other.txt']
@@ -0,0 +1,36 @@
+import os
+import MRzeroCore as mr0
+
+import cost_model
+from test_main_pass import load_seq, load_data
+
+
+def test_cheap_graph_ranks_below_expensive(tmp_path):
+    seq = load_seq('exE01_FLASH_2D_user_tag_fruit#.seq')
+    data = load_data(diffusion=False, B0=True)
+    cache_file = str(tmp_path / 'calibration.json')
+    calibration = cost_model.calibrate(data.device, cache_file)
+    assert os.path.isfile(cache_file)
+    assert cost_model.calibrate(data.device, cache_file) == calibration
+
+    cheap = cost_model.estimate_cost(
+        seq, data, mr0.compute_graph(seq, data, 10, 1e-3), calibration=calibration)
+    expensive = cost_model.estimate_cost(
+        seq, data, mr0.compute_graph(seq, data, 200, 1e-4), calibration=calibration)
+    assert cheap['flops'] < expensive['flops']
+    assert cheap['time'] < expensive['time']
+    assert cheap['peak_memory'] <= expensive['peak_memory']
+
+
+def test_fit_overhead():
+    seq = load_seq('exA02_SpinEcho.seq')
+    data = load_data(diffusion=False, B0=True)
+    runs = [(seq, data, mr0.compute_graph(seq, data, count, 1e-4))
+            for count in [5, 50]]
+    calibration = cost_model.fit_overhead(
+        runs, cost_model.calibrate(data.device, None), repeats=1)
+    for name in ['rep_ops', 'graph_dist_ops', 'dist_ops']:
+        assert calibration[name] >= 0
+    cost = cost_model.estimate_cost(seq, data, runs[0][2],
+                                    calibration=calibration)
+    assert cost['time'] > 0
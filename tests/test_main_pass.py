@@ -0,0 +1,59 @@
+import os
+import pytest
+import torch
+import MRzeroCore as mr0
+
+import main_pass
+from conftest import EX_DIR, DATA_DIR
+
+
+SEQ_FILES = ['exE01_FLASH_2D_user_tag_fruit#.seq', 'exA02_SpinEcho.seq']
+
+
+def load_seq(name):
+    return mr0.Sequence.from_seq_file(
+        mr0.PulseqFile(os.path.join(EX_DIR, 'out', name)))
+
+
+def load_data(diffusion, B0):
+    obj_p = mr0.VoxelGridPhantom.load_mat(
+        os.path.join(DATA_DIR, 'numerical_brain_cropped.mat'))
+    obj_p = obj_p.interpolate(16, 16, 1)
+    obj_p.T2dash[:] = 30e-3
+    if not diffusion:
+        obj_p.D *= 0
+    if not B0:
+        obj_p.B0 *= 0
+    return obj_p.build()
+
+
+def simulate(execute, seq, data, **kwargs):
+    graph = mr0.compute_graph(seq, data, 200, 1e-3)
+    return execute(graph, seq, data, **kwargs)
+
+
+def test_detects_missing_terms():
+    data = load_data(diffusion=False, B0=False)
+    # SimData clamps D, so D *= 0 doesn't result in zeros
+    assert data.D.min() == main_pass.D_FLOOR
+    assert not main_pass.has_diffusion(data)
+    assert not main_pass.has_B0(data)
+
+    data = load_data(diffusion=True, B0=True)
+    assert main_pass.has_diffusion(data)
+    assert main_pass.has_B0(data)
+
+
+@pytest.mark.parametrize('seq_file', SEQ_FILES)
+@pytest.mark.parametrize('diffusion', [True, False])
+@pytest.mark.parametrize('B0', [True, False])
+@pytest.mark.parametrize('separable_phase', [False, True])
+def test_matches_mr0(seq_file, diffusion, B0, separable_phase):
+    seq = load_seq(seq_file)
+    data = load_data(diffusion, B0)
+
+    expected = simulate(mr0.execute_graph, seq, data)
+    signal = simulate(main_pass.execute_graph, seq, data,
+                      separable_phase=separable_phase)
+    error = (signal - expected).abs().max() / expected.abs().max()
+    assert error < 1e-5
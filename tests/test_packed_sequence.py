@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+import torch
+import MRzeroCore as mr0
+
+from packed_sequence import PackedSequence
+from test_main_pass import load_seq
+from test_pulseq_stream import assert_same_sequence
+
+
+# FLASH, EPI and a spin echo, whose REFOC pulse negates the trajectory
+SEQ_FILES = ['exE01_FLASH_2D_user_tag_fruit#.seq', 'exB09_GRE_EPI_2D.seq',
+             'exA02_SpinEcho.seq', 'exD01_bSSFP_2D.seq']
+
+
+def random_sequence(rep_count=40, seed=0):
+    """Random pulse usages, so that STORE / EXCIT chains are tested."""
+    rng = np.random.default_rng(seed)
+    usages = list(mr0.PulseUsage)
+    seq = mr0.Sequence()
+    for _ in range(rep_count):
+        rep = seq.new_rep(int(rng.integers(1, 6)))
+        rep.pulse.usage = usages[rng.integers(len(usages))]
+        rep.event_time[:] = torch.from_numpy(rng.uniform(1e-4, 1e-3, rep.event_count))
+        rep.gradm[:] = torch.from_numpy(rng.normal(size=(rep.event_count, 3)))
+        rep.adc_usage[:] = torch.from_numpy(rng.integers(0, 3, rep.event_count))
+    return seq
+
+
+def assert_close(value, expected):
+    scale = expected.abs().max().clamp(min=1)
+    assert (value - expected).abs().max() <= 1e-5 * scale
+
+
+@pytest.mark.parametrize('seq', [
+    *[pytest.param(name, id=name) for name in SEQ_FILES],
+    *[pytest.param(seed, id=f'random{seed}') for seed in range(3)],
+])
+def test_same_as_sequence(seq):
+    seq = load_seq(seq) if isinstance(seq, str) else random_sequence(seed=seq)
+    packed = PackedSequence.from_sequence(seq)
+    assert_same_sequence(packed.to_sequence(), seq)
+
+    full = packed.get_full_kspace()
+    expected = seq.get_full_kspace()
+    assert len(full) == len(expected)
+    for rep_kspace, expected_kspace in zip(full, expected):
+        assert rep_kspace.shape == expected_kspace.shape
+        assert_close(rep_kspace, expected_kspace)
+    assert_close(packed.get_full_kspace(split=False), torch.cat(expected))
+    assert_close(packed.get_kspace(), seq.get_kspace())
+
+    assert packed.get_contrasts() == seq.get_contrasts()
+    for contrast in seq.get_contrasts():
+        assert torch.equal(packed.get_contrast_mask(contrast),
+                           seq.get_contrast_mask(contrast))
+    assert packed.get_duration() == pytest.approx(seq.get_duration())
+
+
+def test_spin_echo_is_refocused():
+    # Otherwise the conjugation path isn't covered by test_same_as_sequence
+    seq = load_seq('exA02_SpinEcho.seq')
+    assert any(rep.pulse.usage == mr0.PulseUsage.REFOC for rep in seq)
+    assert any(rep.pulse.usage == mr0.PulseUsage.STORE
+               for rep in random_sequence())
@@ -0,0 +1,40 @@
+import pytest
+import MRzeroCore as mr0
+
+import main_pass
+import parallel_sim
+from test_main_pass import load_seq, load_data
+
+
+@pytest.fixture(scope='module')
+def setup():
+    seq = load_seq('exE01_FLASH_2D_user_tag_fruit#.seq')
+    data = load_data(diffusion=True, B0=True)
+    graph = mr0.compute_graph(seq, data, 200, 1e-3)
+    expected = main_pass.execute_graph(graph, seq, data)
+    return graph, seq, data, expected
+
+
+def relative_error(signal, expected):
+    return ((signal - expected).abs().max() / expected.abs().max()).item()
+
+
+def test_shards_sum_to_signal(setup):
+    graph, seq, data, expected = setup
+    shards = parallel_sim.split_voxels(data, 3)
+    assert shards[0].start == 0 and shards[-1].stop == data.PD.numel()
+
+    signal = sum(
+        main_pass.execute_graph(graph, seq, parallel_sim.select_voxels(data, s))
+        for s in shards
+    )
+    assert relative_error(signal, expected) < 1e-5
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_parallel_matches_single_process(setup, workers, capsys):
+    graph, seq, data, expected = setup
+    signal = parallel_sim.execute_graph_parallel(
+        graph, seq, data, workers=workers, shard_count=3, verbose=False)
+    assert relative_error(signal, expected) < 1e-5
+    assert capsys.readouterr().out == ''
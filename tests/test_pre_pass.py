@@ -0,0 +1,56 @@
+import os
+import pytest
+import MRzeroCore as mr0
+
+import main_pass
+import pre_pass
+from test_main_pass import SEQ_FILES, load_seq, load_data
+
+
+def test_adaptive_budget(capfd):
+    seq = load_seq('exE01_FLASH_2D_user_tag_fruit#.seq')
+    data = load_data(diffusion=False, B0=True)
+
+    graph, budget = pre_pass.compute_graph_adaptive(seq, data, 1e-3)
+    assert budget['estimated_error'] <= 1e-3
+    assert budget['max_state_count'] < pre_pass.STATE_COUNT_LADDER[-1]
+    assert len(graph) == len(seq) + 1
+    # Neither the budget nor the timing of the pre-passes is printed
+    assert capfd.readouterr().out == ''
+
+    # The reference is reused, the same budget is chosen again
+    references = len(pre_pass._references)
+    _, again = pre_pass.compute_graph_adaptive(seq, data, 1e-3)
+    assert len(pre_pass._references) == references
+    assert again == budget
+
+
+@pytest.mark.parametrize('seq_file', SEQ_FILES)
+@pytest.mark.parametrize('target_error', [1e-1, 1e-2])
+def test_estimate_bounds_signal_error(seq_file, target_error):
+    seq = load_seq(seq_file)
+    data = load_data(diffusion=False, B0=True)
+
+    graph, budget = pre_pass.compute_graph_adaptive(
+        seq, data, target_error, reference_state_count=1000,
+        reference_mag=1e-6)
+    reference = mr0.compute_graph(seq, data, 1000, 1e-6)
+    signal = main_pass.execute_graph(graph, seq, data)
+    expected = main_pass.execute_graph(reference, seq, data)
+    error = (signal - expected).abs().max() / expected.abs().max()
+    assert error <= max(budget['estimated_error'], 1e-6)
+
+
+def test_graph_cache(tmp_path):
+    seq = load_seq('exA02_SpinEcho.seq')
+    data = load_data(diffusion=False, B0=True)
+
+    cache = pre_pass.GraphCache(str(tmp_path))
+    graph = cache.compute_graph(seq, data, 50, 1e-3)
+    again = cache.compute_graph(seq, data, 50, 1e-3)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert [len(rep) for rep in again] == [len(rep) for rep in graph]
+    assert [name for _, _, name in cache.entries()] == os.listdir(tmp_path)
+
+    cache.clear()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,113 @@
+import os
+import glob
+import shutil
+import numpy as np
+import pytest
+import MRzeroCore as mr0
+
+import pulseq_reader
+from conftest import EX_DIR
+
+
+SEQ_FILES = sorted(glob.glob(os.path.join(EX_DIR, 'out', '*.seq')))
+
+
+def test_parse_table():
+    table = pulseq_reader.parse_table('1 2 3\n\n2 4 5\n', 3)
+    assert table.tolist() == [[1, 2, 3], [2, 4, 5]]
+    assert pulseq_reader.parse_table('1 2 3 4\n', (3, 4)).shape == (1, 4)
+
+
+def test_parse_table_checks_every_line():
+    # A short line followed by a long line has the expected total count
+    with pytest.raises(ValueError):
+        pulseq_reader.parse_table('1 2\n2 3 4 5\n3 4 5\n', 3)
+    with pytest.raises(ValueError):
+        pulseq_reader.parse_table('1 2 3 4\n2 3 4 5\n', 3)
+
+
+def test_parse_table_checks_integers():
+    with pytest.raises(ValueError):
+        pulseq_reader.parse_table('1.5 2 3\n', 3)
+    with pytest.raises(ValueError):
+        pulseq_reader.parse_table('1 2 3.5\n', 3, (0, 2))
+    # Delays in us are integers, amplitudes aren't
+    with pytest.raises(ValueError):
+        pulseq_reader.parse_delays('1 100.5\n', 140)
+    grads = pulseq_reader.parse_gradients('1 2.5 3 0\n', 131)
+    assert grads[1].amp == 2.5
+
+
+def assert_same_pulseq(pulseq, expected):
+    assert pulseq.version == expected.version
+    assert repr(pulseq.definitions) == repr(expected.definitions)
+    for name in ['rfs', 'grads', 'adcs', 'blocks']:
+        events, expected_events = getattr(pulseq, name), getattr(expected, name)
+        assert list(events) == list(expected_events)
+        for event, expected_event in zip(events.values(),
+                                         expected_events.values()):
+            assert vars(event) == vars(expected_event)
+    assert list(pulseq.shapes) == list(expected.shapes)
+    for i in pulseq.shapes:
+        np.testing.assert_array_equal(pulseq.shapes[i], expected.shapes[i])
+
+
+@pytest.mark.parametrize('file_name', SEQ_FILES, ids=os.path.basename)
+def test_same_as_mr0(file_name):
+    assert_same_pulseq(pulseq_reader.read_pulseq(file_name),
+                       mr0.PulseqFile(file_name))
+
+
+@pytest.mark.parametrize('file_name', SEQ_FILES, ids=os.path.basename)
+def test_arrays_round_trip(file_name, tmp_path):
+    expected = mr0.PulseqFile(file_name)
+    arrays = pulseq_reader.pulseq_to_arrays(pulseq_reader.read_pulseq(file_name))
+    assert_same_pulseq(pulseq_reader.pulseq_from_arrays(arrays), expected)
+
+    # Same through a memory mapped .npz
+    npz_file = str(tmp_path / 'arrays.npz')
+    np.savez(npz_file, **arrays)
+    mapped = pulseq_reader.load_npz_mmap(npz_file)
+    assert_same_pulseq(pulseq_reader.pulseq_from_arrays(mapped), expected)
+
+
+def copy_seq(name, target):
+    shutil.copyfile(os.path.join(EX_DIR, 'out', name), target)
+
+
+def test_sidecar_is_rebuilt_for_changed_file(tmp_path):
+    file_name = str(tmp_path / 'external.seq')
+    sidecar = file_name + pulseq_reader.SIDECAR_SUFFIX
+    copy_seq('exA02_SpinEcho.seq', file_name)
+    pulseq_reader.load_pulseq(file_name)
+    assert os.path.isfile(sidecar)
+    key = str(pulseq_reader.load_npz_mmap(sidecar)['key'])
+
+    # The sidecar is used as long as the file is unchanged
+    pulseq = pulseq_reader.load_pulseq(file_name)
+    assert isinstance(pulseq.shapes[1], np.memmap)
+    assert_same_pulseq(pulseq, mr0.PulseqFile(file_name))
+
+    copy_seq('exE01_FLASH_2D_user_tag_fruit#.seq', file_name)
+    assert_same_pulseq(pulseq_reader.load_pulseq(file_name),
+                       mr0.PulseqFile(file_name))
+    assert str(pulseq_reader.load_npz_mmap(sidecar)['key']) != key
+
+
+def test_corrupt_sidecar_is_ignored(tmp_path):
+    file_name = str(tmp_path / 'external.seq')
+    sidecar = file_name + pulseq_reader.SIDECAR_SUFFIX
+    copy_seq('exA02_SpinEcho.seq', file_name)
+    expected = mr0.PulseqFile(file_name)
+
+    pulseq_reader.load_pulseq(file_name)
+    with open(sidecar, 'r+b') as file:
+        file.truncate(os.path.getsize(sidecar) // 2)
+    assert_same_pulseq(pulseq_reader.load_pulseq(file_name), expected)
+
+    with open(sidecar, 'wb') as file:
+        file.write(b'not a zip file')
+    assert_same_pulseq(pulseq_reader.load_pulseq(file_name), expected)
+    # The sidecar was rewritten
+    pulseq_reader.load_npz_mmap(sidecar)
+    assert [name for name in os.listdir(tmp_path) if '.tmp' in name] == []
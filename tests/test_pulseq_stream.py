@@ -0,0 +1,92 @@
+import os
+import glob
+import numpy as np
+import pytest
+import torch
+import MRzeroCore as mr0
+from MRzeroCore.pulseq import pulseq_loader
+
+import pulseq_stream
+from conftest import EX_DIR, DATA_DIR
+from test_pulseq_reader import assert_same_pulseq
+
+
+# 1.3.1 (ex/out, data/out), 1.3.9 pTx (data/out) and 1.2.0 (BlochSimWeb)
+SEQ_FILES = sorted(
+    glob.glob(os.path.join(EX_DIR, 'out', '*.seq'))
+    + glob.glob(os.path.join(DATA_DIR, 'out', '*.seq'))
+    + glob.glob(os.path.join(
+        os.path.dirname(EX_DIR), 'BlochSimWeb', 'seq', 'out', '*.seq'))
+)
+
+
+def assert_same_value(value, expected):
+    if isinstance(expected, torch.Tensor):
+        assert torch.equal(torch.as_tensor(value), expected)
+    elif isinstance(expected, np.ndarray):
+        np.testing.assert_array_equal(value, expected)
+    elif isinstance(expected, (list, tuple)):
+        assert len(value) == len(expected)
+        for v, e in zip(value, expected):
+            assert_same_value(v, e)
+    else:
+        assert value == expected
+
+
+def assert_same_events(events, expected):
+    assert [type(e) for e in events] == [type(e) for e in expected]
+    for event, expected_event in zip(events, expected):
+        assert vars(event).keys() == vars(expected_event).keys()
+        for name, value in vars(expected_event).items():
+            assert_same_value(getattr(event, name), value)
+
+
+@pytest.mark.parametrize('file_name', SEQ_FILES, ids=os.path.basename)
+def test_lazy_file_same_as_mr0(file_name):
+    expected = mr0.PulseqFile(file_name)
+    # Small chunks, so that blocks are spread over multiple chunks
+    lazy = pulseq_stream.LazyPulseqFile(file_name, chunk_size=7)
+
+    assert len(lazy.blocks) == len(expected.blocks)
+    assert [len(chunk) for chunk in lazy.blocks.chunks()][0] \
+        == min(7, len(expected.blocks))
+    # Compares all libraries and every block, iterating the lazy blocks
+    assert_same_pulseq(lazy, expected)
+
+    for (block_id, block), expected_id in zip(lazy.blocks.items(),
+                                              expected.blocks):
+        assert block_id == expected_id
+        assert_same_events(pulseq_stream.decode_block(block, lazy),
+                           pulseq_stream.decode_block(
+                               expected.blocks[expected_id], expected))
+
+
+def assert_same_sequence(seq, expected):
+    assert len(seq) == len(expected)
+    for rep, expected_rep in zip(seq, expected):
+        assert rep.pulse.usage == expected_rep.pulse.usage
+        for name in ['angle', 'phase']:
+            assert torch.equal(torch.as_tensor(getattr(rep.pulse, name)),
+                               torch.as_tensor(getattr(expected_rep.pulse, name)))
+        for name in ['event_time', 'gradm', 'adc_phase', 'adc_usage']:
+            assert torch.equal(getattr(rep, name), getattr(expected_rep, name))
+
+
+@pytest.mark.parametrize('memoize', [True, False])
+@pytest.mark.parametrize('name', ['exB09_GRE_EPI_2D.seq', 'exA02_SpinEcho.seq'])
+def test_sequence_same_as_mr0(name, memoize):
+    file_name = os.path.join(EX_DIR, 'out', name)
+    expected_file = mr0.PulseqFile(file_name)
+    expected = mr0.Sequence.from_seq_file(expected_file)
+
+    assert_same_sequence(pulseq_stream.sequence_from_file(
+        file_name, chunk_size=100, memoize=memoize), expected)
+    assert_same_sequence(pulseq_stream.sequence_from_file(
+        expected_file, memoize=memoize), expected)
+
+    reps = pulseq_stream.intermediate(expected_file, memoize)
+    expected_reps = pulseq_loader.intermediate(expected_file)
+    assert len(reps) == len(expected_reps)
+    for rep, expected_rep in zip(reps, expected_reps):
+        assert rep[0] == expected_rep[0]
+        assert_same_events([rep[1]] + rep[2], [expected_rep[1]] + expected_rep[2])
@@ -0,0 +1,99 @@
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+import MRzeroCore as mr0
+
+pp = pytest.importorskip('pypulseq')
+import pypulseq_convert
+from conftest import EX_DIR
+from test_pulseq_reader import assert_same_pulseq
+from test_pulseq_stream import assert_same_sequence
+
+
+SEQ_FILES = sorted(glob.glob(os.path.join(EX_DIR, 'out', '*.seq')))
+
+
+@pytest.fixture(autouse=True)
+def numpy_aliases(monkeypatch):
+    # pypulseq 1.3 still uses the aliases that numpy >= 1.24 removed
+    for name, alias in [('int', int), ('float', float), ('complex', complex)]:
+        if name not in np.__dict__:
+            monkeypatch.setattr(np, name, alias, raising=False)
+
+
+def make_sequence(n=16, fov=0.2):
+    """Sinc pulse (arbitrary shapes), traps, refocusing pulse and delays."""
+    system = pp.Opts(max_grad=28, grad_unit='mT/m', max_slew=150,
+                     slew_unit='T/m/s', rf_ringdown_time=20e-6,
+                     rf_dead_time=100e-6, adc_dead_time=20e-6)
+    seq = pp.Sequence(system)
+    rf, gz, gzr = pp.make_sinc_pulse(
+        flip_angle=0.3, duration=1e-3, slice_thickness=8e-3, apodization=0.5,
+        time_bw_product=4, system=system, return_gz=True)
+    rf180 = pp.make_block_pulse(flip_angle=np.pi, duration=1e-3, system=system)
+    adc = pp.make_adc(num_samples=n, duration=6.4e-3, phase_offset=0.3,
+                      system=system)
+    gx = pp.make_trapezoid(channel='x', flat_area=n / fov, flat_time=6.4e-3,
+                           system=system)
+    gx_pre = pp.make_trapezoid(channel='x', area=-gx.area / 2, duration=1.5e-3,
+                               system=system)
+    for i in range(n):
+        gy = pp.make_trapezoid(channel='y', area=(i - n // 2) / fov,
+                               duration=1.5e-3, system=system)
+        seq.add_block(rf, gz)
+        seq.add_block(gzr, gx_pre, gy)
+        seq.add_block(adc, gx)
+        if i == 3:
+            seq.add_block(rf180)
+            seq.add_block(adc, gx)
+        seq.add_block(pp.make_delay(0.0123456))
+    seq.set_definition('FOV', [fov, fov, 8e-3])
+    seq.set_definition('Name', 'test')
+    return seq
+
+
+def read_sequence(file_name):
+    seq = pp.Sequence()
+    seq.read(file_name)
+    return seq
+
+
+@pytest.mark.parametrize('source', [
+    pytest.param(None, id='generated'),
+    *[pytest.param(f, id=os.path.basename(f)) for f in SEQ_FILES],
+])
+def test_same_as_written_file(source, tmp_path):
+    seq = make_sequence() if source is None else read_sequence(source)
+    file_name = str(tmp_path / 'external.seq')
+    seq.write(file_name)
+    expected = mr0.PulseqFile(file_name)
+
+    assert_same_pulseq(pypulseq_convert.pulseq_file_from_pypulseq(seq),
+                       expected)
+    assert_same_sequence(pypulseq_convert.sequence_from_pypulseq(seq),
+                         mr0.Sequence.from_seq_file(expected))
+
+
+def test_unrounded_values_are_close(tmp_path):
+    seq = make_sequence()
+    file_name = str(tmp_path / 'external.seq')
+    seq.write(file_name)
+    expected = mr0.Sequence.from_seq_file(mr0.PulseqFile(file_name))
+    seq0 = pypulseq_convert.sequence_from_pypulseq(seq, round_like_file=False)
+    assert len(seq0) == len(expected)
+    for rep, expected_rep in zip(seq0, expected):
+        np.testing.assert_allclose(rep.gradm, expected_rep.gradm,
+                                   rtol=1e-4, atol=1e-3)
+
+
+def test_write_async(tmp_path):
+    seq = make_sequence(n=4)
+    default = pypulseq_convert.write_async(seq, str(tmp_path / 'a.seq'))
+    with ThreadPoolExecutor(1) as executor:
+        pypulseq_convert.write_async(
+            seq, str(tmp_path / 'b.seq'), executor).result()
+    default.result()
+    with open(tmp_path / 'a.seq') as a, open(tmp_path / 'b.seq') as b:
+        assert a.read() == b.read()
@@ -0,0 +1,70 @@
+import os
+import torch
+import MRzeroCore as mr0
+
+import sim_cache
+from conftest import EX_DIR, DATA_DIR
+from test_brainweb_store import write_subject
+
+
+SEQ_FILE = os.path.join(EX_DIR, 'out', 'exA02_SpinEcho.seq')
+PHANTOM_FILE = os.path.join(DATA_DIR, 'numerical_brain_cropped.mat')
+MODIFY = [('T2dash', '=', 30e-3), ('D', '*=', 0), ('B0', '*=', 2)]
+
+
+def test_repeated_call_is_hit(tmp_path):
+    cache = sim_cache.SimCache(str(tmp_path))
+    signal = cache.simulate(SEQ_FILE, PHANTOM_FILE, sz=[16, 16], modify=MODIFY)
+    again = cache.simulate(SEQ_FILE, PHANTOM_FILE, sz=[16, 16], modify=MODIFY)
+    assert torch.equal(signal, again)
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 1
+
+    # Any other modification is a different entry
+    cache.simulate(SEQ_FILE, PHANTOM_FILE, sz=[16, 16], modify=MODIFY[:2])
+    assert cache.stats()['entries'] == 2
+
+
+def test_phantom_object_is_not_modified(tmp_path):
+    cache = sim_cache.SimCache(str(tmp_path))
+    obj_p = mr0.VoxelGridPhantom.load_mat(PHANTOM_FILE).interpolate(16, 16, 1)
+    B0 = obj_p.B0.clone()
+
+    signal = cache.simulate(SEQ_FILE, obj_p, modify=MODIFY)
+    assert torch.equal(obj_p.B0, B0)
+    again = cache.simulate(SEQ_FILE, obj_p, modify=MODIFY)
+    assert torch.equal(signal, again)
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_eviction(tmp_path):
+    cache = sim_cache.SimCache(str(tmp_path), max_size=1)
+    cache.simulate(SEQ_FILE, PHANTOM_FILE, sz=[16, 16])
+    cache.simulate(SEQ_FILE, PHANTOM_FILE, sz=[8, 8])
+    # The newest entry is kept even if it exceeds the limit
+    assert cache.stats()['entries'] == 1
+    cache.simulate(SEQ_FILE, PHANTOM_FILE, sz=[8, 8])
+    assert cache.hits == 1
+
+
+def test_brainweb_phantom(tmp_path):
+    phantom_file = str(tmp_path / 'subject05.npz')
+    write_subject(phantom_file)
+    cache = sim_cache.SimCache(str(tmp_path / 'cache'))
+
+    signal = cache.simulate(SEQ_FILE, phantom_file, sz=[16, 16],
+                            modify=MODIFY, slices=[12])
+    again = cache.simulate(SEQ_FILE, phantom_file, sz=[16, 16],
+                           modify=MODIFY, slices=[12])
+    assert torch.equal(signal, again)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Same as simulating the phantom loaded by mr0
+    obj_p = mr0.VoxelGridPhantom.brainweb(phantom_file).slices([12])
+    expected = cache.simulate(SEQ_FILE, obj_p.interpolate(16, 16, 1),
+                              modify=MODIFY)
+    assert cache.misses == 2
+    assert ((signal - expected).abs().max() / expected.abs().max()) < 1e-4
+
+    # Other slices are a different entry
+    cache.simulate(SEQ_FILE, phantom_file, sz=[16, 16], slices=[13])
+    assert cache.misses == 3 and cache.stats()['entries'] == 3
@@ -0,0 +1,21 @@
+import pytest
+import MRzeroCore as mr0
+
+import vector_pass
+from test_main_pass import SEQ_FILES, load_seq, load_data, simulate
+
+
+@pytest.mark.parametrize('seq_file', SEQ_FILES)
+@pytest.mark.parametrize('diffusion', [True, False])
+@pytest.mark.parametrize('B0', [True, False])
+def test_matches_mr0(seq_file, diffusion, B0, capsys):
+    seq = load_seq(seq_file)
+    data = load_data(diffusion, B0)
+
+    expected = simulate(mr0.execute_graph, seq, data)
+    capsys.readouterr()
+    signal = simulate(vector_pass.execute_graph_vectorized, seq, data,
+                      verbose=False)
+    assert capsys.readouterr().out == ''
+    error = (signal - expected).abs().max() / expected.abs().max()
+    assert error < 1e-5